@@ -0,0 +1,127 @@
+"""
+Benchmark a KRPC_Responder on Twisted's reactor and on asyncio loops
+
+For every loop, a process runs a KRPC_Responder on a loopback port,
+driven by that loop (@see mdht.asyncio_adapter), while `--clients'
+processes send it ping queries for `--seconds' seconds (as in
+benchmarks.reuseport_scaling). The loops are Twisted's default
+reactor, asyncio's default loop (trollius on python 2) and uvloop,
+where they are installed.
+
+Reported per loop:
+    answered_per_second: replies received by the clients per second
+
+Usage (from the root of the repository):
+    python -m benchmarks.event_loops --seconds 5
+
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+from mdht import constants, asyncio_adapter
+from benchmarks.reuseport_scaling import run_client, free_port
+
+def _importable(module_name):
+    try:
+        __import__(module_name)
+    except ImportError:
+        return False
+    return True
+
+def available_loops():
+    loops = ["twisted"]
+    if asyncio_adapter.available():
+        loops.append("asyncio")
+        if _importable("uvloop"):
+            loops.append("uvloop")
+    return loops
+
+def serve(loop_name, port):
+    """Answer queries on port until terminated"""
+    from mdht.protocols.krpc_responder import KRPC_Responder
+
+    # Measure the loops, not the rate limits or the shedding
+    constants.source_packet_rate = None
+    constants.subnet_packet_rate = None
+    constants.global_bandwidth_rate = None
+    constants.host_bandwidth_rate = None
+    constants.overload_lag_threshold = None
+    if loop_name == "twisted":
+        from twisted.internet import reactor
+        responder = KRPC_Responder(node_id=2**159 + 1)
+        reactor.listenUDP(port, responder, "127.0.0.1")
+        reactor.run()
+        return
+
+    asyncio = asyncio_adapter.asyncio
+    if loop_name == "uvloop":
+        import uvloop
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    responder = KRPC_Responder(node_id=2**159 + 1,
+                               _reactor=asyncio_adapter.LoopClock(loop))
+    loop.run_until_complete(
+        asyncio_adapter.listen_udp(port, responder, "127.0.0.1", loop))
+    loop.run_forever()
+
+def run_mode(loop_name, args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.event_loops",
+         "--serve", loop_name, "--port", str(port)])
+    try:
+        # Let the server bind the port
+        time.sleep(1)
+        counters = [multiprocessing.Value("l", 0)
+                    for _ in xrange(args.clients)]
+        clients = [multiprocessing.Process(target=run_client,
+                       args=(port, args.sockets, args.window, args.seconds,
+                             answered))
+                   for answered in counters]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+    answered = sum(counter.value for counter in counters)
+    return {"loop": loop_name,
+            "clients": args.clients,
+            "seconds": args.seconds,
+            "answered_per_second": answered / args.seconds}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--sockets", type=int, default=16,
+            help="client sockets per client")
+    parser.add_argument("--window", type=int, default=16,
+            help="outstanding queries per client socket")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        serve(args.serve, args.port)
+        return
+
+    loops = available_loops()
+    if len(loops) == 1:
+        sys.stderr.write("asyncio (or trollius) is not installed, "
+                         "only measuring twisted\n")
+    for loop_name in loops:
+        result = run_mode(loop_name, args)
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
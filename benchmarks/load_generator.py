@@ -0,0 +1,357 @@
+"""
+Generate KRPC query load against a DHT node and measure its replies
+
+`--processes' processes send a mix of ping, find_node, get_peers and
+announce_peer queries (weighted by `--mix') at `--rate' queries per
+second in total, for `--seconds' seconds. The queries come from
+`--node-ids' random node ids and `--sockets' source ports per process.
+Replies are matched to queries by transaction id; a query that is not
+answered within `--timeout' seconds is counted as lost. announce_peer
+queries carry tokens handed out in earlier get_peers replies; until a
+process has such a token, it sends get_peers queries in their place.
+
+The queries are sent to a running node (such as mdht_server) with
+`--port' (and `--host'); mind that its per-source rate limits
+(constants.source_packet_rate) then apply to the generated load.
+Without `--port', a KRPC_Responder is started in a separate process on
+a loopback port, with its rate limits and load shedding disabled.
+
+Several rates can be given (`--rate 1000 --rate 4000 ...') to find
+where the latency of the node degrades. Reported per rate:
+    sent_per_second, answered_per_second: queries sent and answered
+    sent, answered, errors, lost, late: query counts (late replies
+        arrived after their query was counted as lost)
+    send_failures: queries the local socket refused to send
+    loss: the fraction of the sent queries that were lost
+    latency: count, mean, min, max and percentile latencies (seconds)
+    rpctypes: the counts and latencies of every rpctype
+
+With --max-loss or --max-p99, the benchmark exits with an error status
+when a rate loses a larger fraction of its queries, or answers with a
+larger 99th percentile latency, so it can be used as a regression
+check.
+
+Usage (from the root of the repository):
+    python -m benchmarks.load_generator --rate 2000 --rate 8000
+    python -m benchmarks.load_generator --port 7001 --mix ping=1,get_peers=3
+
+"""
+import sys
+import json
+import time
+import errno
+import random
+import select
+import socket
+import argparse
+import subprocess
+import multiprocessing
+from bisect import bisect
+from collections import deque
+from timeit import default_timer
+
+from mdht import constants
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query, Error
+from mdht.latency_histogram import LatencyHistogram
+from benchmarks.reuseport_scaling import free_port
+
+RPCTYPES = ["ping", "find_node", "get_peers", "announce_peer"]
+
+# Queries sent at once when the generator falls behind its rate
+_MAX_BURST = 256
+# Tokens kept per socket for announce_peer queries
+_MAX_TOKENS = 1024
+
+def parse_mix(mix):
+    """
+    Parse a mix such as "ping=1,get_peers=3"
+
+    @returns a list of (rpctype, weight) pairs
+
+    """
+    weights = []
+    for entry in mix.split(","):
+        rpctype, _, weight = entry.partition("=")
+        rpctype = rpctype.strip()
+        if rpctype not in RPCTYPES:
+            raise ValueError("unknown rpctype: {0}".format(rpctype))
+        weight = float(weight or 1)
+        if weight > 0:
+            weights.append((rpctype, weight))
+    if not weights:
+        raise ValueError("the mix has no query with a positive weight")
+    return weights
+
+class _Tally(object):
+    """The counts and latencies of one rpctype"""
+    def __init__(self, max_latency):
+        self.sent = 0
+        self.answered = 0
+        self.errors = 0
+        self.lost = 0
+        self.latencies = LatencyHistogram(max_latency)
+
+    def merge(self, other):
+        self.sent += other.sent
+        self.answered += other.answered
+        self.errors += other.errors
+        self.lost += other.lost
+        self.latencies.merge(other.latencies)
+
+    def summary(self):
+        return {"sent": self.sent,
+                "answered": self.answered,
+                "errors": self.errors,
+                "lost": self.lost,
+                "latency": self.latencies.snapshot()}
+
+class Generator(object):
+    """Send queries at a fixed rate from one process, and match replies"""
+    def __init__(self, destination, rate, mix, node_ids, sockets, timeout,
+                 infohashes=1000, seed=None):
+        self.destination = destination
+        self.rate = rate
+        self.timeout = timeout
+        self._random = random.Random(seed)
+        self._rpctypes = [rpctype for rpctype, _ in mix]
+        self._cumulative_weights = []
+        total = 0
+        for _, weight in mix:
+            total += weight
+            self._cumulative_weights.append(total)
+        self._node_ids = [self._random.getrandbits(160)
+                          for _ in xrange(node_ids)]
+        self._infohashes = [self._random.getrandbits(160)
+                            for _ in xrange(infohashes)]
+        self._socks = []
+        for _ in xrange(sockets):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", 0))
+            sock.setblocking(False)
+            self._socks.append(sock)
+        self._tokens = dict((sock, deque(maxlen=_MAX_TOKENS))
+                            for sock in self._socks)
+        # transaction id: (sent time, rpctype, sock, node id, target id)
+        self._outstanding = {}
+        # (sent time, transaction id), oldest first
+        self._expiries = deque()
+        self._transaction_id = 0
+        self.tallies = dict((rpctype, _Tally(timeout))
+                            for rpctype in RPCTYPES)
+        self.send_failures = 0
+        self.late = 0
+
+    def run(self, seconds):
+        start = default_timer()
+        deadline = start + seconds
+        scheduled = 0
+        while True:
+            now = default_timer()
+            if now < deadline:
+                due = int((now - start) * self.rate) - scheduled
+                for _ in xrange(min(due, _MAX_BURST)):
+                    self._send_query(now)
+                scheduled += due
+                wait = 1.0 / self.rate
+            elif self._outstanding and now < deadline + self.timeout:
+                wait = 0.01
+            else:
+                break
+            self._expire(now)
+            readable, _, _ = select.select(self._socks, [], [], wait)
+            for sock in readable:
+                self._read_replies(sock)
+        self._expire(float("inf"))
+        for sock in self._socks:
+            sock.close()
+
+    def _send_query(self, now):
+        sock = self._random.choice(self._socks)
+        rpctype = self._rpctypes[bisect(self._cumulative_weights,
+            self._random.random() * self._cumulative_weights[-1])]
+        self._transaction_id += 1
+        query = Query(_transaction_id=self._transaction_id, rpctype=rpctype,
+                      _from=self._random.choice(self._node_ids))
+        if rpctype == "find_node":
+            query.target_id = self._random.getrandbits(160)
+        elif rpctype == "announce_peer" and self._tokens[sock]:
+            query._from, query.target_id, query.token = \
+                self._tokens[sock].popleft()
+            query.port = self._random.randint(1024, 65535)
+        elif rpctype != "ping":
+            query.rpctype = "get_peers"
+            query.target_id = self._random.choice(self._infohashes)
+        try:
+            sock.sendto(krpc_coder.encode(query), self.destination)
+        except socket.error:
+            self.send_failures += 1
+            return
+        self.tallies[query.rpctype].sent += 1
+        self._outstanding[query._transaction_id] = (now, query.rpctype,
+                sock, query._from, query.target_id)
+        self._expiries.append((now, query._transaction_id))
+
+    def _read_replies(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            received = default_timer()
+            try:
+                reply = krpc_coder.decode(data)
+            except Exception:
+                continue
+            outstanding = self._outstanding.pop(reply._transaction_id, None)
+            if outstanding is None:
+                if not isinstance(reply, Query):
+                    self.late += 1
+                continue
+            sent, rpctype, _, node_id, target_id = outstanding
+            tally = self.tallies[rpctype]
+            if isinstance(reply, Error):
+                tally.errors += 1
+                continue
+            tally.answered += 1
+            tally.latencies.record(received - sent)
+            if rpctype == "get_peers" and reply.token is not None:
+                self._tokens[sock].append((node_id, target_id, reply.token))
+
+    def _expire(self, now):
+        expiries = self._expiries
+        outstanding = self._outstanding
+        while expiries and now - expiries[0][0] >= self.timeout:
+            _, transaction_id = expiries.popleft()
+            query = outstanding.pop(transaction_id, None)
+            if query is not None:
+                self.tallies[query[1]].lost += 1
+
+def _generate(destination, args, rate, mix, seed, results):
+    generator = Generator(destination, rate, mix, args.node_ids,
+                          args.sockets, args.timeout, seed=seed)
+    generator.run(args.seconds)
+    results.put((generator.tallies, generator.send_failures,
+                 generator.late))
+
+def serve(port):
+    """Answer queries on a loopback port until terminated"""
+    from twisted.internet import reactor
+    from mdht.protocols.krpc_responder import KRPC_Responder
+
+    # Measure the responder, not the rate limits or the shedding
+    constants.source_packet_rate = None
+    constants.subnet_packet_rate = None
+    constants.global_bandwidth_rate = None
+    constants.host_bandwidth_rate = None
+    constants.overload_lag_threshold = None
+    responder = KRPC_Responder(node_id=2**159 + 1)
+    reactor.listenUDP(port, responder, "127.0.0.1")
+    reactor.run()
+
+def run_rate(destination, rate, mix, args):
+    results = multiprocessing.Queue()
+    generators = [multiprocessing.Process(target=_generate,
+                      args=(destination, args, float(rate) / args.processes,
+                            mix, args.seed + index, results))
+                  for index in xrange(args.processes)]
+    for generator in generators:
+        generator.start()
+    tallies = dict((rpctype, _Tally(args.timeout)) for rpctype in RPCTYPES)
+    send_failures = 0
+    late = 0
+    for _ in generators:
+        generator_tallies, generator_failures, generator_late = results.get()
+        for rpctype, tally in generator_tallies.iteritems():
+            tallies[rpctype].merge(tally)
+        send_failures += generator_failures
+        late += generator_late
+    for generator in generators:
+        generator.join()
+
+    total = _Tally(args.timeout)
+    for tally in tallies.itervalues():
+        total.merge(tally)
+    result = total.summary()
+    result.update({"rate": rate,
+                   "seconds": args.seconds,
+                   "processes": args.processes,
+                   "send_failures": send_failures,
+                   "late": late,
+                   "loss": float(total.lost) / max(total.sent, 1),
+                   "sent_per_second": total.sent / args.seconds,
+                   "answered_per_second": total.answered / args.seconds,
+                   "rpctypes": dict((rpctype, tally.summary())
+                                    for rpctype, tally in tallies.iteritems()
+                                    if tally.sent > 0)})
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None,
+            help="the port of the node to load (default: start one)")
+    parser.add_argument("--rate", type=int, action="append",
+            help="queries per second (default: 1000); may be repeated")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--mix",
+            default="ping=1,find_node=1,get_peers=1,announce_peer=1",
+            help="weights of the rpctypes")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--node-ids", type=int, default=10000,
+            help="fake node ids per process")
+    parser.add_argument("--sockets", type=int, default=64,
+            help="source ports per process")
+    parser.add_argument("--timeout", type=float, default=2,
+            help="seconds after which a query is lost")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-loss", type=float, default=None)
+    parser.add_argument("--max-p99", type=float, default=None)
+    parser.add_argument("--serve", action="store_true",
+            help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.port)
+        return
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = None
+    port = args.port
+    if port is None:
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.load_generator",
+             "--serve", "--port", str(port)])
+        # Let the server bind the port
+        time.sleep(1)
+    destination = (socket.gethostbyname(args.host), port)
+    failures = []
+    try:
+        for rate in args.rate or [1000]:
+            result = run_rate(destination, rate, mix, args)
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+            if args.max_loss is not None and result["loss"] > args.max_loss:
+                failures.append("{0} q/s: loss {1:.4f} above {2}".format(
+                    rate, result["loss"], args.max_loss))
+            p99 = result["latency"]["p99"]
+            if (args.max_p99 is not None and
+                    (p99 is None or p99 > args.max_p99)):
+                failures.append("{0} q/s: p99 latency {1} above {2}".format(
+                    rate, p99, args.max_p99))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if failures:
+        sys.exit("; ".join(failures))
+
+if __name__ == "__main__":
+    main()
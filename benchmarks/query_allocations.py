@@ -0,0 +1,149 @@
+"""
+Benchmark the allocations of the query lifecycle of KRPC_Sender
+
+A KRPC_Sender (with a transport that discards packets and a simulated
+clock) sends `--queries' queries, `--window' at a time, and either
+answers them or lets them time out. This is done through sendQuery
+(Deferreds) and through sendQueryCallback. The garbage collector is
+disabled while the queries run, so that everything that is not freed
+by reference counting alone is found by the collection afterwards.
+
+Reported per mode (counts are per 100000 queries):
+    cyclic_garbage: objects only the garbage collector could free
+        (this should be 0, anything else is a reference cycle)
+    collect_seconds: time taken by that collection
+    allocated_bytes, peak_bytes: memory still allocated after the
+        run, and its peak during the run (only if tracemalloc
+        is available)
+
+Usage (from the root of the repository):
+    python -m benchmarks.query_allocations --queries 100000
+
+With --max-garbage, the benchmark exits with an error status when any
+mode leaves more cyclic garbage than allowed, so it can be used to
+catch regressions.
+
+"""
+import gc
+import sys
+import json
+import argparse
+from timeit import default_timer
+
+from twisted.internet import task
+
+from mdht import constants
+from mdht.krpc_types import Query, Response
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.protocols.krpc_sender import KRPC_Sender
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class NullTransport(object):
+    def write(self, packet, address):
+        pass
+
+def _ignore(result):
+    pass
+
+def _ignore_callback(response, error):
+    pass
+
+def run_queries(sender, clock, api, outcome, queries, window):
+    address = ("127.0.0.1", 6881)
+    responder_id = 2**158
+    timeout = constants.rpctimeout
+    for first in xrange(0, queries, window):
+        sent = []
+        for i in xrange(first, min(first + window, queries)):
+            # Distinct targets, so that no query is coalesced
+            query = Query(rpctype="find_node", target_id=i)
+            if api == "deferred":
+                d = sender.sendQuery(query, address, timeout)
+                d.addBoth(_ignore)
+            else:
+                sender.sendQueryCallback(query, address, _ignore_callback,
+                                         timeout)
+            sent.append(query)
+        if outcome == "response":
+            for query in sent:
+                response = Response(_transaction_id=query._transaction_id,
+                                    _from=responder_id)
+                sender.krpcReceived(response, address)
+        else:
+            clock.advance(timeout)
+            clock.advance(constants._timer_granularity)
+
+def run_mode(api, outcome, queries, window):
+    clock = task.Clock()
+    sender = KRPC_Sender(TreeRoutingTable, 2**159, _reactor=clock)
+    sender.transport = NullTransport()
+    # Warm up, so that lazily created state is not counted
+    run_queries(sender, clock, api, outcome, window, window)
+
+    gc.collect()
+    gc.disable()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        start = default_timer()
+        run_queries(sender, clock, api, outcome, queries, window)
+        elapsed = default_timer() - start
+        if tracemalloc is not None:
+            allocated_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        collect_start = default_timer()
+        cyclic_garbage = gc.collect()
+        collect_seconds = default_timer() - collect_start
+    finally:
+        gc.enable()
+
+    scale = 100000.0 / queries
+    result = {"api": api,
+              "outcome": outcome,
+              "queries": queries,
+              "queries_per_second": queries / elapsed,
+              "cyclic_garbage": cyclic_garbage * scale,
+              "collect_seconds": collect_seconds * scale}
+    if tracemalloc is not None:
+        result["allocated_bytes"] = allocated_bytes * scale
+        result["peak_bytes"] = peak_bytes * scale
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100000)
+    parser.add_argument("--window", type=int, default=1000,
+            help="number of outstanding queries at a time")
+    parser.add_argument("--max-garbage", type=float, default=None,
+            help="fail if a mode leaves more cyclic garbage "
+                 "(per 100000 queries)")
+    args = parser.parse_args(argv)
+
+    # Measure the query lifecycle, not the bandwidth shaping,
+    # the per destination query limits or retransmissions
+    constants.global_bandwidth_rate = None
+    constants.host_bandwidth_rate = None
+    constants.max_queries_per_address = None
+    constants.max_queries_per_subnet = None
+    constants.rpc_retransmits = 0
+
+    failed = False
+    for api in ["deferred", "callback"]:
+        for outcome in ["response", "timeout"]:
+            result = run_mode(api, outcome, args.queries, args.window)
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+            if (args.max_garbage is not None and
+                    result["cyclic_garbage"] > args.max_garbage):
+                failed = True
+    if failed:
+        sys.exit("cyclic garbage above %s per 100000 queries" %
+                 args.max_garbage)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Benchmark how queries answered per second scale with worker processes
+
+For every worker count (1, 2, 4, ... up to `--max-workers'), that many
+processes each run a KRPC_Responder on one loopback port, shared
+through SO_REUSEPORT (@see mdht.workers). `--clients' processes then
+send ping queries from `--sockets' sockets each (the kernel spreads
+the workers' load by source address), keeping up to `--window'
+queries outstanding per socket, for `--seconds' seconds.
+
+Reported per worker count:
+    answered_per_second: replies received by the clients per second
+    scaling: answered_per_second relative to a single worker
+
+The clients are plain python too; give them enough cores (and
+processes) that they are not what is being measured.
+
+Usage (from the root of the repository):
+    python -m benchmarks.reuseport_scaling --max-workers 4 --seconds 5
+
+"""
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import argparse
+import subprocess
+import multiprocessing
+from timeit import default_timer
+
+from mdht import constants
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query
+
+def run_worker(port, node_id):
+    """Serve queries on the shared port until terminated"""
+    from twisted.internet import reactor
+    from mdht import workers
+    from mdht.protocols.krpc_responder import KRPC_Responder
+
+    # Measure the responders, not the rate limits or the shedding
+    constants.source_packet_rate = None
+    constants.subnet_packet_rate = None
+    constants.global_bandwidth_rate = None
+    constants.host_bandwidth_rate = None
+    constants.overload_lag_threshold = None
+    responder = KRPC_Responder(node_id=node_id)
+    workers.listen_reuseport(port, responder, "127.0.0.1")
+    reactor.run()
+
+def run_client(port, sockets, window, seconds, answered):
+    destination = ("127.0.0.1", port)
+    query = Query(_transaction_id=1, rpctype="ping", _from=2**158)
+    socks = []
+    for _ in xrange(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        socks.append(sock)
+    outstanding = dict((sock, 0) for sock in socks)
+    last_reply = dict((sock, default_timer()) for sock in socks)
+    count = 0
+    deadline = default_timer() + seconds
+    while True:
+        now = default_timer()
+        if now >= deadline:
+            break
+        for sock in socks:
+            # Replies that were dropped are not waited for forever
+            if now - last_reply[sock] > 0.2:
+                outstanding[sock] = 0
+                last_reply[sock] = now
+            while outstanding[sock] < window:
+                # A new transaction id for every query, so that the
+                # responder's reply cache does not answer them
+                query._transaction_id = query._transaction_id % 2**32 + 1
+                try:
+                    sock.sendto(krpc_coder.encode(query), destination)
+                except socket.error:
+                    break
+                outstanding[sock] += 1
+        readable, _, _ = select.select(socks, [], [], 0.01)
+        for sock in readable:
+            while True:
+                try:
+                    sock.recv(2048)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                count += 1
+                outstanding[sock] = max(0, outstanding[sock] - 1)
+            last_reply[sock] = default_timer()
+    answered.value = count
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def run_mode(worker_count, args):
+    port = free_port()
+    node_id = 2**159 + 1
+    worker_processes = [subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.reuseport_scaling",
+         "--worker-port", str(port), "--node-id", str(node_id)])
+        for _ in xrange(worker_count)]
+    try:
+        # Let the workers bind the port
+        time.sleep(1)
+        counters = [multiprocessing.Value("l", 0)
+                    for _ in xrange(args.clients)]
+        clients = [multiprocessing.Process(target=run_client,
+                       args=(port, args.sockets, args.window, args.seconds,
+                             answered))
+                   for answered in counters]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        for worker in worker_processes:
+            worker.terminate()
+            worker.wait()
+    answered = sum(counter.value for counter in counters)
+    return {"workers": worker_count,
+            "clients": args.clients,
+            "seconds": args.seconds,
+            "answered_per_second": answered / args.seconds}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-workers", type=int,
+            default=max(1, multiprocessing.cpu_count() / 2))
+    parser.add_argument("--clients", type=int,
+            default=max(1, multiprocessing.cpu_count() / 2))
+    parser.add_argument("--sockets", type=int, default=16,
+            help="client sockets (source addresses) per client")
+    parser.add_argument("--window", type=int, default=16,
+            help="outstanding queries per client socket")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--worker-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--node-id", type=long, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker_port is not None:
+        run_worker(args.worker_port, args.node_id)
+        return
+
+    from mdht import workers
+    if not workers.reuseport_available():
+        sys.exit("SO_REUSEPORT is not available on this system")
+
+    single_rate = None
+    worker_count = 1
+    while worker_count <= args.max_workers:
+        result = run_mode(worker_count, args)
+        if single_rate is None:
+            single_rate = result["answered_per_second"]
+        result["scaling"] = (result["answered_per_second"] /
+                             max(single_rate, 1))
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+        worker_count *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Benchmarks for IRoutingTable implementations
+
+For every combination of routing table class, id distribution and
+number of offered nodes, a fresh process is forked which measures:
+    * offer_node throughput (nodes offered per second)
+    * get_closest_nodes latency (percentiles over random targets)
+    * remove_node throughput (accepted nodes removed per second)
+    * memory used by the routing table (resident set growth)
+
+Results are written to stdout as one JSON object per line
+
+Usage (from the root of the repository):
+    python -m benchmarks.routing_table --sizes 1000,10000,100000 \\
+        --distributions uniform,clustered
+
+"""
+import gc
+import sys
+import json
+import random
+import argparse
+import resource
+import multiprocessing
+from timeit import default_timer
+
+from twisted.python.reflect import namedAny
+
+from mdht import constants
+from mdht.contact import Node
+from mdht.kademlia.routing_table import IRoutingTable
+
+DEFAULT_TABLES = ["mdht.kademlia.routing_table.TreeRoutingTable",
+                  "mdht.kademlia.routing_table.SubsecondRoutingTable"]
+
+def uniform_ids(rng, own_id, count):
+    """Node ids spread evenly over the whole id space"""
+    return [rng.getrandbits(constants.id_size) for _ in xrange(count)]
+
+def clustered_ids(rng, own_id, count, spread_bits=32):
+    """
+    Node ids sharing all but the lowest `spread_bits' bits with own_id
+
+    This is the adversarial case: every node lands in the deepest
+    kbuckets of the tree, forcing the maximum number of splits
+
+    """
+    return [own_id ^ rng.getrandbits(spread_bits) for _ in xrange(count)]
+
+def mixed_ids(rng, own_id, count, clustered_fraction=0.1):
+    """Mostly uniform ids, with a fraction clustered around own_id"""
+    num_clustered = int(count * clustered_fraction)
+    ids = (uniform_ids(rng, own_id, count - num_clustered) +
+           clustered_ids(rng, own_id, num_clustered))
+    rng.shuffle(ids)
+    return ids
+
+DISTRIBUTIONS = {"uniform": uniform_ids,
+                 "clustered": clustered_ids,
+                 "mixed": mixed_ids}
+
+def make_nodes(ids):
+    """Wrap the ids into nodes, each with a unique address"""
+    nodes = []
+    for num, node_id in enumerate(ids):
+        ip = "10.%d.%d.%d" % ((num >> 16) & 0xff, (num >> 8) & 0xff,
+                              num & 0xff)
+        nodes.append(Node(node_id, (ip, 1024 + (num >> 24))))
+    return nodes
+
+def resident_memory():
+    """Current resident set size in bytes (peak size if unavailable)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+def run_case(table_name, distribution, size, seed, num_lookups):
+    """
+    Run the benchmark for one routing table / distribution / size
+
+    @returns a dictionary of results
+
+    """
+    rng = random.Random(seed)
+    table_class = namedAny(table_name)
+    own_id = rng.getrandbits(constants.id_size)
+    nodes = make_nodes(DISTRIBUTIONS[distribution](rng, own_id, size))
+    targets = [rng.getrandbits(constants.id_size)
+               for _ in xrange(num_lookups)]
+
+    gc.collect()
+    memory_before = resident_memory()
+    objects_before = len(gc.get_objects())
+
+    rt = table_class(own_id)
+    start = default_timer()
+    accepted = [node for node in nodes if rt.offer_node(node)]
+    insert_time = default_timer() - start
+
+    gc.collect()
+    memory_after = resident_memory()
+    objects_after = len(gc.get_objects())
+
+    latencies = []
+    for target in targets:
+        start = default_timer()
+        rt.get_closest_nodes(target)
+        latencies.append(default_timer() - start)
+    latencies.sort()
+
+    start = default_timer()
+    for node in accepted:
+        rt.remove_node(node)
+    remove_time = default_timer() - start
+
+    return {"table": table_name,
+            "distribution": distribution,
+            "offered": size,
+            "accepted": len(accepted),
+            "kbuckets": len(rt.get_kbuckets()),
+            "seed": seed,
+            "insert_per_second": size / insert_time,
+            "remove_per_second": (len(accepted) / remove_time
+                                  if remove_time > 0 else None),
+            "closest_nodes_latency": {
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None},
+            "memory_bytes": memory_after - memory_before,
+            "gc_objects": objects_after - objects_before}
+
+def _run_case_in_child(queue, *args):
+    queue.put(run_case(*args))
+
+def run_isolated(*args):
+    """Run a case in a child process so memory results do not mix"""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_case_in_child,
+                                    args=(queue,) + args)
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", default=",".join(DEFAULT_TABLES),
+            help="comma separated IRoutingTable classes")
+    parser.add_argument("--distributions", default="uniform,clustered,mixed",
+            help="comma separated id distributions: %s" %
+                 ", ".join(sorted(DISTRIBUTIONS)))
+    parser.add_argument("--sizes", default="1000,10000,100000",
+            help="comma separated numbers of offered nodes")
+    parser.add_argument("--lookups", type=int, default=1000,
+            help="number of get_closest_nodes calls per case")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for table_name in args.tables.split(","):
+        if not IRoutingTable.implementedBy(namedAny(table_name)):
+            parser.error("%s does not implement IRoutingTable" % table_name)
+    for distribution in args.distributions.split(","):
+        if distribution not in DISTRIBUTIONS:
+            parser.error("unknown distribution: %s" % distribution)
+
+    for table_name in args.tables.split(","):
+        for distribution in args.distributions.split(","):
+            for size in [int(float(size)) for size in args.sizes.split(",")]:
+                result = run_isolated(table_name, distribution, size,
+                                      args.seed, args.lookups)
+                print json.dumps(result, sort_keys=True)
+                sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
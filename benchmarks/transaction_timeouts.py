@@ -0,0 +1,111 @@
+"""
+Benchmark transaction timeouts: TimerWheel against per-query DelayedCalls
+
+A KRPC_Sender (with a transport that discards packets) keeps a window
+of outstanding queries open. Every round it sends `--window' queries,
+lets the reactor iterate, answers all of them, and lets the reactor
+iterate again. This is done once with the sender's TimerWheel and
+once with a sender that schedules one reactor DelayedCall per query
+(the previous behaviour).
+
+Reported per mode:
+    queries_per_second: sustained send + reply rate
+    reactor_iteration_seconds: mean time of a reactor iteration while
+        the window is outstanding (the cost of the timed-call heap)
+    peak_delayed_calls: largest number of reactor DelayedCalls seen
+
+Usage (from the root of the repository):
+    python -m benchmarks.transaction_timeouts --window 20000 --rounds 10
+
+"""
+import sys
+import json
+import argparse
+from timeit import default_timer
+
+from twisted.internet import reactor
+
+from mdht import constants
+from mdht.krpc_types import Query, Response
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.protocols.krpc_sender import KRPC_Sender
+
+class NullTransport(object):
+    def write(self, packet, address):
+        pass
+
+class DelayedCallSender(KRPC_Sender):
+    """A KRPC_Sender that times out queries with reactor DelayedCalls"""
+    def _schedule_timeout(self, transaction, timeout):
+        return self._reactor.callLater(timeout, self._timed_out, transaction)
+
+def _ignore(result):
+    pass
+
+def run_mode(sender_class, window, rounds):
+    sender = sender_class(TreeRoutingTable, 2**159)
+    sender.transport = NullTransport()
+    address = ("127.0.0.1", 6881)
+    responder_id = 2**158
+
+    peak_delayed_calls = 0
+    iteration_time = 0
+    iterations = 0
+    start = default_timer()
+    for _ in xrange(rounds):
+        queries = []
+        for i in xrange(window):
+            # Distinct targets, so that no query is coalesced
+            query = Query(rpctype="find_node", target_id=i)
+            d = sender.sendQuery(query, address, constants.rpctimeout,
+                                 retransmits=0)
+            d.addBoth(_ignore)
+            queries.append(query)
+        peak_delayed_calls = max(peak_delayed_calls,
+                                 len(reactor.getDelayedCalls()))
+
+        iteration_start = default_timer()
+        reactor.iterate(0)
+        iteration_time += default_timer() - iteration_start
+        iterations += 1
+
+        for query in queries:
+            response = Response(_transaction_id=query._transaction_id,
+                                _from=responder_id)
+            sender.krpcReceived(response, address)
+
+        iteration_start = default_timer()
+        reactor.iterate(0)
+        iteration_time += default_timer() - iteration_start
+        iterations += 1
+    elapsed = default_timer() - start
+
+    return {"mode": sender_class.__name__,
+            "window": window,
+            "rounds": rounds,
+            "queries_per_second": window * rounds / elapsed,
+            "reactor_iteration_seconds": iteration_time / iterations,
+            "peak_delayed_calls": peak_delayed_calls}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--window", type=int, default=20000,
+            help="number of outstanding queries per round")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    # Measure the transaction table, not the bandwidth shaping
+    # or the per destination query limits
+    constants.global_bandwidth_rate = None
+    constants.host_bandwidth_rate = None
+    constants.max_queries_per_address = None
+    constants.max_queries_per_subnet = None
+
+    for sender_class in [KRPC_Sender, DelayedCallSender]:
+        result = run_mode(sender_class, args.window, args.rounds)
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
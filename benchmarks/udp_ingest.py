@@ -0,0 +1,116 @@
+"""
+Benchmark UDP ingest: RecvmmsgPort against Twisted's stock UDP port
+
+A child process floods a loopback port with KRPC ping queries for
+`--seconds' seconds while the reactor reads them, once through
+reactor.listenUDP and once through mdht.recvmmsg.RecvmmsgPort. Each
+mode is run with a protocol that only counts datagrams (the cost of
+the port itself) and with a KRPC_Sender (which also decodes them).
+
+Reported per mode:
+    packets_per_second: datagrams handed to the protocol per second
+    packets_sent: datagrams sent by the flooding process (the
+        difference was dropped by the kernel)
+
+Usage (from the root of the repository):
+    python -m benchmarks.udp_ingest --seconds 5
+
+"""
+import sys
+import json
+import socket
+import argparse
+import multiprocessing
+from timeit import default_timer
+
+from twisted.internet import reactor, protocol
+
+from mdht import constants, recvmmsg
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.protocols.krpc_sender import KRPC_Sender
+
+class CountingProtocol(protocol.DatagramProtocol):
+    def __init__(self):
+        self.count = 0
+
+    def datagramReceived(self, data, address):
+        self.count += 1
+
+    def datagramsReceived(self, datagrams):
+        self.count += len(datagrams)
+
+class CountingSender(KRPC_Sender):
+    """A KRPC_Sender counting the queries it decodes"""
+    def __init__(self):
+        KRPC_Sender.__init__(self, TreeRoutingTable, 2**159)
+        self.count = 0
+
+    def queryReceived(self, query, address):
+        self.count += 1
+
+def flood(port, seconds, sent):
+    query = Query(_transaction_id=1, rpctype="ping", _from=2**158)
+    packet = krpc_coder.encode(query)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destination = ("127.0.0.1", port)
+    count = 0
+    deadline = default_timer() + seconds
+    while default_timer() < deadline:
+        for _ in xrange(100):
+            try:
+                sock.sendto(packet, destination)
+                count += 1
+            except socket.error:
+                pass
+    sent.value = count
+
+def run_mode(port_mode, protocol_name, seconds):
+    if protocol_name == "count":
+        proto = CountingProtocol()
+    else:
+        proto = CountingSender()
+    if port_mode == "recvmmsg":
+        port = recvmmsg.RecvmmsgPort(0, proto, "127.0.0.1")
+        port.startListening()
+    else:
+        port = reactor.listenUDP(0, proto, "127.0.0.1")
+
+    sent = multiprocessing.Value("l", 0)
+    flooder = multiprocessing.Process(target=flood,
+            args=(port.getHost().port, seconds, sent))
+    start = default_timer()
+    flooder.start()
+    while flooder.is_alive():
+        reactor.iterate(0.01)
+    elapsed = default_timer() - start
+    flooder.join()
+    port.stopListening()
+
+    return {"port": port_mode,
+            "protocol": protocol_name,
+            "seconds": seconds,
+            "packets_per_second": proto.count / elapsed,
+            "packets_sent": sent.value}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args(argv)
+
+    if not recvmmsg.available():
+        sys.exit("recvmmsg is not available on this system")
+    # Measure the ports, not the source rate limits
+    constants.source_packet_rate = None
+    constants.subnet_packet_rate = None
+
+    for protocol_name in ["count", "krpc"]:
+        for port_mode in ["stock", "recvmmsg"]:
+            result = run_mode(port_mode, protocol_name, args.seconds)
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
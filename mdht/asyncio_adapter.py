@@ -0,0 +1,199 @@
+"""
+@author Greg Skoczek
+
+Running the KRPC protocols on an asyncio event loop
+
+The protocol logic only needs two things from its environment: a clock
+(the `_reactor' argument of the protocols, providing callLater and
+seconds as in twisted.internet.interfaces.IReactorTime) and a transport
+with write(packet, address). Deferreds returned by the protocols do
+not depend on a running reactor.
+
+LoopClock provides the clock on top of an asyncio loop, and
+KRPCDatagramProtocol connects a KRPC protocol to an asyncio datagram
+endpoint. The same responder and lookup code thus runs on either loop:
+
+    loop = asyncio.get_event_loop()
+    responder = KRPC_Responder(_reactor=LoopClock(loop))
+    loop.run_until_complete(listen_udp(6881, responder, loop=loop))
+    loop.run_forever()
+
+asyncio datagram transports never fail a send with EAGAIN: datagrams
+that the socket cannot take are buffered by the transport, without
+limit. Instead, the protocol is told to pause_writing() once the buffer
+grows past the transport's high-water mark, and to resume_writing()
+once it drained. While writing is paused, the transport handed to the
+KRPC protocol refuses packets with EAGAIN, so that the protocol's
+SendQueue backs off as it does on a full socket.
+
+On python 2, trollius is used where asyncio is not available.
+
+"""
+import errno
+import socket
+
+from zope.interface import implements
+from twisted.python import log
+from twisted.internet import error
+from twisted.internet.interfaces import IReactorTime
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+def available():
+    """Tells whether asyncio (or trollius) can be imported"""
+    return asyncio is not None
+
+class LoopClock(object):
+    """
+    The clock of an asyncio loop, as the KRPC protocols expect it
+
+    Only loop.call_later and loop.time are used
+
+    """
+    implements(IReactorTime)
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._calls = set()
+
+    def seconds(self):
+        return self._loop.time()
+
+    def callLater(self, delay, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) after `delay' seconds
+
+        @returns an object providing active(), cancel() and getTime(),
+            as a twisted DelayedCall would
+
+        """
+        call = _LoopDelayedCall(self, self._loop.time() + delay,
+                                function, args, kwargs)
+        call.handle = self._loop.call_later(delay, call._fire)
+        self._calls.add(call)
+        return call
+
+    def getDelayedCalls(self):
+        return list(self._calls)
+
+class _LoopDelayedCall(object):
+    """A call scheduled on an asyncio loop through a LoopClock"""
+
+    __slots__ = ("clock", "time", "function", "args", "kwargs", "handle")
+
+    def __init__(self, clock, time, function, args, kwargs):
+        self.clock = clock
+        self.time = time
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.handle = None
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return self.clock is not None
+
+    def cancel(self):
+        if self.clock is None:
+            raise error.AlreadyCalled("the call has already been run "
+                                      "or cancelled")
+        self.handle.cancel()
+        self._clear()
+
+    def _fire(self):
+        function, args, kwargs = self.function, self.args, self.kwargs
+        self._clear()
+        try:
+            function(*args, **kwargs)
+        except:
+            log.err(None, "Error while running a delayed call")
+
+    def _clear(self):
+        self.clock._calls.discard(self)
+        self.clock = None
+        self.function = None
+        self.args = None
+        self.kwargs = None
+        self.handle = None
+
+if asyncio is not None:
+    _DatagramProtocol = asyncio.DatagramProtocol
+else:
+    _DatagramProtocol = object
+
+class KRPCDatagramProtocol(_DatagramProtocol):
+    """
+    An asyncio datagram protocol driving a KRPC protocol
+
+    The KRPC protocol should have been created with a
+    LoopClock of the same loop as its _reactor
+
+    """
+    def __init__(self, krpc_protocol):
+        self.krpc_protocol = krpc_protocol
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.krpc_protocol.transport = _TransportAdapter(transport)
+        self.krpc_protocol.startProtocol()
+
+    def datagram_received(self, data, address):
+        # IPv6 addresses come with flow info and scope id
+        self.krpc_protocol.datagramReceived(data, address[:2])
+
+    def error_received(self, exc):
+        log.msg("error on the DHT socket: {0}".format(exc))
+
+    def connection_lost(self, exc):
+        self.krpc_protocol.stopProtocol()
+
+    def pause_writing(self):
+        self.krpc_protocol.transport.paused = True
+
+    def resume_writing(self):
+        self.krpc_protocol.transport.paused = False
+
+class _TransportAdapter(object):
+    """
+    Give an asyncio datagram transport the write() of twisted's
+
+    While `paused' (the transport's buffer is above its high-water
+    mark), write() raises socket.error(EAGAIN) as a full socket would
+
+    """
+    def __init__(self, transport):
+        self._transport = transport
+        self.paused = False
+
+    def write(self, packet, address):
+        if self.paused:
+            raise socket.error(errno.EAGAIN, "the write buffer is full")
+        self._transport.sendto(packet, address)
+
+    def getHandle(self):
+        return self._transport.get_extra_info("socket")
+
+def listen_udp(port, krpc_protocol, interface="", loop=None):
+    """
+    Listen for datagrams for krpc_protocol on an asyncio loop
+
+    @returns the loop's create_datagram_endpoint coroutine, to be
+        run by the loop; it results in a (transport, protocol) pair
+
+    """
+    if asyncio is None:
+        raise NotImplementedError("asyncio is not available")
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop.create_datagram_endpoint(
+        lambda: KRPCDatagramProtocol(krpc_protocol),
+        local_addr=(interface, port))
@@ -11,7 +11,7 @@ from twisted.python import log
 
 from mdht import contact
 from mdht.coding import basic_coder
-from mdht.coding.bencode import bdecode, bencode, BTFailure
+from mdht.coding.bencode import bdecode, bencode, BTFailure, encode_string
 from mdht.krpc_types import Query, Response, Error
 
 class InvalidKRPCError(Exception):
@@ -64,6 +64,9 @@ def encode(message):
 
     """
     try:
+        if (isinstance(message, Response) and
+                message._packet_prefix is not None):
+            return _encode_from_prefix(message)
         packet = _encode(message)
         return packet
     except (ValueError, KeyError, AttributeError, _ProtocolFormatError,
@@ -72,6 +75,32 @@ def encode(message):
     else:
         return packet
 
+def encode_nodes_prefix(node_id, nodes):
+    """
+    Pre-encode the beginning of a response from `node_id' carrying `nodes'
+
+    The prefix can be attached to any Response with the same _from
+    and nodes (and no peers) as its _packet_prefix. Encoding such a
+    Response only appends the token and transaction id to the prefix
+
+    @see mdht.krpc_types.Response
+    @raises InvalidKRPCError if the node_id or nodes are invalid
+
+    """
+    try:
+        encoded_nodes = "".join(contact.encode_node(node) for node in nodes)
+        prefix = ["d"]
+        encode_string("r", prefix)
+        prefix.append("d")
+        encode_string("id", prefix)
+        encode_string(basic_coder.encode_network_id(node_id), prefix)
+        encode_string("nodes", prefix)
+        encode_string(encoded_nodes, prefix)
+        return "".join(prefix)
+    except (ValueError, AttributeError, TypeError,
+            basic_coder.InvalidDataError):
+        raise InvalidKRPCError(nodes)
+
 ##
 ## Private encoding / decoding helper functions
 ##
@@ -217,6 +246,27 @@ def _encode(message):
     encoded_msg = bencode(intermediate_msg)
     return encoded_msg
 
+def _encode_from_prefix(response):
+    """
+    Encode a response that carries a pre-encoded _packet_prefix
+
+    The bencoded keys are sorted, so everything that follows the
+    nodes of the response ("token" in the response dictionary, then
+    "t" and "y" in the message dictionary) is simply appended
+
+    @see encode_nodes_prefix
+
+    """
+    packet = [response._packet_prefix]
+    if response.token is not None:
+        encode_string("token", packet)
+        encode_string(basic_coder.ltob(response.token), packet)
+    packet.append("e")
+    encode_string("t", packet)
+    encode_string(basic_coder.ltob(response._transaction_id), packet)
+    packet.append("1:y1:re")
+    return "".join(packet)
+
 def _query_encoder(query):
     """@see encode"""
     query_dict = {"q": query.rpctype,
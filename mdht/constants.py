@@ -6,8 +6,33 @@ k = 8
 id_size = 160
 
 # Time after which an RPC will timeout and fail (seconds)
+# Unless a timeout is given explicitly, RPCs time out sooner, based on
+# the RTTs observed for their destination (@see mdht.rtt_estimator),
+# and this is the upper bound of such timeouts
 rpctimeout = 30
 
+# Timeout of RPCs to destinations that we have no RTT history for,
+# and the lower bound of RTT based timeouts (seconds)
+rpctimeout_initial = 5
+rpctimeout_min = 1
+
+# The number of times an unanswered RPC is sent again before it times
+# out. The first retransmission happens after timeout / (2**(n+1) - 1)
+# seconds, and every further one after twice the previous interval.
+# Off by default: every retransmission is extra traffic to a node that
+# may simply be gone
+rpc_retransmits = 0
+
+# The maximum number of outstanding RPCs to a single address, and to
+# all addresses in one /24 subnet. Further RPCs wait until an earlier
+# one completes (None disables a limit)
+max_queries_per_address = 8
+max_queries_per_subnet = 32
+
+# The maximum number of RPCs waiting for their /24 subnet to drop
+# below the limits above. Further RPCs fail with a QueryLimitError
+max_waiting_queries_per_subnet = 64
+
 # Time after which a high level query (as used in the SimpleNodeProtocol)
 # should timeout (seconds)
 query_timeout = 60           # 1 minute
@@ -40,7 +65,9 @@ tokensize = 32
 token_timeout = 600         # 10 minutes
 
 # Transaction ID size (bits)
-transaction_id_size = 32
+# Ids are this size as long as fewer than 2**transaction_id_size
+# queries are outstanding; longer ids are used beyond that
+transaction_id_size = 16
 
 # Failcount threshold: The number of KRPCs a node can fail before being
 # being remove from the routing table (int)
@@ -57,13 +84,67 @@ bootstrap_addresses = [("127.0.0.1", 2323),
                    ("dht.transmissionbt.com", 6881),
                    ("router.utorrent.com", 6881)]
 
+# The maximum number of imported nodes that are pinged at the same time
+# while verifying an external node list (int)
+# @see mdht.node_import
+import_concurrency = 64
+
 
 # Global outgoing bandwidth limit (bytes / second)
+# Packets exceeding it are queued, responses ahead of queries
+# (None disables the limit)
+# @see mdht.send_queue
 global_bandwidth_rate = 20 * 1024   # 20 kilobytes
 
-# Outgoing bandwidth limit per host (bytes / second)
+# Outgoing bandwidth limit per host (bytes / second, or None)
 host_bandwidth_rate = 5 * 1024      # 5 kilobytes
 
+# Incoming packet rate limits, per source address and per /24 subnet
+# (packets / second, or None). Excess datagrams are dropped before
+# they are decoded
+# @see mdht.source_filter
+source_packet_rate = 50
+subnet_packet_rate = 200
+
+# Addresses ("1.2.3.4") and networks ("1.2.3.0/24") whose
+# datagrams are always dropped
+source_blocklist = []
+
+# Event loop lag (seconds) from which incoming queries are shed, by
+# rpctype in the order below: the first rpctype is shed from this lag
+# on, the second from twice this lag, and so on. Replies to our own
+# queries are never shed (None disables shedding)
+# @see mdht.overload
+overload_lag_threshold = 0.1
+overload_shed_order = ["announce_peer", "get_peers", "find_node", "ping"]
+
+
+# Time for which the reply to a query is kept, to answer retransmissions
+# of the query (same address, transaction id and rpctype) without
+# computing the reply again (seconds), and the maximum number of
+# replies kept
+reply_cache_timeout = 10
+reply_cache_size = 5000
+
+# Upper bounds of the bins used to report the distribution of node ages
+# (seconds since a node was last heard from) in the routing table stats
+# @see mdht.kademlia.routing_table.IRoutingTable.get_stats
+stats_age_bins = [60, 300, node_timeout, 3600]
+
+# Upper bounds of the bins used to report the distribution of node RTTs
+# in the routing table stats (seconds)
+stats_rtt_bins = [0.05, 0.1, 0.25, 0.5, 1, 2, 5]
+
+
+# Interval at which the kernel counters (drops, queue sizes)
+# of the DHT socket are sampled (seconds)
+# @see mdht.socket_monitor
+socket_sample_interval = 10
+
+# The first of the loopback ports on which the worker processes serving
+# one node talk to each other (worker i uses worker_base_port + i)
+# @see mdht.workers
+worker_base_port = 7100
 
 # The default port on which DHTBot will run
 dht_port = 1800
@@ -79,3 +160,64 @@ dht_port = 1800
 # Note: For proper functionality, token_timeout should
 # be a multiple of _secret_timeout
 _secret_timeout = 5 * 60    # 5 minutes
+
+# Granularity of the timer wheel used to time out outstanding
+# transactions (seconds), and the number of slots in the wheel
+# (together they should cover rpctimeout)
+# @see mdht.timer_wheel
+_timer_granularity = 0.5
+_timer_slots = 64
+
+# Number of destinations for which RTT statistics are remembered
+_rtt_max_addresses = 10000
+
+# The maximum number of outgoing packets (of each priority) waiting
+# for bandwidth; further packets are dropped
+_send_queue_size = 1000
+
+# Number of destinations for which a bandwidth bucket is remembered
+_send_queue_max_hosts = 10000
+
+# The largest datagram we expect to send (bytes). Bandwidth buckets
+# always allow bursts of at least this size
+_max_datagram_size = 1500
+
+# The maximum number of packets written in one go, before other
+# reactor events get a turn
+_send_batch_size = 256
+
+# Pause before retrying to write to a socket whose buffer is full,
+# doubled (up to the maximum) while it stays full (seconds)
+_send_backoff_min = 0.005
+_send_backoff_max = 0.5
+
+# Number of source addresses (and of subnets) for which an incoming
+# packet rate bucket is remembered
+_source_filter_max_sources = 10000
+
+# Sources may send bursts of this many seconds worth of packets
+_source_burst_seconds = 2
+
+# The maximum number of datagrams read by one recvmmsg call
+# @see mdht.recvmmsg
+_recvmmsg_batch_size = 64
+
+# Interval at which the event loop lag is measured (seconds), and the
+# weight of every new measurement in the smoothed lag (as it falls)
+# @see mdht.overload
+_overload_sample_interval = 0.05
+_overload_lag_smoothing = 0.25
+
+# Interval at which worker processes tell each other about the nodes
+# they have added to their routing tables (seconds), and the number
+# of nodes sent per datagram
+# @see mdht.workers
+_worker_share_interval = 10
+_worker_nodes_per_datagram = 50
+
+# Size of the shared memory buffer through which every worker of a
+# DecodePool receives its batches of datagrams (bytes), and the number
+# of batches waiting for a worker beyond which batches are dropped
+# @see mdht.offload
+_offload_buffer_size = 256 * 1024
+_offload_max_pending = 64
@@ -153,3 +153,7 @@ class Node(object):
 def address_str(address):
     return "%s:%d" % address
 
+def address_subnet(address):
+    """Return the /24 subnet (as in "1.2.3") of an IPv4 address"""
+    return address[0].rpartition(".")[0]
+
@@ -42,8 +42,15 @@ class KBucket(object):
     Each KBucket also has a maxsize, which determines the maximum
     number of nodes that this KBucket will hold
 
+    A KBucket may be given a discard_callback, a callable that is
+    passed every node that the KBucket throws away on its own (ie,
+    a node evicted in favor of a better one, or a node that did not
+    fit into either half during a split). KBuckets created by split()
+    inherit the discard_callback of their parent
+
     """
-    def __init__(self, range_min, range_max, maxsize=constants.k):
+    def __init__(self, range_min, range_max, maxsize=constants.k,
+            discard_callback=None):
         self._nodes = set()
         if range_min >= range_max:
             raise KBucketError("__init__",
@@ -53,6 +60,7 @@ class KBucket(object):
         self.range_min = range_min
         self.range_max = range_max
         self.maxsize = maxsize
+        self.discard_callback = discard_callback
 
     def offer_node(self, node):
         """
@@ -84,6 +92,7 @@ class KBucket(object):
             worst_node = self._get_worst_node()
             if node.better_than(worst_node):
                 self.remove_node(worst_node)
+                self._discard(worst_node)
             else:
                 return False
 
@@ -124,10 +133,12 @@ class KBucket(object):
         new_width = (self.range_max - self.range_min) / 2
         lbucket = KBucket(range_min=self.range_min,
                           range_max=(self.range_min + new_width),
-                          maxsize=self.maxsize)
+                          maxsize=self.maxsize,
+                          discard_callback=self.discard_callback)
         rbucket = KBucket(range_min=(self.range_min + new_width),
                           range_max=self.range_max,
-                          maxsize=self.maxsize)
+                          maxsize=self.maxsize,
+                          discard_callback=self.discard_callback)
 
         self._distribute_nodes(lbucket, rbucket)
         self.maxsize = 0
@@ -169,6 +180,9 @@ class KBucket(object):
     def full(self):
         return len(self._nodes) == self.maxsize
 
+    def __len__(self):
+        return len(self._nodes)
+
     def get_stalest_node(self):
         """
         Returns the node that has been refreshed the longest time ago
@@ -209,3 +223,9 @@ class KBucket(object):
                 rbucket.offer_node(node)
             else:
                 log.msg("While splitting a KBucket, we threw away a node")
+                self._discard(node)
+
+    def _discard(self, node):
+        """Report a node this KBucket threw away to the discard_callback"""
+        if self.discard_callback is not None:
+            self.discard_callback(node)
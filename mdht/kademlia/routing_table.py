@@ -6,11 +6,12 @@ Implementation of a RoutingTable for the Kademlia network
 @see references/README for Rasterbar's BitTorrent Overview
 
 """
+import time
 import random
 from collections import defaultdict
 
 from twisted.python import log
-from zope.interface import Interface, implements
+from zope.interface import Interface, Attribute, implements
 
 from mdht import contact, constants
 from mdht.kademlia import kbucket
@@ -22,6 +23,15 @@ class IRoutingTable(Interface):
     @see DHBot/references/kademlia.pdf
 
     """
+    version = Attribute("""
+        A counter that increases every time a node is added to or
+        removed from the routing table, or a kbucket is split
+
+        Objects derived from the contents of the routing table can
+        remember the version they were built from and compare it
+        to this value to find out whether they are out of date
+        """)
+
     def offer_node(self, node):
         """Offers the given node to the RoutingTable
 
@@ -66,6 +76,69 @@ class IRoutingTable(Interface):
 
         """
 
+    def get_stats(self):
+        """
+        Report on the health and occupancy of the routing table
+
+        @return a dictionary of plain python values (suitable for
+            serialization) with the following keys:
+            counters: accepted/rejected/evicted/removed nodes, and
+                the number of splits and nodes dropped during splits,
+                counted since the routing table was created
+            kbuckets: a list of dictionaries (depth, nodes, maxsize),
+                one per active kbucket, ordered by depth
+            ages: how many nodes were last heard from within each of
+                the intervals found in constants.stats_age_bins
+                (the last bin counts everything older)
+            rtts: how many nodes have an RTT within each of the
+                intervals found in constants.stats_rtt_bins
+                (the last bin counts everything slower)
+            stale: the number of nodes that are not fresh
+            unknown_rtt: the number of nodes that never replied
+
+        """
+
+    def register_observer(self, observer):
+        """
+        Register an IRoutingTableObserver to be told about changes
+
+        The observer's methods are called synchronously, right after
+        the change has been made to the routing table
+
+        """
+
+    def unregister_observer(self, observer):
+        """
+        Stop telling the given observer about changes
+
+        Nothing happens if the observer was not registered
+
+        """
+
+class IRoutingTableObserver(Interface):
+    """
+    An object interested in the changes made to an IRoutingTable
+
+    @see IRoutingTable.register_observer
+
+    """
+    def node_added(self, node):
+        """Called after `node' has been added to the routing table"""
+
+    def node_removed(self, node):
+        """
+        Called after `node' has left the routing table
+
+        This includes nodes that were removed with remove_node as well
+        as nodes that were evicted to make room for better nodes
+
+        """
+
+    def bucket_split(self, kbucket, lbucket, rbucket):
+        """
+        Called after `kbucket' has been split into lbucket and rbucket
+        """
+
 class TreeRoutingTable(object):
     """
     Prefix tree based Kademlia routing table
@@ -80,11 +153,18 @@ class TreeRoutingTable(object):
 
     def __init__(self, node_id):
         self.node_id = node_id
-        k = kbucket.KBucket(0, 2**constants.id_size)
+        k = kbucket.KBucket(0, 2**constants.id_size,
+                discard_callback=self._node_discarded)
         self.root = _TreeNode(k)
         self.nodes_dict = {}
         self.nodes_by_addr = defaultdict(set)
         self.active_kbuckets = [k]
+        self.version = 0
+        self._observers = []
+        # Counters are kept up to date as the table changes
+        # @see get_stats
+        self.counters = defaultdict(int)
+        self._splitting = False
 
     def offer_node(self, node):
         if node.node_id in self.nodes_dict:
@@ -97,15 +177,20 @@ class TreeRoutingTable(object):
                 # for quick lookup later
                 self.nodes_dict[node.node_id] = node
                 self.nodes_by_addr[node.address].add(node)
+                self.counters["accepted"] += 1
+                self.version += 1
+                if self._observers:
+                    for observer in list(self._observers):
+                        observer.node_added(node)
+            else:
+                self.counters["rejected"] += 1
             return node_accepted
 
     def remove_node(self, node):
         if node.node_id in self.nodes_dict:
-            del self.nodes_dict[node.node_id]
-            self.nodes_by_addr[node.address].remove(node)
-            if len(self.nodes_by_addr[node.address]) == 0:
-                del self.nodes_by_addr[node.address]
             self._remove_node(self.root, node)
+            self._forget_node(node)
+            self.counters["removed"] += 1
             return True
         else:
             return False
@@ -137,6 +222,79 @@ class TreeRoutingTable(object):
         """
         return self.active_kbuckets
 
+    def get_stats(self):
+        kbuckets = []
+        for kbucket in self.active_kbuckets:
+            width = kbucket.range_max - kbucket.range_min
+            depth = constants.id_size - (width.bit_length() - 1)
+            kbuckets.append({"depth": depth, "nodes": len(kbucket),
+                             "maxsize": kbucket.maxsize})
+        kbuckets.sort(key = lambda bucket_stats: bucket_stats["depth"])
+
+        # Ages and RTTs change without the routing table noticing,
+        # so these are the only values computed on demand
+        ages = [0] * (len(constants.stats_age_bins) + 1)
+        rtts = [0] * (len(constants.stats_rtt_bins) + 1)
+        stale = 0
+        unknown_rtt = 0
+        current_time = time.time()
+        for node in self.nodes_dict.itervalues():
+            age = current_time - node.last_updated
+            ages[_bin_index(constants.stats_age_bins, age)] += 1
+            if age >= constants.node_timeout:
+                stale += 1
+            if node.successcount + node.failcount == 0:
+                unknown_rtt += 1
+            else:
+                rtts[_bin_index(constants.stats_rtt_bins, node._rtt())] += 1
+
+        return {"counters": dict(self.counters),
+                "kbuckets": kbuckets,
+                "nodes": len(self.nodes_dict),
+                "ages": ages,
+                "rtts": rtts,
+                "stale": stale,
+                "unknown_rtt": unknown_rtt,
+                "version": self.version}
+
+    def register_observer(self, observer):
+        if observer not in self._observers:
+            self._observers.append(observer)
+
+    def unregister_observer(self, observer):
+        if observer in self._observers:
+            self._observers.remove(observer)
+
+    def _forget_node(self, node):
+        """
+        Remove a node (that has left the tree) from the lookup dictionaries
+
+        The version is increased and observers are told of the removal
+
+        """
+        del self.nodes_dict[node.node_id]
+        self.nodes_by_addr[node.address].remove(node)
+        if len(self.nodes_by_addr[node.address]) == 0:
+            del self.nodes_by_addr[node.address]
+        self.version += 1
+        if self._observers:
+            for observer in list(self._observers):
+                observer.node_removed(node)
+
+    def _node_discarded(self, node):
+        """
+        Called by our kbuckets whenever they throw away a node by themselves
+
+        @see mdht.kademlia.kbucket.KBucket
+
+        """
+        if self.nodes_dict.get(node.node_id) is node:
+            self._forget_node(node)
+            if self._splitting:
+                self.counters["split_dropped"] += 1
+            else:
+                self.counters["evicted"] += 1
+
     def _offer_node(self, tnode, node):
         """
         Recursive helper function for offer_node
@@ -170,7 +328,8 @@ class TreeRoutingTable(object):
             if (tnode.kbucket.full() and
                 tnode.kbucket.splittable() and
                 tnode.kbucket.key_in_range(self.node_id)):
-                self._split(tnode)
+                if self._split(tnode):
+                    self._bucket_split(tnode)
                 node_accepted = self._offer_node(tnode, node)
                 return node_accepted
         return False
@@ -252,7 +411,11 @@ class TreeRoutingTable(object):
             not tnode.kbucket.key_in_range(self.node_id)):
             return False
 
+        # Nodes that the kbucket throws away while splitting
+        # are counted separately from evictions
+        self._splitting = True
         (lbucket, rbucket) = tnode.kbucket.split()
+        self._splitting = False
         tnode.lchild = _TreeNode(lbucket)
         tnode.rchild = _TreeNode(rbucket)
         # The original kbucket is no longer active
@@ -262,6 +425,27 @@ class TreeRoutingTable(object):
         self.active_kbuckets.extend([lbucket, rbucket])
         return True
 
+    def _bucket_split(self, tnode):
+        """Record that the given treenode has just been split"""
+        self.counters["splits"] += 1
+        self.version += 1
+        if self._observers:
+            for observer in list(self._observers):
+                observer.bucket_split(tnode.kbucket,
+                        tnode.lchild.kbucket, tnode.rchild.kbucket)
+
+def _bin_index(bins, value):
+    """
+    Return the index of the first bin whose upper bound exceeds value
+
+    Values beyond the last bound fall into the index len(bins)
+
+    """
+    for index, upper_bound in enumerate(bins):
+        if value < upper_bound:
+            return index
+    return len(bins)
+
 class _TreeNode(object):
     """
     An auxilary node structure for the TreeRoutingTable
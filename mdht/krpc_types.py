@@ -58,6 +58,11 @@ class Query(_KRPC):
     token: the token used to validate an announce_peer query
            (the token originates from a previous get_peers query response)
     port: the port that the announcing peer will be listening on
+    _issued_token: optional token to hand out in the response to this
+                   get_peers query, computed before the query reached
+                   the responder (@see mdht.offload)
+    _token_valid: optional result of the verification of the token of
+                  this announce_peer query, likewise computed in advance
 
     """
     def __init__(self, _transaction_id=None, rpctype=None,
@@ -68,6 +73,8 @@ class Query(_KRPC):
         self.target_id = target_id
         self.token = token
         self.port = port
+        self._issued_token = None
+        self._token_valid = None
 
     def build_response(self, nodes=None, token=None, peers=None):
         """
@@ -118,6 +125,10 @@ class Response(_KRPC):
     values: a list of peers that are associated with the target ID
             as specified in the originating query
     _from: the node that received the original query
+    _packet_prefix: optional pre-encoded beginning of this response
+                    (its _from and nodes), which the encoder uses instead
+                    of encoding them again
+                    @see mdht.coding.krpc_coder.encode_nodes_prefix
 
     """
     def __init__(self, _transaction_id=None, _from=None,
@@ -128,6 +139,7 @@ class Response(_KRPC):
         self.token = token
         self.peers = peers 
         self.rpctype = rpctype 
+        self._packet_prefix = None
 
     def __repr__(self):
         printable_attributes = self._get_attrs()
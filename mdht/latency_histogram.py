@@ -0,0 +1,140 @@
+"""
+@author Greg Skoczek
+
+Compact latency histograms with a fixed relative precision
+
+Latencies are counted in log-linear buckets (as in HdrHistogram):
+values (in microseconds) below 2**sub_bucket_bits have a bucket
+each, and every further power of two is divided into
+2**(sub_bucket_bits - 1) equally wide buckets. Every bucket is thus
+at most 2**-(sub_bucket_bits - 1) of its value wide, whatever the
+magnitude of the value. Recording a latency costs a few integer
+operations and one array increment.
+
+"""
+from array import array
+
+# Latencies are recorded in whole microseconds
+_UNITS_PER_SECOND = 1000000
+
+class LatencyHistogram(object):
+    """
+    Count latencies of up to `max_latency' seconds
+
+    Larger latencies are counted in the last bucket (their exact
+    maximum is still reported)
+
+    """
+    def __init__(self, max_latency, sub_bucket_bits=6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self._sub_bucket_count = 1 << sub_bucket_bits
+        self._half_count = self._sub_bucket_count >> 1
+        self._max_value = int(max_latency * _UNITS_PER_SECOND)
+        self._counts = array("l", [0]) * (self._index(self._max_value) + 1)
+        self.reset()
+
+    def record(self, latency):
+        """Count a latency (in seconds)"""
+        value = int(latency * _UNITS_PER_SECOND)
+        if value < 0:
+            value = 0
+        if value > self.max:
+            self.max = value
+        if value < self.min:
+            self.min = value
+        self.count += 1
+        self.total += value
+        if value > self._max_value:
+            value = self._max_value
+        self._counts[self._index(value)] += 1
+
+    def percentile(self, percent):
+        """
+        @returns the latency (seconds) below which `percent' percent
+            of the recorded latencies lie (within the precision of the
+            buckets), or None if nothing was recorded
+
+        """
+        if self.count == 0:
+            return None
+        # The rank of the sought latency, counting from 1
+        rank = max(1, int(round(percent / 100.0 * self.count)))
+        seen = 0
+        last_index = len(self._counts) - 1
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                if index == last_index:
+                    # Latencies beyond the maximum end up here
+                    value = self.max
+                else:
+                    value = min(self._highest_value(index), self.max)
+                return max(value, self.min) / float(_UNITS_PER_SECOND)
+
+    def snapshot(self):
+        """
+        Summarize the recorded latencies
+
+        @returns a dictionary with the count, and the mean, min, max
+            and 50th, 90th, 99th and 99.9th percentile latencies in
+            seconds (these are None if nothing was recorded)
+
+        """
+        summary = {"count": self.count}
+        if self.count == 0:
+            for name in ["mean", "min", "max", "p50", "p90", "p99", "p999"]:
+                summary[name] = None
+            return summary
+        seconds = float(_UNITS_PER_SECOND)
+        summary["mean"] = self.total / seconds / self.count
+        summary["min"] = self.min / seconds
+        summary["max"] = self.max / seconds
+        for name, percent in [("p50", 50), ("p90", 90), ("p99", 99),
+                              ("p999", 99.9)]:
+            summary[name] = self.percentile(percent)
+        return summary
+
+    def merge(self, other):
+        """
+        Count the latencies recorded by another histogram
+
+        @raises ValueError if the histograms have different buckets
+
+        """
+        if (other.sub_bucket_bits != self.sub_bucket_bits or
+                len(other._counts) != len(self._counts)):
+            raise ValueError("the histograms have different buckets")
+        counts = self._counts
+        for index, count in enumerate(other._counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        """Forget all recorded latencies"""
+        for index in xrange(len(self._counts)):
+            self._counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.min = float("inf")
+        self.max = 0
+
+    def _index(self, value):
+        if value < self._sub_bucket_count:
+            return value
+        exponent = value.bit_length() - self.sub_bucket_bits
+        half_count = self._half_count
+        return (self._sub_bucket_count + (exponent - 1) * half_count +
+                (value >> exponent) - half_count)
+
+    def _highest_value(self, index):
+        """The largest value counted in the bucket at index"""
+        if index < self._sub_bucket_count:
+            return index
+        half_count = self._half_count
+        exponent = (index - self._sub_bucket_count) // half_count + 1
+        mantissa = (index - self._sub_bucket_count) % half_count + half_count
+        return ((mantissa + 1) << exponent) - 1
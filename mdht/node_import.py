@@ -0,0 +1,232 @@
+"""
+@author Greg Skoczek
+
+Import lists of DHT nodes from external sources (for fast bootstrapping)
+
+Two formats are understood:
+    * libtorrent style `dht_state' files: a bencoded dictionary whose
+      "nodes" entry holds compact (6 byte) ip/port strings, either
+      concatenated into one string or as a list of strings
+    * plain text lists with one `host:port' per line (blank lines and
+      lines starting with '#' are ignored)
+
+Imported addresses are not trusted blindly: the NodeImporter pings
+every address and it is the response to the ping that places the
+node into the routing table
+
+"""
+import socket
+
+from twisted.python import log
+from twisted.internet import reactor, defer
+
+from mdht import constants
+from mdht.krpc_types import Query
+from mdht.coding import basic_coder
+from mdht.coding.bencode import bdecode, BTFailure
+
+class NodeImportError(Exception):
+    """
+    Error signifying that a node list could not be parsed
+
+    @param message: a message describing what went wrong
+
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def __repr__(self):
+        return "<NodeImportError(%s)>" % self.message
+
+    __str__ = __repr__
+
+def parse_dht_state(data):
+    """
+    Extract the addresses found in a bencoded libtorrent dht_state
+
+    Compact node strings (26 bytes: node id and address) are accepted
+    in the list form as well, in which case only the address is kept
+
+    @returns a list of (ip, port) tuples
+    @raises NodeImportError if the data is not a valid dht_state
+
+    """
+    try:
+        state = bdecode(data)
+    except BTFailure:
+        raise NodeImportError("dht_state is not validly bencoded")
+    if not isinstance(state, dict) or "nodes" not in state:
+        raise NodeImportError("dht_state does not contain any nodes")
+
+    nodes = state["nodes"]
+    if isinstance(nodes, str):
+        if len(nodes) % 6 != 0:
+            raise NodeImportError("dht_state nodes string has a bad length")
+        nodes = [nodes[i:i+6] for i in xrange(0, len(nodes), 6)]
+    elif not isinstance(nodes, list):
+        raise NodeImportError("dht_state nodes entry has a bad type")
+
+    addresses = []
+    for node_string in nodes:
+        if not isinstance(node_string, str):
+            continue
+        # Strip the node id off of compact node strings
+        if len(node_string) == 26:
+            node_string = node_string[20:]
+        try:
+            addresses.append(basic_coder.decode_address(node_string))
+        except basic_coder.InvalidDataError:
+            log.msg("dht_state: skipping invalid node string")
+    return addresses
+
+def parse_address_list(text):
+    """
+    Extract the (host, port) pairs found in a `host:port' per line list
+
+    Invalid lines are logged and skipped
+
+    @returns a list of (host, port) tuples
+
+    """
+    addresses = []
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        host, sep, port_str = line.rpartition(":")
+        try:
+            port = int(port_str)
+            basic_coder.encode_port(port)
+        except (ValueError, basic_coder.InvalidDataError):
+            port = None
+        if not sep or not host or port is None:
+            log.msg("address list: skipping invalid line '%s'" % line)
+            continue
+        addresses.append((host, port))
+    return addresses
+
+def load_addresses(path):
+    """
+    Read the addresses out of the node list file found at `path'
+
+    The file is read as a dht_state if it is a bencoded dictionary,
+    and as an address list otherwise
+
+    @returns a list of (host, port) tuples
+    @raises NodeImportError if the file is a dht_state without nodes
+    @raises IOError if the file cannot be read
+
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        state = bdecode(data)
+    except BTFailure:
+        state = None
+    if isinstance(state, dict):
+        return parse_dht_state(data)
+    return parse_address_list(data)
+
+class NodeImporter(object):
+    """
+    Verify a stream of addresses by pinging them with bounded concurrency
+
+    At most `concurrency' pings are outstanding at any given time. The
+    addresses are pulled lazily from the given iterable, so very large
+    node lists are never copied in memory. Every node that answers its
+    ping is added to the protocol's routing table by the protocol itself
+
+    offered: the number of addresses pulled from the iterable
+    verified: the number of addresses that answered their ping
+    failed: the number of addresses that could not be resolved,
+            timed out, or answered with an error
+
+    """
+    def __init__(self, krpc_protocol,
+            concurrency=constants.import_concurrency, _reactor=None):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self.krpc_protocol = krpc_protocol
+        self.concurrency = concurrency
+        self.offered = 0
+        self.verified = 0
+        self.failed = 0
+        self._outstanding = 0
+        self._addresses = None
+        self._deferred = None
+        self._filling = False
+
+    def import_addresses(self, addresses):
+        """
+        Ping every address found in the iterable `addresses'
+
+        @returns a Deferred that fires with this NodeImporter once
+            every address has been pinged (and answered or failed)
+
+        """
+        if self._deferred is not None:
+            return defer.fail(
+                NodeImportError("An import is already in progress"))
+        self._addresses = iter(addresses)
+        self._deferred = defer.Deferred()
+        d = self._deferred
+        self._fill()
+        return d
+
+    def _fill(self):
+        """Start pings until the concurrency limit is reached"""
+        # Pings that fail synchronously would otherwise recurse
+        # back into _fill for every address in the list
+        if self._filling:
+            return
+        self._filling = True
+        while (self._addresses is not None and
+                self._outstanding < self.concurrency):
+            try:
+                address = next(self._addresses)
+            except StopIteration:
+                self._addresses = None
+                break
+            self.offered += 1
+            self._outstanding += 1
+            host, port = address
+            try:
+                socket.inet_aton(host)
+            except socket.error:
+                # Resolve the host into an ip first
+                d = self._reactor.resolve(host)
+                d.addCallbacks(self._resolved, self._resolve_failed,
+                               callbackArgs=(port,))
+            else:
+                self._ping(address)
+        self._filling = False
+        self._check_completion()
+
+    def _resolved(self, ip, port):
+        self._ping((ip, port))
+
+    def _resolve_failed(self, failure):
+        self._ping_done(None, failure.value)
+
+    def _ping(self, address):
+        self.krpc_protocol.sendQueryCallback(Query(rpctype="ping"),
+                                             address, self._ping_done)
+
+    def _ping_done(self, response, error):
+        # Every error (resolution, timeout, error or encoding)
+        # only means that this address is not usable
+        if error is None:
+            self.verified += 1
+        else:
+            self.failed += 1
+        self._outstanding -= 1
+        self._fill()
+
+    def _check_completion(self):
+        if (self._addresses is None and self._outstanding == 0 and
+                self._deferred is not None):
+            d, self._deferred = self._deferred, None
+            d.callback(self)
@@ -0,0 +1,317 @@
+"""
+@author Greg Skoczek
+
+Decoding datagrams (and computing tokens) in worker processes
+
+Decoding every datagram, and hashing a token for every get_peers and
+announce_peer query, are the bulk of the CPU work of a responder.
+A DecodePool hands batches of datagrams (as read by a RecvmmsgPort)
+to worker processes, so that the reactor process is left with the
+I/O and with updating its state.
+
+Every worker has a buffer in shared memory. The datagrams of a batch
+are copied into the buffer of an idle worker, and only their lengths
+and addresses (and the current token secrets) go through the worker's
+pipe. The worker answers with the decoded krpcs, with _issued_token
+set on get_peers queries and _token_valid on announce_peer queries
+(@see mdht.krpc_types.Query). The reactor reads the answers as soon as
+the pipe becomes readable.
+
+Batches wait while every worker is busy, up to `max_pending' of
+them; further batches are dropped. A worker that dies is replaced,
+and the batch it was decoding is decoded in the reactor process
+instead. Without live workers (before start(), or when they cannot be
+restarted), batches are decoded in the reactor process.
+
+@see mdht.protocols.krpc_sender.KRPC_Sender.decode_pool
+
+"""
+import os
+import ctypes
+import signal
+import hashlib
+import multiprocessing
+from collections import deque
+
+from zope.interface import implements
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+
+from mdht import constants
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query
+from mdht.protocols.krpc_responder import token_hash
+
+class DecodePool(object):
+    """
+    A pool of `workers' processes decoding batches of datagrams
+
+    Batches are only handed to the workers once start() is called
+
+    """
+    def __init__(self, workers=2, hash_name="sha512",
+            buffer_size=constants._offload_buffer_size,
+            max_pending=constants._offload_max_pending, _reactor=None):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self.worker_count = workers
+        self.hash_name = hash_name
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self._workers = []
+        self._idle = deque()
+        # (datagrams, callback, secrets) waiting for an idle worker
+        self._pending = deque()
+        self.submitted = 0
+        self.dropped = 0
+        self.inline = 0
+        self.restarted = 0
+
+    def start(self):
+        """Start the worker processes"""
+        for _ in xrange(self.worker_count):
+            self._idle.append(self._start_worker())
+
+    def stop(self):
+        """Stop the worker processes (batches being decoded are lost)"""
+        for worker in self._workers:
+            self._reactor.removeReader(worker)
+            worker.stop()
+        self._workers = []
+        self._idle.clear()
+        self._pending.clear()
+
+    def submit(self, datagrams, callback, secrets=None):
+        """
+        Decode a batch of (data, address) datagrams
+
+        callback(datagrams, krpcs) is called once the batch is decoded;
+        krpcs holds the krpc decoded from every datagram (None for
+        malformed datagrams)
+
+        @param secrets: the token secrets (@see _TokenGenerator
+            .current_secrets), or None to compute no tokens
+
+        """
+        # Batches are cut to fit the shared buffers
+        batch = []
+        size = 0
+        for datagram in datagrams:
+            length = len(datagram[0])
+            if batch and size + length > self.buffer_size:
+                self._submit_batch(batch, callback, secrets)
+                batch = []
+                size = 0
+            batch.append(datagram)
+            size += length
+        if batch:
+            self._submit_batch(batch, callback, secrets)
+
+    def get_stats(self):
+        return {"workers": len(self._workers),
+                "idle_workers": len(self._idle),
+                "pending_batches": len(self._pending),
+                "submitted_batches": self.submitted,
+                "dropped_batches": self.dropped,
+                "inline_batches": self.inline,
+                "restarted_workers": self.restarted}
+
+    def _start_worker(self):
+        worker = _Worker(self)
+        self._workers.append(worker)
+        self._reactor.addReader(worker)
+        return worker
+
+    def _submit_batch(self, batch, callback, secrets):
+        if not self._workers or len(batch[0][0]) > self.buffer_size:
+            # No worker to decode it (or too large for the
+            # buffers), decode it here
+            self._decode_inline(batch, callback, secrets)
+            return
+        if self._idle:
+            self._idle.popleft().decode(batch, callback, secrets)
+        elif len(self._pending) < self.max_pending:
+            self._pending.append((batch, callback, secrets))
+        else:
+            self.dropped += 1
+            return
+        self.submitted += 1
+
+    def _worker_done(self, worker):
+        if self._pending:
+            batch, callback, secrets = self._pending.popleft()
+            worker.decode(batch, callback, secrets)
+        else:
+            self._idle.append(worker)
+
+    def _worker_died(self, worker):
+        """Replace a worker whose process exited"""
+        log.msg("a DecodePool worker exited")
+        self._reactor.removeReader(worker)
+        worker.stop()
+        self._workers.remove(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        batch, callback, secrets = worker.take_batch()
+        try:
+            replacement = self._start_worker()
+        except Exception:
+            log.err(None, "could not restart a DecodePool worker")
+        else:
+            self.restarted += 1
+            self._worker_done(replacement)
+        if not self._workers:
+            pending, self._pending = self._pending, deque()
+            for pending_batch in pending:
+                self._decode_inline(*pending_batch)
+        if batch is not None:
+            self._decode_inline(batch, callback, secrets)
+
+    def _decode_inline(self, batch, callback, secrets):
+        self.inline += 1
+        krpcs = [_decode(data, address, secrets, self.hash_name)
+                 for data, address in batch]
+        try:
+            callback(batch, krpcs)
+        except:
+            log.err()
+
+class _Worker(object):
+    """A worker process, as seen (and read) by the reactor"""
+    implements(IReadDescriptor)
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = multiprocessing.RawArray(ctypes.c_char,
+                                               pool.buffer_size)
+        self.connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_worker_main,
+            args=(self.buffer, child_connection, pool.hash_name))
+        self._process.daemon = True
+        self._process.start()
+        child_connection.close()
+        self._batch = None
+        self._callback = None
+        self._secrets = None
+
+    def decode(self, batch, callback, secrets):
+        lengths = []
+        addresses = []
+        offset = 0
+        for data, address in batch:
+            length = len(data)
+            self.buffer[offset:offset + length] = data
+            offset += length
+            lengths.append(length)
+            addresses.append(address)
+        self._batch = batch
+        self._callback = callback
+        self._secrets = secrets
+        try:
+            self.connection.send((lengths, addresses, secrets))
+        except (IOError, OSError):
+            # The process is gone; once the reactor reads the end of
+            # the pipe, the pool decodes the batch itself
+            pass
+
+    def take_batch(self):
+        """@returns the (batch, callback, secrets) being decoded"""
+        taken = self._batch, self._callback, self._secrets
+        self._batch = None
+        self._callback = None
+        self._secrets = None
+        return taken
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (IOError, OSError):
+            pass
+        self.connection.close()
+        self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(1)
+        if self._process.is_alive():
+            # Killed before it could restore the default SIGTERM handler
+            os.kill(self._process.pid, signal.SIGKILL)
+            self._process.join()
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def doRead(self):
+        """Called by the reactor once the worker has answered"""
+        try:
+            krpcs = self.connection.recv()
+        except (EOFError, IOError):
+            self.pool._worker_died(self)
+            return
+        batch, callback, _ = self.take_batch()
+        self.pool._worker_done(self)
+        try:
+            callback(batch, krpcs)
+        except:
+            log.err()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return "DecodePool"
+
+def _worker_main(buffer, connection, hash_name):
+    """Decode batches until told to stop"""
+    # A worker forked while the reactor runs inherits its signal
+    # handling, which would keep it from dying on SIGTERM; SIGINT
+    # is left to the reactor process, which stops the pool
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        lengths, addresses, secrets = task
+        krpcs = []
+        offset = 0
+        for length, address in zip(lengths, addresses):
+            data = buffer[offset:offset + length]
+            offset += length
+            krpcs.append(_decode(data, address, secrets, hash_name))
+        connection.send(krpcs)
+
+def _decode(data, address, secrets, hash_name):
+    """
+    Decode a datagram, computing the token of get_peers and
+    announce_peer queries if secrets are given
+
+    @returns the krpc, or None if the datagram is malformed
+
+    """
+    try:
+        krpc = krpc_coder.decode(data)
+    except Exception:
+        return None
+    if secrets and isinstance(krpc, Query):
+        hash_constructor = lambda: hashlib.new(hash_name)
+        try:
+            if krpc.rpctype == "get_peers":
+                krpc._issued_token = token_hash(krpc, address, secrets[0],
+                                                hash_constructor)
+            elif krpc.rpctype == "announce_peer":
+                krpc._token_valid = any(
+                    token_hash(krpc, address, secret,
+                               hash_constructor) == krpc.token
+                    for secret in secrets)
+        except Exception:
+            # Leave it to the responder
+            pass
+    return krpc
@@ -0,0 +1,104 @@
+"""
+@author Greg Skoczek
+
+Shedding of incoming queries while the reactor is overloaded
+
+When the reactor has more work than CPU time, every timed call runs
+late. OverloadController schedules a call every `interval' seconds
+and measures by how much it is late (the event loop lag). While the
+(smoothed) lag is high, incoming queries are shed by rpctype: the
+first rpctype of the shed order is dropped once the lag reaches the
+lag threshold, the second one once it reaches twice the threshold,
+and so on. Replies to our own queries are never shed.
+
+@see mdht.constants.overload_lag_threshold
+@see mdht.constants.overload_shed_order
+
+"""
+from collections import defaultdict
+
+from twisted.internet import reactor
+
+from mdht import constants
+
+class OverloadController(object):
+    """
+    Measure the event loop lag and decide which queries to shed
+
+    Lag is only measured while the controller is started. A lag
+    threshold of None disables shedding
+
+    """
+    def __init__(self, _reactor=None,
+            lag_threshold=constants.overload_lag_threshold,
+            shed_order=constants.overload_shed_order,
+            interval=constants._overload_sample_interval):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self.lag_threshold = lag_threshold
+        self.shed_order = list(shed_order)
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # The rpctypes currently being shed
+        self.shedding = frozenset()
+        # rpctype => number of queries shed
+        self.counters = defaultdict(int)
+        self._expected_time = None
+        self._call = None
+
+    def start(self):
+        if self._call is None:
+            self._schedule()
+
+    def stop(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+    def admit(self, rpctype):
+        """
+        Tell whether an incoming query of rpctype should be processed
+
+        Every query that is not admitted is counted under its rpctype
+
+        """
+        if rpctype in self.shedding:
+            self.counters[rpctype] += 1
+            return False
+        return True
+
+    def get_stats(self):
+        return {"lag": self.lag,
+                "max_lag": self.max_lag,
+                "shedding": sorted(self.shedding),
+                "shed_queries": dict(self.counters)}
+
+    def _schedule(self):
+        self._expected_time = self._reactor.seconds() + self.interval
+        self._call = self._reactor.callLater(self.interval, self._measure)
+
+    def _measure(self):
+        """Record how late this call is, and reschedule it"""
+        sample = max(0.0, self._reactor.seconds() - self._expected_time)
+        self.max_lag = max(self.max_lag, sample)
+        # Rising lag is followed at once, so that shedding
+        # starts quickly; it is forgotten more gradually
+        if sample >= self.lag:
+            self.lag = sample
+        else:
+            smoothing = constants._overload_lag_smoothing
+            self.lag += smoothing * (sample - self.lag)
+        self._update_shedding()
+        self._schedule()
+
+    def _update_shedding(self):
+        if self.lag_threshold is None or self.lag < self.lag_threshold:
+            self.shedding = frozenset()
+            return
+        level = int(self.lag / self.lag_threshold)
+        self.shedding = frozenset(self.shed_order[:level])
@@ -21,3 +21,29 @@ class KRPCError(Exception):
     """
     def __init__(self, error):
         self.error = error
+
+class QueryLimitError(Exception):
+    """
+    Error denoting that a Query was not sent, because too many
+    queries to its destination (or its /24 subnet) were outstanding
+    and waiting to be sent
+
+    address: the address the query was meant for
+
+    """
+    def __init__(self, address):
+        Exception.__init__(self, address)
+        self.address = address
+
+class SendDroppedError(Exception):
+    """
+    Error denoting that a Query was not sent, because the send
+    queue dropped its packet (to stay within the bandwidth limits,
+    @see mdht.send_queue)
+
+    address: the address the query was meant for
+
+    """
+    def __init__(self, address):
+        Exception.__init__(self, address)
+        self.address = address
@@ -7,14 +7,16 @@ import time
 import random
 import hashlib
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from zope.interface import implements
 from twisted.python import log
 
 from mdht import constants, contact
-from mdht.coding import basic_coder
+from mdht.coding import basic_coder, krpc_coder
 from mdht.krpc_types import Query
 from mdht.protocols.krpc_sender import KRPC_Sender
-from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.kademlia.routing_table import TreeRoutingTable, \
+                                        IRoutingTableObserver
 
 class KRPC_Responder(KRPC_Sender):
     def __init__(self, routing_table_class=TreeRoutingTable,
@@ -30,6 +32,48 @@ class KRPC_Responder(KRPC_Sender):
         # Datastore is used for storing peers on torrents
         self._datastore = defaultdict(set)
         self._token_generator = _TokenGenerator()
+        self._closest_nodes_cache = _ClosestNodesCache(self.routing_table)
+        self._reply_cache = _ReplyCache(constants.reply_cache_timeout,
+                                        constants.reply_cache_size,
+                                        self._reactor)
+        # The reply cache key of the query being answered
+        self._answering = None
+
+    def queryReceived(self, query, address):
+        """
+        Answer a retransmitted query with the reply already sent to it
+
+        Queries that we have not answered before (or whose cached
+        reply has expired) are dispatched as usual
+
+        @see _ReplyCache
+
+        """
+        key = _reply_key(query, address)
+        packet = self._reply_cache.get(key)
+        if packet is not None:
+            self.sendPacket(packet, address)
+            return
+        self._answering = key
+        try:
+            KRPC_Sender.queryReceived(self, query, address)
+        finally:
+            self._answering = None
+
+    def sendResponse(self, response, address):
+        """Send the response, and remember it for retransmitted queries"""
+        response._from = self.node_id
+        packet = krpc_coder.encode(response)
+        key = self._answering
+        if (key is not None and key[0] == address and
+                key[1] == response._transaction_id):
+            self._reply_cache.put(key, packet)
+        self.sendPacket(packet, address)
+
+    def get_stats(self):
+        stats = KRPC_Sender.get_stats(self)
+        stats["reply_cache"] = self._reply_cache.get_stats()
+        return stats
 
     def ping_Received(self, query, address):
         response = query.build_response()
@@ -40,37 +84,51 @@ class KRPC_Responder(KRPC_Sender):
         # Give them the node if we have it,
         # otherwise give them the nodes closest to it
         if target_node is not None:
-            nodes = [target_node]
+            response = query.build_response(nodes=[target_node])
         else:
-            nodes = self.routing_table.get_closest_nodes(query.target_id)
-        response = query.build_response(nodes=nodes)
+            nodes, prefix = self._closest_nodes_cache.get(query.target_id)
+            response = query.build_response(nodes=nodes)
+            response._packet_prefix = prefix
         self.sendResponse(response, address)
 
     def get_peers_Received(self, query, address):
         # Give them the peers if we have them,
         # otherwise, give them nodes
         nodes = None
+        prefix = None
         peers = self._datastore.get(query.target_id)
         have_peers = peers is not None and len(peers) > 0
         if not have_peers:
             peers = None
-            nodes = self.routing_table.get_closest_nodes(query.target_id)
+            nodes, prefix = self._closest_nodes_cache.get(query.target_id)
 
-        # Generate a unique token for the response
-        token = self._token_generator.generate(query, address)
+        # Generate a unique token for the response (unless
+        # it was generated while the query was decoded)
+        token = query._issued_token
+        if token is None:
+            token = self._token_generator.generate(query, address)
         response = query.build_response(nodes=nodes, peers=peers, token=token)
+        response._packet_prefix = prefix
         self.sendResponse(response, address)
 
     def announce_peer_Received(self, query, address):
         token = query.token
-        token_is_valid = self._token_generator.verify(query, address, token)
+        token_is_valid = query._token_valid
+        if token_is_valid is None:
+            token_is_valid = self._token_generator.verify(query, address,
+                                                          token)
         if token_is_valid:
             # If the token is valid, we authenticate
             # the querying node to store itself as a peer
             # in our datastore
             node_ip, node_port = address
             peer_address = (node_ip, query.port)
-            self._datastore[query.target_id].add(peer_address)
+            self.store_peer(query.target_id, peer_address)
+            # The other workers serving this node answer get_peers
+            # queries for the same infohash from their own datastores
+            if self.worker_channel is not None:
+                self.worker_channel.share_peer(query.target_id,
+                                               peer_address)
             # announce_peer responses have no additional
             # data (and serve just as a confirmation)
             response = query.build_response()
@@ -80,24 +138,31 @@ class KRPC_Responder(KRPC_Sender):
                     "{0} sent an announce_peer with an invalid token: {1}".format(
                     contact.address_str(address), str(token)))
 
-    def ping(self, address, timeout=constants.rpctimeout):
+    def store_peer(self, infohash, peer_address):
+        """Store a peer that announced itself for infohash"""
+        self._datastore[infohash].add(peer_address)
+
+    def _token_secrets(self):
+        return self._token_generator.current_secrets()
+
+    def ping(self, address, timeout=None):
         query = Query()
         query.rpctype = "ping"
         return self.sendQuery(query, address, timeout)
 
-    def find_node(self, address, node_id, timeout=constants.rpctimeout):
+    def find_node(self, address, node_id, timeout=None):
         query = Query()
         query.rpctype = "find_node"
         query.target_id = node_id
         return self.sendQuery(query, address, timeout)
 
-    def get_peers(self, address, target_id, timeout=constants.rpctimeout):
+    def get_peers(self, address, target_id, timeout=None):
         query = Query()
         query.rpctype = "get_peers"
         query.target_id = target_id
         return self.sendQuery(query, address, timeout)
 
-    def announce_peer(self, address, target_id, token, port, timeout=constants.rpctimeout):
+    def announce_peer(self, address, target_id, token, port, timeout=None):
         query = Query()
         query.rpctype = "announce_peer"
         query.target_id = target_id
@@ -105,6 +170,193 @@ class KRPC_Responder(KRPC_Sender):
         query.port = port
         return self.sendQuery(query, address, timeout)
 
+class _ClosestNodesCache(object):
+    """
+    Cache the closest nodes (and their encoding) handed out in responses
+
+    Answers are cached per kbucket: every target in a kbucket gets the
+    closest nodes to the first target asked for in it. KBuckets that
+    can hold more than constants.k nodes (@see SubsecondRoutingTable)
+    are divided further by the leading bits of the target, into parts
+    meant to cover about constants.k nodes each.
+
+    The answers are thus approximate per part. Where a kbucket (or a
+    part of one) holds fewer than constants.k nodes, or the nodes are
+    spread unevenly over its parts, the answer for a target may differ
+    from routing_table.get_closest_nodes(target). The nodes handed out
+    are always in the routing table, and close to the part's targets.
+
+    Every entry is a (nodes, packet_prefix) pair, where the packet
+    prefix is the encoded beginning of a response carrying the nodes
+    @see mdht.coding.krpc_coder.encode_nodes_prefix
+
+    The cache observes the routing table. A node that is added or
+    removed only drops the entries it could belong to: those of its
+    own part of a kbucket, and those that had to be filled with nodes
+    from parts at least as far away as its own. The whole cache is only
+    dropped when a kbucket is split.
+
+    """
+    implements(IRoutingTableObserver)
+
+    def __init__(self, routing_table):
+        self.routing_table = routing_table
+        self._entries = {}
+        # key => the largest distance (in key bits) from the key's part
+        # to a node of its entry, None if the entry is short of nodes
+        self._bounds = {}
+        # Number of low bits of a target that do not affect its key,
+        # indexed by the depth of the target's kbucket (None until
+        # the kbucket geometry is computed)
+        self._shifts = None
+        routing_table.register_observer(self)
+
+    def get(self, target_id):
+        """
+        Return the closest nodes to target_id and their packet prefix
+
+        @returns a tuple (nodes, packet_prefix)
+
+        """
+        if self._shifts is None:
+            self._reset()
+
+        # The tree only splits kbuckets covering our own node id, so
+        # a target's kbucket lies one level below the prefix it shares
+        # with our node id (or at the deepest level of the tree)
+        distance = target_id ^ self.routing_table.node_id
+        depth = min(constants.id_size - distance.bit_length() + 1,
+                    len(self._shifts) - 1)
+        shift = self._shifts[depth]
+        key = (depth, target_id >> shift)
+
+        entry = self._entries.get(key)
+        if entry is None:
+            nodes = self.routing_table.get_closest_nodes(target_id)
+            prefix = krpc_coder.encode_nodes_prefix(
+                        self.routing_table.node_id, nodes)
+            entry = self._entries[key] = (nodes, prefix)
+            if len(nodes) < constants.k:
+                self._bounds[key] = None
+            else:
+                self._bounds[key] = max((node.node_id >> shift) ^ key[1]
+                                        for node in nodes)
+        return entry
+
+    def node_added(self, node):
+        self._invalidate(node)
+
+    def node_removed(self, node):
+        self._invalidate(node)
+
+    def bucket_split(self, kbucket, lbucket, rbucket):
+        # The kbucket geometry changed
+        self._entries.clear()
+        self._bounds.clear()
+        self._shifts = None
+
+    def _invalidate(self, node):
+        """
+        Drop the entries that a change to `node' could affect
+
+        Key bits are the leading bits of a distance, so a node further
+        away (in key bits) from a part than every node of its entry is
+        further from any target in the part than those nodes are
+
+        """
+        if not self._entries:
+            return
+        shifts = self._shifts
+        node_id = node.node_id
+        stale = [key for key, bound in self._bounds.iteritems()
+                 if bound is None or
+                    (node_id >> shifts[key[0]]) ^ key[1] <= bound]
+        for key in stale:
+            del self._entries[key]
+            del self._bounds[key]
+
+    def _reset(self):
+        """Forget all entries and recompute the kbucket geometry"""
+        self._entries.clear()
+        self._bounds.clear()
+        max_sizes = defaultdict(int)
+        for kbucket in self.routing_table.get_kbuckets():
+            width = kbucket.range_max - kbucket.range_min
+            depth = constants.id_size - (width.bit_length() - 1)
+            max_sizes[depth] = max(max_sizes[depth], kbucket.maxsize)
+        self._shifts = []
+        for depth in range(max(max_sizes) + 1):
+            # Divide large kbuckets into parts of about constants.k nodes
+            parts = max(1, max_sizes[depth] / constants.k)
+            extra_bits = parts.bit_length() - 1
+            self._shifts.append(
+                max(0, constants.id_size - depth - extra_bits))
+
+def _reply_key(query, address):
+    """
+    The _ReplyCache key of a query
+
+    Some clients reuse (or wrap) short transaction ids, so everything
+    the reply depends on is part of the key, not just the id
+
+    """
+    return (address, query._transaction_id, query.rpctype, query._from,
+            query.target_id, query.token, query.port)
+
+class _ReplyCache(object):
+    """
+    Remember the encoded replies sent to recent queries
+
+    Nodes send a query again (with the same transaction id) when our
+    reply is slow or lost. Replies are cached under the address and
+    the contents of the query (@see _reply_key) for `timeout' seconds,
+    so that such a retransmission is answered without computing the
+    reply again.
+    At most `max_entries' replies are kept (the least recently used
+    are dropped first)
+
+    """
+    def __init__(self, timeout, max_entries, _reactor):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._reactor = _reactor
+        # key => (expiry time, packet), least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """@returns the cached packet for key, or None"""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= self._reactor.seconds():
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, packet):
+        if self.max_entries <= 0:
+            return
+        now = self._reactor.seconds()
+        self._entries.pop(key, None)
+        # Drop expired (and excess) entries from the old end
+        while self._entries:
+            oldest_key = next(iter(self._entries))
+            if (len(self._entries) < self.max_entries and
+                    self._entries[oldest_key][0] > now):
+                break
+            del self._entries[oldest_key]
+        self._entries[key] = (now + self.timeout, packet)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        return {"entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses}
+
 class _TokenGenerator(object):
     """
     Generate unique tokens in response to get_peers requests
@@ -142,6 +394,23 @@ class _TokenGenerator(object):
         self.last_secret_time = time.time()
         return self._get_hash(query, address, self.secrets[0])
 
+    def current_secrets(self):
+        """
+        The secrets tokens are generated with (the first one)
+        and verified against (all of them)
+
+        This lets tokens be generated and verified elsewhere
+        (@see token_hash). A new secret is made if it is due
+
+        """
+        self._prune_secrets()
+        time_since_last_secret = time.time() - self.last_secret_time
+        if (time_since_last_secret >= constants._secret_timeout or
+                len(self.secrets) == 0):
+            self.secrets.appendleft(self._new_secret())
+            self.last_secret_time = time.time()
+        return list(self.secrets)
+
     def verify(self, query, address, token):
         """
         Verify that the token is one that we could have generated
@@ -161,20 +430,7 @@ class _TokenGenerator(object):
         """
         Create the hash code for the given query/address/secret combination
         """
-        node_id = query._from
-        infohash = query.target_id
-        hash = self.hash_constructor()
-        # The hash code relies on the querying node's ID,
-        # the target infohash of the query, the address of
-        # the querier, and a secret that changes every
-        # constants._secret_timeout seconds
-        hash.update(basic_coder.encode_network_id(node_id))
-        hash.update(basic_coder.encode_network_id(infohash))
-        hash.update(basic_coder.encode_address(address))
-        hash.update(secret)
-        # Return the hash as a number rather than a string
-        numeric_hash_value = basic_coder.btol(hash.digest())
-        return numeric_hash_value
+        return token_hash(query, address, secret, self.hash_constructor)
 
     def _new_secret(self):
         """Generate a random number of size atleast that of the digest"""
@@ -191,3 +447,25 @@ class _TokenGenerator(object):
         while (num_stale_secrets > 0) and (len(self.secrets) > 0):
             num_stale_secrets -= 1
             self.secrets.pop()
+
+def token_hash(query, address, secret, hash_constructor=hashlib.sha512):
+    """
+    Create the token for the given query/address/secret combination
+
+    @see _TokenGenerator
+
+    """
+    node_id = query._from
+    infohash = query.target_id
+    hash = hash_constructor()
+    # The hash code relies on the querying node's ID,
+    # the target infohash of the query, the address of
+    # the querier, and a secret that changes every
+    # constants._secret_timeout seconds
+    hash.update(basic_coder.encode_network_id(node_id))
+    hash.update(basic_coder.encode_network_id(infohash))
+    hash.update(basic_coder.encode_address(address))
+    hash.update(secret)
+    # Return the hash as a number rather than a string
+    numeric_hash_value = basic_coder.btol(hash.digest())
+    return numeric_hash_value
@@ -1,5 +1,7 @@
+import time
 import random
-from collections import defaultdict
+from functools import partial
+from collections import defaultdict, deque
 
 from zope.interface import implements, Interface
 from twisted.python import log
@@ -13,40 +15,174 @@ from mdht.coding.krpc_coder import InvalidKRPCError
 from mdht.kademlia import routing_table
 from mdht.krpc_types import Query, Response, Error
 from mdht.transaction import Transaction
-from mdht.protocols.errors import TimeoutError, KRPCError 
+from mdht.timer_wheel import TimerWheel
+from mdht.rtt_estimator import RTTEstimator
+from mdht.send_queue import SendQueue, RESPONSE, QUERY
+from mdht.source_filter import SourceFilter
+from mdht.overload import OverloadController
+from mdht.latency_histogram import LatencyHistogram
+from mdht.protocols.errors import TimeoutError, KRPCError, QueryLimitError, \
+                                  SendDroppedError
+
+_transaction_id_mask = 2**constants.transaction_id_size - 1
+
+# Queries without side effects, for which a caller can share
+# the reply to an identical query that is already outstanding
+_coalesced_rpctypes = frozenset(["ping", "find_node", "get_peers"])
 
 class KRPC_Sender(protocol.DatagramProtocol):
     def __init__(self, routing_table_class, node_id, _reactor=None):
         # If the user doesn't specify a reactor, we will use
         # one from twisted.internet
         if _reactor is None:
-            self._reactor = reactor
+            _reactor = reactor
+        self._reactor = _reactor
         self.node_id = long(node_id)
         self._transactions = dict()
+        # (address, rpctype, target_id) => Transaction, for queries
+        # that identical queries can wait on
+        self._coalescable = dict()
+        self._coalesced_queries = 0
+        # The number of outstanding transactions per address and per
+        # /24 subnet, and the queries waiting for them to drop below
+        # the limits (subnet => deque of (query, address, timeout,
+        # retransmits, callback))
+        self._queries_by_address = defaultdict(int)
+        self._queries_by_subnet = defaultdict(int)
+        self._waiting_queries = dict()
+        self._delayed_queries = 0
+        self._rejected_queries = 0
+        self._dropped_queries = 0
+        self._retransmitted_queries = 0
+        # Transaction ids are a counter masked to transaction_id_size
+        # bits, scrambled with a salt chosen for every protocol instance
+        self._transaction_counter = 0
+        self._transaction_id_salt = random.getrandbits(
+                                        constants.transaction_id_size)
+        # Set when this protocol is one of several worker processes
+        # serving one node (@see mdht.workers.WorkerChannel)
+        self.worker_channel = None
+        # Set to have batches of datagrams decoded by worker
+        # processes (@see mdht.offload.DecodePool)
+        self.decode_pool = None
+        # Transaction timeouts are kept in a timer wheel rather
+        # than in one reactor DelayedCall per query
+        self._timer_wheel = TimerWheel(constants._timer_granularity,
+                                       constants._timer_slots, self._reactor)
+        self._rtt_estimator = RTTEstimator()
+        # (rpctype, outcome) => LatencyHistogram of our queries
+        self._latencies = dict()
+        # Outgoing packets are shaped to the configured bandwidth limits
+        self._send_queue = SendQueue(self._write_packet, self._reactor,
+                                     constants.global_bandwidth_rate,
+                                     constants.host_bandwidth_rate)
+        # Incoming datagrams are rate limited by source before decoding
+        self.source_filter = SourceFilter(self._reactor,
+                                          constants.source_packet_rate,
+                                          constants.subnet_packet_rate,
+                                          constants.source_blocklist)
+        # Incoming queries are shed while the reactor lags behind
+        self.overload = OverloadController(self._reactor,
+                                           constants.overload_lag_threshold,
+                                           constants.overload_shed_order)
         self.routing_table = routing_table_class(self.node_id)
         # TODO rework the routing table classes: are multiple needed?, maybe
         # one interface, one implementation, to leave room for the potential
         # of making a direct-to-database implementation later?
 
+    def startProtocol(self):
+        """Called by twisted when the protocol starts listening"""
+        self.overload.start()
+
+    def stopProtocol(self):
+        """Called by twisted when the protocol stops listening"""
+        self.overload.stop()
+
     def datagramReceived(self, data, address):
         """
         This method is called by twisted when a datagram is received
 
         This implementation tries to decode the datagram. If it succeeds,
         it is passed onto self.krpcReceived for further processing, otherwise
-        the encoding exception is captured and logged
+        the encoding exception is captured and logged. Datagrams from
+        blocked or flooding sources are dropped without being decoded
+        (addresses we have queries outstanding to are not rate limited)
 
         @see krpcReceived
+        @see mdht.source_filter
 
         """
+        if not self.source_filter.accept(address,
+                                         address in self._queries_by_address):
+            return
         try:
             krpc = krpc_coder.decode(data)
         except InvalidKRPCError:
             log.msg("{0}:{1} sent a malformed packet"
                 .format(address[0], address[1]))
             return
+        self._decoded(krpc, data, address)
+
+    def datagramsReceived(self, datagrams):
+        """
+        Process a batch of (data, address) datagrams
+
+        This method is called by ports that read many datagrams at
+        once; every datagram is handled as by datagramReceived. If a
+        decode_pool is set, the datagrams accepted by the source filter
+        are decoded by its worker processes instead
+
+        @see mdht.recvmmsg
+        @see mdht.offload
+
+        """
+        if self.decode_pool is not None:
+            accept = self.source_filter.accept
+            expected = self._queries_by_address
+            datagrams = [(data, address) for data, address in datagrams
+                         if accept(address, address in expected)]
+            if datagrams:
+                self.decode_pool.submit(datagrams, self._batch_decoded,
+                                        self._token_secrets())
+            return
+        datagramReceived = self.datagramReceived
+        for data, address in datagrams:
+            try:
+                datagramReceived(data, address)
+            except Exception:
+                log.err()
+
+    def _batch_decoded(self, datagrams, krpcs):
+        """Process datagrams decoded by the decode_pool"""
+        for (data, address), krpc in zip(datagrams, krpcs):
+            if krpc is None:
+                log.msg("{0}:{1} sent a malformed packet"
+                    .format(address[0], address[1]))
+                continue
+            try:
+                self._decoded(krpc, data, address)
+            except Exception:
+                log.err()
+
+    def _decoded(self, krpc, data, address):
+        # Replies to queries of other workers are handed to them
+        if (self.worker_channel is not None and
+                not isinstance(krpc, Query) and
+                krpc._transaction_id not in self._transactions and
+                self.worker_channel.forward(data, krpc._transaction_id,
+                                            address)):
+            return
         self.krpcReceived(krpc, address)
 
+    def _token_secrets(self):
+        """
+        The secrets the decode_pool computes tokens with (or None)
+
+        @see mdht.protocols.krpc_responder._TokenGenerator.current_secrets
+
+        """
+        return None
+
     def krpcReceived(self, krpc, address):
         if isinstance(krpc, Query):
             self.queryReceived(krpc, address)
@@ -63,40 +199,165 @@ class KRPC_Sender(protocol.DatagramProtocol):
                         contact.address_str(address), str(krpc)))
 
     def queryReceived(self, query, address):
+        """
+        Dispatch the query to the <rpctype>_Received method
+
+        Queries are dropped while their rpctype is being shed
+        because of overload (@see mdht.overload)
+
+        """
+        if not self.overload.admit(query.rpctype):
+            return
         method_name = "%s_Received" % query.rpctype
         dispatcher = getattr(self, method_name, None)
         if dispatcher is not None:
             dispatcher(query, address)
 
     def responseReceived(self, response, transaction, address):
-        transaction.deferred.callback(response)
+        self._complete(transaction, response, None)
 
     def errorReceived(self, error, transaction, address):
-        transaction.deferred.errback(KRPCError(error))
+        self._complete(transaction, None, KRPCError(error))
 
     def sendKRPC(self, krpc, address):
+        """
+        Encode the krpc and send it to address
+
+        The packet may be held back (or dropped) to stay within the
+        bandwidth limits; responses and errors are sent before queries
+
+        @see mdht.send_queue
+        @returns boolean indicating whether the packet was accepted
+
+        """
         encoded_packet = krpc_coder.encode(krpc)
-        self.transport.write(encoded_packet, address)
+        if isinstance(krpc, Query):
+            priority = QUERY
+        else:
+            priority = RESPONSE
+        return self.sendPacket(encoded_packet, address, priority)
+
+    def sendPacket(self, encoded_packet, address, priority=RESPONSE):
+        """
+        Send an already encoded krpc to address
+
+        @param priority: mdht.send_queue.RESPONSE for responses and
+            errors, mdht.send_queue.QUERY for queries
+        @returns boolean indicating whether the packet was accepted
+
+        @see sendKRPC
+
+        """
+        return self._send_queue.send(encoded_packet, address, priority)
+
+    def sendQuery(self, query, address, timeout=None, retransmits=None):
+        """
+        Send the query to address and wait for its reply
+
+        @param timeout: seconds after which the query times out. If it
+            is None, the timeout is based on the RTTs observed for the
+            address (@see mdht.rtt_estimator)
+        @param retransmits: the number of times the query is sent again
+            (with the same transaction id) if no reply arrives, at
+            exponentially growing intervals within the timeout. If it
+            is None, constants.rpc_retransmits is used. No copy is sent
+            while the query still waits in the send queue
+        @returns a Deferred that fires with the Response, or fails with
+            a TimeoutError, KRPCError, InvalidKRPCError, QueryLimitError
+            or SendDroppedError
+
+        If an identical ping, find_node or get_peers query (same address,
+        rpctype and target_id) is already outstanding, no packet is sent:
+        the returned Deferred fires with the result of that query (and
+        the timeout of that query applies)
+
+        Queries beyond constants.max_queries_per_address outstanding
+        queries to address (or max_queries_per_subnet to its /24 subnet)
+        are held back until earlier ones complete. If too many are held
+        back already, the Deferred fails with a QueryLimitError
+
+        If the send queue drops the query's packet (@see sendKRPC), the
+        Deferred fails with a SendDroppedError right away; such a query
+        does not count against the RTT estimate or the node
+
+        @see sendQueryCallback
+
+        """
+        d = defer.Deferred()
+        self.sendQueryCallback(query, address, partial(_fire_deferred, d),
+                               timeout, retransmits)
+        return d
 
-    def sendQuery(self, query, address, timeout):
+    def sendQueryCallback(self, query, address, callback, timeout=None,
+            retransmits=None):
+        """
+        Send the query to address and call callback(response, error)
+        once it completes
+
+        This is the lightweight counterpart of sendQuery, meant for
+        library internal code that sends many queries: no Deferred or
+        Failure is created. Exactly one of response and error is None;
+        error is a TimeoutError, KRPCError, InvalidKRPCError,
+        QueryLimitError or SendDroppedError instance. The callback may
+        be called before this method returns (for encoding errors,
+        QueryLimitErrors and SendDroppedErrors)
+
+        @see sendQuery
+
+        """
+        key = None
+        if query.rpctype in _coalesced_rpctypes:
+            key = (address, query.rpctype, query.target_id)
+            transaction = self._coalescable.get(key)
+            if transaction is not None:
+                self._wait_for(transaction, query, callback)
+                return
+        subnet = contact.address_subnet(address)
+        waiting = self._waiting_queries.get(subnet)
+        if waiting is not None or not self._below_query_limits(address,
+                                                               subnet):
+            self._hold_back(query, address, timeout, retransmits, callback,
+                            subnet, waiting)
+            return
+        self._send_query(query, address, timeout, retransmits, callback, key)
+
+    def _send_query(self, query, address, timeout, retransmits, callback,
+                    key):
+        """Send a query (that is within the limits) and track its reply"""
+        if timeout is None:
+            timeout = self._rtt_estimator.timeout(address)
         query._from = self.node_id
         query._transaction_id = self._generate_transaction_id()
         try:
-            self.sendKRPC(query, address)
+            packet = krpc_coder.encode(query)
         except InvalidKRPCError as encoding_error:
-            return defer.fail(encoding_error)
+            callback(None, encoding_error)
+            return
+        accepted = self.sendPacket(packet, address, QUERY)
+        if not accepted:
+            # Our own bandwidth limit is no failure of the node
+            # (nor a sign of its RTT), so no transaction is kept
+            self._dropped_queries += 1
+            callback(None, SendDroppedError(address))
+            return
 
         t = Transaction()
         t.query = query
         t.address = address
-        t.deferred = defer.Deferred()
-        t.deferred.addCallback(self._query_success, address, t)
-        t.deferred.addErrback(self._query_failure, address, t)
-        t.timeout_call = self._reactor.callLater(
-            constants.rpctimeout, t.deferred.errback, TimeoutError())
+        t.packet = packet
+        t.callback = callback
+        t.timeout_call = self._schedule_timeout(t, timeout)
+        if retransmits is None:
+            retransmits = constants.rpc_retransmits
+        if retransmits > 0:
+            interval = float(timeout) / (2**(retransmits + 1) - 1)
+            t.retransmit_call = self._timer_wheel.callLater(
+                interval, self._retransmit, t, interval, retransmits)
         self._transactions[query._transaction_id] = t
-        t.deferred.addBoth(self._remove_transaction, t)
-        return t.deferred
+        if key is not None:
+            self._coalescable[key] = t
+        self._queries_by_address[address] += 1
+        self._queries_by_subnet[contact.address_subnet(address)] += 1
 
     def sendResponse(self, response, address):
         response._from = self.node_id
@@ -105,15 +366,236 @@ class KRPC_Sender(protocol.DatagramProtocol):
     def sendError(self, error, address):
         self.sendKRPC(error, address)
 
+    def get_stats(self):
+        """
+        Report statistics on this protocol and its components
+
+        @returns a dictionary of plain python values (suitable
+            for serialization), keyed by component
+
+        """
+        stats = {"routing_table": self.routing_table.get_stats(),
+                 "outstanding_transactions": len(self._transactions),
+                 "coalesced_queries": self._coalesced_queries,
+                 "delayed_queries": self._delayed_queries,
+                 "rejected_queries": self._rejected_queries,
+                 "dropped_queries": self._dropped_queries,
+                 "waiting_queries": sum(len(waiting) for waiting
+                                        in self._waiting_queries.itervalues()),
+                 "retransmitted_queries": self._retransmitted_queries,
+                 "rtt_tracked_addresses": len(self._rtt_estimator),
+                 "latency": self.get_latency_snapshot(),
+                 "send_queue": self._send_queue.get_stats(),
+                 "source_filter": self.source_filter.get_stats(),
+                 "overload": self.overload.get_stats()}
+        if self.worker_channel is not None:
+            stats["worker_channel"] = self.worker_channel.get_stats()
+        if self.decode_pool is not None:
+            stats["decode_pool"] = self.decode_pool.get_stats()
+        return stats
+
+    def get_latency_snapshot(self, reset=False):
+        """
+        Summarize the latencies of our queries since the last reset
+
+        Queries are told apart by rpctype and outcome: "success"
+        (a Response arrived), "error" (an Error arrived) or "timeout".
+        The latency of a retransmitted query counts from its first copy
+
+        @param reset: start recording anew after this snapshot
+        @returns {rpctype: {outcome: summary}}
+            @see mdht.latency_histogram.LatencyHistogram.snapshot
+
+        """
+        snapshot = defaultdict(dict)
+        for (rpctype, outcome), histogram in self._latencies.iteritems():
+            snapshot[rpctype][outcome] = histogram.snapshot()
+            if reset:
+                histogram.reset()
+        return dict(snapshot)
+
+    def _below_query_limits(self, address, subnet):
+        """Tell whether another query may be sent to address right now"""
+        max_per_address = constants.max_queries_per_address
+        max_per_subnet = constants.max_queries_per_subnet
+        return ((max_per_address is None or
+                 self._queries_by_address.get(address, 0) < max_per_address)
+            and (max_per_subnet is None or
+                 self._queries_by_subnet.get(subnet, 0) < max_per_subnet))
+
+    def _hold_back(self, query, address, timeout, retransmits, callback,
+                   subnet, waiting):
+        """
+        Queue a query until its destination is below the query limits
+
+        If too many queries are queued already, the callback is
+        given a QueryLimitError right away
+
+        """
+        if waiting is None:
+            waiting = self._waiting_queries[subnet] = deque()
+        elif len(waiting) >= constants.max_waiting_queries_per_subnet:
+            self._rejected_queries += 1
+            callback(None, QueryLimitError(address))
+            return
+        waiting.append((query, address, timeout, retransmits, callback))
+        self._delayed_queries += 1
+
+    def _send_waiting_queries(self, subnet):
+        """Send the queries of subnet that fit within the limits again"""
+        waiting = self._waiting_queries.get(subnet)
+        if waiting is None:
+            return
+        max_per_subnet = constants.max_queries_per_subnet
+        held_back = deque()
+        while waiting:
+            if (max_per_subnet is not None and
+                    self._queries_by_subnet.get(subnet, 0) >= max_per_subnet):
+                break
+            entry = waiting.popleft()
+            query, address, timeout, retransmits, callback = entry
+            if not self._below_query_limits(address, subnet):
+                held_back.append(entry)
+                continue
+            key = None
+            if query.rpctype in _coalesced_rpctypes:
+                key = (address, query.rpctype, query.target_id)
+                transaction = self._coalescable.get(key)
+                if transaction is not None:
+                    self._wait_for(transaction, query, callback)
+                    continue
+            self._send_query(query, address, timeout, retransmits, callback,
+                             key)
+        # Queries to busy addresses keep their place in line
+        held_back.extend(waiting)
+        if held_back:
+            self._waiting_queries[subnet] = held_back
+        else:
+            del self._waiting_queries[subnet]
+
+    def _retransmit(self, transaction, interval, retransmits):
+        """
+        Send an unanswered query again, and schedule the next attempt
+
+        The attempt is skipped while the query's packet still waits in
+        the send queue, and retransmission stops once the send queue
+        refuses the packet
+
+        """
+        transaction.retransmit_call = None
+        packet = transaction.packet
+        address = transaction.address
+        if not self._send_queue.is_queued(packet, address):
+            if not self.sendPacket(packet, address, QUERY):
+                return
+            transaction.attempts += 1
+            self._retransmitted_queries += 1
+        if retransmits > 1:
+            interval *= 2
+            transaction.retransmit_call = self._timer_wheel.callLater(
+                interval, self._retransmit, transaction, interval,
+                retransmits - 1)
+
+    def _wait_for(self, transaction, query, callback):
+        """
+        Share the result of an outstanding transaction with another query
+
+        The callback is called with the result of transaction
+
+        """
+        query._from = self.node_id
+        query._transaction_id = transaction.query._transaction_id
+        if transaction.waiters is None:
+            transaction.waiters = [callback]
+        else:
+            transaction.waiters.append(callback)
+        self._coalesced_queries += 1
+
+    def _write_packet(self, packet, address):
+        self.transport.write(packet, address)
+
+    def _schedule_timeout(self, transaction, timeout):
+        """
+        Arrange for the transaction to time out after `timeout' seconds
+
+        @returns the timer (providing active() and cancel())
+
+        """
+        return self._timer_wheel.callLater(timeout, self._timed_out,
+                                           transaction)
+
+    def _timed_out(self, transaction):
+        self._complete(transaction, None, TimeoutError())
+
+    def _complete(self, transaction, response, error):
+        """
+        Finish an outstanding transaction with its response or error
+
+        The statistics of the node behind it are updated before the
+        callbacks of the query (and of queries coalesced with it) are
+        called. Queries held back by the query limits are then given
+        a chance to be sent
+
+        """
+        if not self._remove_transaction(transaction):
+            return
+        address = transaction.address
+        try:
+            if error is None:
+                outcome = "success"
+                self._query_success(response, address, transaction)
+            else:
+                if isinstance(error, TimeoutError):
+                    outcome = "timeout"
+                else:
+                    outcome = "error"
+                self._query_failure(error, address, transaction)
+            self._record_latency(transaction.query.rpctype, outcome,
+                                 time.time() - transaction.time)
+        finally:
+            # Even if the statistics (or an observer of the routing
+            # table) fail, the query has to release its place in the
+            # query limits and its caller has to hear of it
+            subnet = contact.address_subnet(address)
+            _decrement(self._queries_by_address, address)
+            _decrement(self._queries_by_subnet, subnet)
+
+            # The transaction lets go of its callbacks before they are
+            # called, so that nothing they reference is kept alive by
+            # (or ends up in a reference cycle with) the transaction
+            callback, waiters = transaction.callback, transaction.waiters
+            transaction.callback = None
+            transaction.waiters = None
+            _call(callback, response, error)
+            if waiters is not None:
+                for callback in waiters:
+                    _call(callback, response, error)
+
+            # Make room for queries held back by the query limits
+            if subnet in self._waiting_queries:
+                self._send_waiting_queries(subnet)
+
+    def _record_latency(self, rpctype, outcome, latency):
+        histogram = self._latencies.get((rpctype, outcome))
+        if histogram is None:
+            histogram = self._latencies[(rpctype, outcome)] = \
+                LatencyHistogram(constants.rpctimeout)
+        histogram.record(latency)
+
     def _query_success(self, response, address, transaction):
         """
         Handle a valid Response to an outstanding Query
 
-        This callback records changes to the statistics for the
-        node behind the address/response (ie, it updates its RTT
-        and makes sures it is in the routing table)
+        This records changes to the statistics for the node behind
+        the address/response (ie, it updates its RTT and makes sure
+        it is in the routing table)
 
         """
+        # The reply to a retransmitted query could be a reply to
+        # any of its copies, so it says nothing about the RTT
+        if transaction.attempts == 1:
+            self._rtt_estimator.add_sample(address,
+                                           time.time() - transaction.time)
         # Pull the node corresponding to this response out
         # of our routing table, or create it if it doesn't exist
         response_node = self.routing_table.get_node(response._from)
@@ -121,64 +603,119 @@ class KRPC_Sender(protocol.DatagramProtocol):
             response_node = contact.Node(response._from, address)
         response_node.successful_query(transaction.time)
         self.routing_table.offer_node(response_node)
-        # Pass the response further down the callback chain
-        return response
 
-    def _query_failure(self, failure, address, transaction):
+    def _query_failure(self, error, address, transaction):
         """
-        Handle exceptions encountered while waiting for a Response
+        Handle errors encountered while waiting for a Response
 
-        This errback processes TimeoutErrors and KRPCErrors.
-        Specifically, it updates the statistics of the node
-        responsible for the exception (if it can be found),
-        and removes it from the routing table if necessary
+        This processes TimeoutErrors and KRPCErrors. Specifically,
+        it updates the statistics of the node responsible for the
+        error (if it can be found), and removes it from the
+        routing table if necessary
 
         """
-        # Only enter this code block if the error
-        # is either a TimeoutError or a KRPCError
-        f = failure.trap(TimeoutError, KRPCError)
+        timed_out = isinstance(error, TimeoutError)
+        if timed_out:
+            self._rtt_estimator.timed_out(address)
+        elif not isinstance(error, KRPCError):
+            return
 
         errornodes = self.routing_table.get_node_by_address(address)
         if errornodes is None:
-            return failure
+            return
 
         for errornode in errornodes:
-            if f == TimeoutError:
+            if timed_out:
                 # TODO multi-factor eviction (freshness is good,
                 # but what about (ie) number of failed queries?)
                 if not errornode.fresh():
                     self.routing_table.remove_node(errornode)
-            elif f == KRPCError:
+            else:
                 errornode.failed_query(transaction.time)
 
-        return failure
-
-    def _remove_transaction(self, result, transaction):
+    def _remove_transaction(self, transaction):
         """
-        Callback/errback that removes an outstanding transaction
+        Remove an outstanding transaction
+
+        The corresponding timeout (and retransmission) calls are also
+        cancelled if they have not yet been called, and dropped
+        from the transaction
 
-        The corresponding timeout delayed call is also cancelled
-        if it has not yet been called
+        @returns boolean indicating whether the transaction was
+            still outstanding
 
         """
         transaction_id = transaction.query._transaction_id
-        if transaction_id in self._transactions:
-                del self._transactions[transaction_id]
+        if self._transactions.get(transaction_id) is not transaction:
+            return False
+        del self._transactions[transaction_id]
+
+        query = transaction.query
+        key = (transaction.address, query.rpctype, query.target_id)
+        if self._coalescable.get(key) is transaction:
+            del self._coalescable[key]
 
         if transaction.timeout_call.active():
             transaction.timeout_call.cancel()
-
-        return result
+        transaction.timeout_call = None
+        if transaction.retransmit_call is not None:
+            transaction.retransmit_call.cancel()
+            transaction.retransmit_call = None
+        return True
 
     def _generate_transaction_id(self):
         """
         Generate a transaction_id unique to our transaction table
 
+        The id is the next value of a counter (of transaction_id_size
+        bits) XORed with our salt. Should the id from one counter wrap
+        ago still be outstanding, the full counter value is prepended,
+        making a unique id longer than transaction_id_size bits
+
+        When this protocol is one of several workers, the lowest bits
+        of the id hold the index of this worker (@see
+        mdht.workers.WorkerChannel.owner), and the counter fills the
+        remaining bits of the transaction_id_size
+
         @see mdht.constants.transaction_id_size
-        @returns a unique transaction_id of constants.transaction_id_size size
+        @returns a unique transaction_id, usually of
+            constants.transaction_id_size size
 
         """
-        while True:
-            transaction_id = random.getrandbits(constants.transaction_id_size)
-            if transaction_id not in self._transactions:
-                return transaction_id
+        self._transaction_counter += 1
+        counter = self._transaction_counter
+        if self.worker_channel is None:
+            transaction_id = ((counter & _transaction_id_mask) ^
+                              self._transaction_id_salt)
+        else:
+            index_bits = self.worker_channel.index_bits
+            index_mask = (1 << index_bits) - 1
+            transaction_id = ((((counter << index_bits) ^
+                                self._transaction_id_salt) &
+                               _transaction_id_mask & ~index_mask) |
+                              self.worker_channel.index)
+        if transaction_id in self._transactions:
+            transaction_id += counter << constants.transaction_id_size
+        return transaction_id
+
+def _call(callback, response, error):
+    """Call a query callback, keeping its exceptions to itself"""
+    try:
+        callback(response, error)
+    except Exception:
+        log.err()
+
+def _fire_deferred(d, response, error):
+    """A sendQueryCallback callback firing the Deferred of sendQuery"""
+    if error is None:
+        d.callback(response)
+    else:
+        d.errback(error)
+
+def _decrement(counts, key):
+    """Decrement a count, forgetting it when it reaches zero"""
+    count = counts[key] - 1
+    if count > 0:
+        counts[key] = count
+    else:
+        del counts[key]
@@ -1,5 +1,7 @@
+from functools import partial
+
+from mdht.krpc_types import Query
 from mdht.protocols.krpc_iterator import KRPC_Iterator
-from mdht.protocols.errors import TimeoutError, KRPCError 
 
 class LiveSearchError(Exception):
     def __init__(self):
@@ -83,21 +85,35 @@ class KRPC_Simple(KRPC_Iterator):
         pass
 
     def _get_iterate(self, nodes, live_search):
-        search_nodes = nodes or []
-        for node in search_nodes:
+        search_nodes = []
+        for node in nodes or []:
             if node in live_search.queried_nodes:
                 continue
-            d = self.get_peers(node.address, live_search.target_id)
             live_search.queried_nodes.add(node)
-            # TODO refactor outstanding_queries and is_completed()
-            # into something else. maybe add some kind of 'query()' and
-            # 'ack_query()'?
-            live_search.outstanding_queries += 1
-            d.addCallback(self._get_peers_response_handler, live_search)
-            d.addErrback(self._get_peers_error_handler, live_search)
-            d.addBoth(self._check_completion, live_search)
-
-    def _check_completion(self, _ignore, live_search):
+            search_nodes.append(node)
+        # TODO refactor outstanding_queries and is_completed()
+        # into something else. maybe add some kind of 'query()' and
+        # 'ack_query()'?
+        # Queries may fail (and call back) before sendQueryCallback
+        # returns, so the whole batch is counted up front, along with
+        # the loop itself: the search can't complete in the middle of it
+        live_search.outstanding_queries += len(search_nodes) + 1
+        for node in search_nodes:
+            # Lookups fan out to many nodes, so use the lightweight
+            # callback API rather than a Deferred per query
+            query = Query(rpctype="get_peers",
+                          target_id=live_search.target_id)
+            self.sendQueryCallback(query, node.address,
+                    partial(self._get_peers_done, live_search))
+        self._check_completion(live_search)
+
+    def _get_peers_done(self, live_search, response, error):
+        # Errors are ignored: we don't care about timeouts or errors
+        if error is None:
+            self._get_peers_response_handler(response, live_search)
+        self._check_completion(live_search)
+
+    def _check_completion(self, live_search):
         live_search.outstanding_queries -= 1
         if live_search.outstanding_queries == 0:
             live_search.mark_completed()
@@ -107,7 +123,3 @@ class KRPC_Simple(KRPC_Iterator):
             # TODO accumuluate peers (??)
             live_search.add_results(response.peers)
         self._get_iterate(response.nodes, live_search)
-
-    def _get_peers_error_handler(self, failure, live_search):
-        f = failure.trap(TimeoutError, KRPCError)
-        # do nothing: we don't care about timeouts or errors
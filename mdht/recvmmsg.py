@@ -0,0 +1,180 @@
+"""
+@author Greg Skoczek
+
+A UDP port that reads many datagrams per system call (Linux only)
+
+Twisted's udp.Port calls recvfrom (and protocol.datagramReceived) once
+for every datagram. RecvmmsgPort uses recvmmsg(2), through ctypes, to
+read up to `batch_size' datagrams at a time into preallocated buffers.
+If the protocol provides datagramsReceived(datagrams), it is handed
+every batch as a list of (data, address) pairs; otherwise
+datagramReceived is called for each datagram.
+
+@see mdht.protocols.krpc_sender.KRPC_Sender.datagramsReceived
+
+"""
+import os
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+from twisted.python import log
+from twisted.internet import reactor, udp
+
+from mdht import constants
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+# Large enough for any socket address (sizeof(struct sockaddr_storage))
+_SOCKADDR_SIZE = 128
+_MSG_DONTWAIT = 0x40
+
+_READ_IGNORE = frozenset([errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR])
+
+def _load_recvmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                         ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+def available():
+    """Tells whether RecvmmsgPort can be used on this system"""
+    return _recvmmsg is not None
+
+class RecvmmsgPort(udp.Port):
+    """
+    A udp.Port reading datagrams in batches of up to `batch_size'
+
+    @see twisted.internet.udp.Port
+
+    """
+    def __init__(self, port, proto, interface='', maxPacketSize=8192,
+            reactor=None, batch_size=constants._recvmmsg_batch_size):
+        if not available():
+            raise NotImplementedError("recvmmsg is not available")
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize,
+                          reactor)
+        self.batch_size = batch_size
+        # Preallocate the buffers that every recvmmsg call reads into
+        self._buffers = [ctypes.create_string_buffer(maxPacketSize)
+                         for _ in xrange(batch_size)]
+        self._names = [ctypes.create_string_buffer(_SOCKADDR_SIZE)
+                       for _ in xrange(batch_size)]
+        self._iovecs = (_iovec * batch_size)()
+        self._messages = (_mmsghdr * batch_size)()
+        for i in xrange(batch_size):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = maxPacketSize
+            header = self._messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(self._names[i])
+            header.msg_namelen = _SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self._iovecs[i])
+            header.msg_iovlen = 1
+        self._buffer_addresses = [ctypes.addressof(buf)
+                                  for buf in self._buffers]
+        self._name_addresses = [ctypes.addressof(name)
+                                for name in self._names]
+
+    def doRead(self):
+        """Called when the socket is ready for reading"""
+        messages = self._messages
+        batch_size = self.batch_size
+        fileno = self.socket.fileno()
+        string_at = ctypes.string_at
+        read = 0
+        while read < self.maxThroughput:
+            count = _recvmmsg(fileno, messages, batch_size,
+                              _MSG_DONTWAIT, None)
+            if count < 0:
+                error_number = ctypes.get_errno()
+                if error_number in _READ_IGNORE:
+                    return
+                if error_number == errno.ECONNREFUSED:
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                    return
+                raise socket.error(error_number, os.strerror(error_number))
+            datagrams = []
+            for i in xrange(count):
+                message = messages[i]
+                length = message.msg_len
+                header = message.msg_hdr
+                read += length
+                datagrams.append((
+                    string_at(self._buffer_addresses[i], length),
+                    _decode_address(string_at(self._name_addresses[i],
+                                              header.msg_namelen))))
+                # The kernel overwrote it with the actual address length
+                header.msg_namelen = _SOCKADDR_SIZE
+            self._deliver(datagrams)
+            if count < batch_size:
+                return
+
+    def _deliver(self, datagrams):
+        datagramsReceived = getattr(self.protocol, "datagramsReceived", None)
+        if datagramsReceived is not None:
+            try:
+                datagramsReceived(datagrams)
+            except:
+                log.err()
+            return
+        for data, address in datagrams:
+            try:
+                self.protocol.datagramReceived(data, address)
+            except:
+                log.err()
+
+def _decode_address(sockaddr):
+    """Decode a struct sockaddr_in/sockaddr_in6 into (host, port)"""
+    family = struct.unpack("=H", sockaddr[:2])[0]
+    port = struct.unpack("!H", sockaddr[2:4])[0]
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, sockaddr[8:24]), port)
+    return (socket.inet_ntoa(sockaddr[4:8]), port)
+
+def listen_udp(port, protocol, interface='', maxPacketSize=8192,
+        _reactor=None):
+    """
+    Listen for datagrams on port, through a RecvmmsgPort if possible
+
+    Falls back to the reactor's own UDP port where recvmmsg
+    is not available
+
+    @returns the listening port
+
+    """
+    if _reactor is None:
+        _reactor = reactor
+    if not available():
+        return _reactor.listenUDP(port, protocol, interface, maxPacketSize)
+    p = RecvmmsgPort(port, protocol, interface, maxPacketSize, _reactor)
+    p.startListening()
+    return p
@@ -0,0 +1,71 @@
+"""
+@author Greg Skoczek
+
+Per destination round trip time estimation, used to time out queries
+
+The estimator follows the retransmission timer computation of TCP
+(RFC 6298): a smoothed RTT and an RTT variance are kept for every
+address, and the timeout is the smoothed RTT plus four times the
+variance, clamped to [constants.rpctimeout_min, constants.rpctimeout].
+Addresses without any history get constants.rpctimeout_initial.
+
+"""
+from collections import OrderedDict
+
+from mdht import constants
+
+# Gains of the smoothed RTT and RTT variance (from RFC 6298)
+_ALPHA = 0.125
+_BETA = 0.25
+_K = 4
+
+class RTTEstimator(object):
+    """
+    Keep smoothed RTT statistics for up to `max_addresses' addresses
+
+    The least recently updated addresses are forgotten first
+
+    """
+    def __init__(self, max_addresses=constants._rtt_max_addresses):
+        self.max_addresses = max_addresses
+        # address => [smoothed rtt, rtt variance, backoff multiplier]
+        self._estimates = OrderedDict()
+
+    def add_sample(self, address, rtt):
+        """Record that a query to `address' was answered after `rtt'"""
+        estimate = self._estimates.pop(address, None)
+        if estimate is None:
+            estimate = [rtt, rtt / 2.0, 1]
+        else:
+            srtt, rttvar, _backoff = estimate
+            rttvar = (1 - _BETA) * rttvar + _BETA * abs(srtt - rtt)
+            srtt = (1 - _ALPHA) * srtt + _ALPHA * rtt
+            estimate = [srtt, rttvar, 1]
+        self._estimates[address] = estimate
+        if len(self._estimates) > self.max_addresses:
+            self._estimates.popitem(last=False)
+
+    def timed_out(self, address):
+        """
+        Record that a query to `address' timed out
+
+        The timeout of an address with history is doubled (up to
+        constants.rpctimeout) until it answers again
+
+        """
+        estimate = self._estimates.get(address)
+        if estimate is not None:
+            estimate[2] *= 2
+
+    def timeout(self, address):
+        """Return the number of seconds to wait for a reply from address"""
+        estimate = self._estimates.get(address)
+        if estimate is None:
+            return constants.rpctimeout_initial
+        srtt, rttvar, backoff = estimate
+        rto = (srtt + _K * rttvar) * backoff
+        return min(max(rto, constants.rpctimeout_min), constants.rpctimeout)
+
+    def __len__(self):
+        """The number of addresses with RTT history"""
+        return len(self._estimates)
@@ -0,0 +1,282 @@
+"""
+@author Greg Skoczek
+
+Outbound traffic shaping for the KRPC protocols
+
+Every outgoing packet has to fit into a global token bucket (limiting
+our total upload rate) and into the token bucket of its destination
+(limiting the rate at which we send to any single host). Packets that
+do not fit are queued and flushed from a reactor call once enough
+tokens have accumulated. Responses (and errors) always leave before
+our own queries, since a remote node is waiting on them. A packet
+larger than the burst of a bucket leaves as soon as the bucket is full.
+
+Packets cleared for sending are not written right away: they are
+collected while the reactor runs other code and written out together,
+in a tight loop, from a single reactor call. When the socket buffer is
+full (EAGAIN/ENOBUFS) the remaining packets stay queued and writing is
+retried after an exponentially growing pause.
+
+@see mdht.constants.global_bandwidth_rate
+@see mdht.constants.host_bandwidth_rate
+
+"""
+import errno
+import socket
+from collections import deque, defaultdict, OrderedDict
+
+from twisted.python import log
+from twisted.internet import reactor
+
+from mdht import constants
+from mdht.token_bucket import TokenBucket
+
+# Packet priorities
+RESPONSE = 0
+QUERY = 1
+
+# Socket errors meaning that the send buffer is full
+_BACKPRESSURE_ERRORS = frozenset([errno.EAGAIN, errno.EWOULDBLOCK,
+                                  errno.ENOBUFS])
+
+class SendQueue(object):
+    """
+    Shape outbound packets before passing them on to write(packet, address)
+
+    A rate of None disables the corresponding limit. At most
+    `max_queued' packets of each priority wait in the queue; further
+    packets are dropped (and counted). The "deferred" counter adds up
+    the packets held back every time the socket buffer was full
+
+    """
+    def __init__(self, write, _reactor=None,
+            global_rate=constants.global_bandwidth_rate,
+            host_rate=constants.host_bandwidth_rate,
+            max_queued=constants._send_queue_size,
+            max_hosts=constants._send_queue_max_hosts,
+            batch_size=constants._send_batch_size):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self._write = write
+        self.global_rate = global_rate
+        self.host_rate = host_rate
+        self.max_queued = max_queued
+        self.max_hosts = max_hosts
+        self.batch_size = batch_size
+        now = self._reactor.seconds()
+        self._global_bucket = None
+        if global_rate is not None:
+            self._global_bucket = TokenBucket(
+                global_rate, _burst(global_rate), now)
+        # address => TokenBucket, least recently used first
+        self._host_buckets = OrderedDict()
+        self._queues = (deque(), deque())
+        self._flush_call = None
+        # Packets within the rate limits, waiting to be written
+        self._ready = deque()
+        self._drain_call = None
+        # Current pause between attempts to write to a full socket
+        self._backoff = 0
+        self.counters = defaultdict(int)
+
+    def send(self, packet, address, priority=QUERY):
+        """
+        Send the packet with the next batch if the rate limits allow it,
+        or queue it until they do
+
+        @returns boolean indicating whether the packet was accepted
+            (False means the queue was full and the packet was dropped)
+
+        """
+        if self._queues[RESPONSE] or self._queues[QUERY] or self._backoff:
+            # Packets are already waiting; don't jump ahead of them
+            return self._enqueue(packet, address, priority)
+        if self._consume(packet, address, self._reactor.seconds()):
+            self._ready.append((packet, address))
+            self._schedule_drain(0)
+            return True
+        return self._enqueue(packet, address, priority)
+
+    def is_queued(self, packet, address):
+        """Tells whether the packet to address is waiting to be sent"""
+        if not self.queue_depth():
+            return False
+        entry = (packet, address)
+        return (entry in self._ready or entry in self._queues[QUERY] or
+                entry in self._queues[RESPONSE])
+
+    def queue_depth(self):
+        """The number of packets waiting to be sent"""
+        return (len(self._ready) + len(self._queues[RESPONSE]) +
+                len(self._queues[QUERY]))
+
+    def get_stats(self):
+        stats = dict(self.counters)
+        stats["queued_responses"] = len(self._queues[RESPONSE])
+        stats["queued_queries"] = len(self._queues[QUERY])
+        stats["queued_ready"] = len(self._ready)
+        return stats
+
+    def _enqueue(self, packet, address, priority):
+        queue = self._queues[priority]
+        if len(queue) >= self.max_queued:
+            if priority == RESPONSE:
+                self.counters["dropped_responses"] += 1
+            else:
+                self.counters["dropped_queries"] += 1
+            return False
+        queue.append((packet, address))
+        self.counters["delayed"] += 1
+        self._schedule_flush(0)
+        return True
+
+    def _consume(self, packet, address, now):
+        """Take tokens for the packet out of both of its buckets"""
+        size = len(packet)
+        host_bucket = self._host_bucket(address, now)
+        if (host_bucket is not None and
+                host_bucket.time_until(_cost(host_bucket, size), now) > 0):
+            return False
+        if (self._global_bucket is not None and
+                not self._global_bucket.consume(
+                    _cost(self._global_bucket, size), now)):
+            return False
+        if host_bucket is not None:
+            host_bucket.consume(_cost(host_bucket, size), now)
+        return True
+
+    def _host_bucket(self, address, now):
+        if self.host_rate is None:
+            return None
+        bucket = self._host_buckets.pop(address, None)
+        if bucket is None:
+            bucket = TokenBucket(self.host_rate, _burst(self.host_rate), now)
+            # A forgotten host only regains the burst it would have
+            # had after being idle
+            if len(self._host_buckets) >= self.max_hosts:
+                self._host_buckets.popitem(last=False)
+        self._host_buckets[address] = bucket
+        return bucket
+
+    def _schedule_flush(self, delay):
+        if self._flush_call is None:
+            self._flush_call = self._reactor.callLater(delay, self._flush)
+
+    def _schedule_drain(self, delay):
+        if self._drain_call is None:
+            self._drain_call = self._reactor.callLater(delay, self._drain)
+
+    def _drain(self):
+        """
+        Write out the packets that are ready, up to batch_size of them
+
+        If the socket runs out of buffer space, the unwritten packets
+        are kept (in order) and another attempt is made after a pause
+
+        """
+        self._drain_call = None
+        ready = self._ready
+        write = self._write
+        written = 0
+        while ready and written < self.batch_size:
+            packet, address = ready[0]
+            try:
+                write(packet, address)
+            except Exception as e:
+                if (isinstance(e, socket.error) and
+                        e.args[0] in _BACKPRESSURE_ERRORS):
+                    self._back_off()
+                    break
+                # The packet can't be sent at all
+                ready.popleft()
+                self.counters["write_errors"] += 1
+                log.err(e, "Failed to send a packet to %s:%d" % address)
+                continue
+            ready.popleft()
+            written += 1
+        else:
+            self._backoff = 0
+        self.counters["sent"] += written
+        if self._backoff:
+            return
+        if ready:
+            # Give the rest of the reactor a turn before continuing
+            self._schedule_drain(0)
+        elif self._queues[RESPONSE] or self._queues[QUERY]:
+            self._schedule_flush(0)
+
+    def _back_off(self):
+        if self._backoff:
+            self._backoff = min(self._backoff * 2,
+                                constants._send_backoff_max)
+        else:
+            self._backoff = constants._send_backoff_min
+        self.counters["backoffs"] += 1
+        self.counters["deferred"] += len(self._ready)
+        self._schedule_drain(self._backoff)
+
+    def _flush(self):
+        """Pass as many queued packets on as the rate limits allow"""
+        self._flush_call = None
+        if self._backoff:
+            # The socket is full; _drain will flush again once it's not
+            return
+        now = self._reactor.seconds()
+        next_delay = None
+        for queue in self._queues:
+            blocked = deque()
+            while queue:
+                packet, address = queue.popleft()
+                if self._consume(packet, address, now):
+                    self._ready.append((packet, address))
+                    continue
+                # Find out whether the host or the whole link is limited
+                size = len(packet)
+                global_wait = 0
+                if self._global_bucket is not None:
+                    global_wait = self._global_bucket.time_until(
+                                    _cost(self._global_bucket, size), now)
+                if global_wait > 0:
+                    queue.appendleft((packet, address))
+                    next_delay = _min_delay(next_delay, global_wait)
+                    break
+                host_bucket = self._host_bucket(address, now)
+                host_wait = host_bucket.time_until(
+                                _cost(host_bucket, size), now)
+                next_delay = _min_delay(next_delay, host_wait)
+                blocked.append((packet, address))
+            # Packets held back by their host keep their place in line
+            blocked.extend(queue)
+            queue.clear()
+            queue.extend(blocked)
+            if self._global_bucket is not None and queue and \
+                    self._global_bucket.tokens < _cost(self._global_bucket,
+                                                       len(queue[0][0])):
+                # The link is saturated, so lower priorities wait too
+                break
+        if self._ready:
+            self._schedule_drain(0)
+        if self._queues[RESPONSE] or self._queues[QUERY]:
+            self._schedule_flush(next_delay or 0)
+
+def _burst(rate):
+    """Allow one second worth of traffic, and at least one full datagram"""
+    return max(rate, constants._max_datagram_size)
+
+def _cost(bucket, size):
+    """
+    The tokens a packet of `size' bytes takes out of the bucket
+
+    A packet larger than the burst of the bucket could never be sent,
+    so it only waits for the bucket to be full, and empties it
+
+    """
+    return min(size, bucket.burst)
+
+def _min_delay(current, delay):
+    if current is None:
+        return delay
+    return min(current, delay)
@@ -0,0 +1,122 @@
+"""
+@author Greg Skoczek
+
+Socket buffer sizing and kernel drop monitoring for UDP ports
+
+When a socket's receive buffer is full, the kernel drops incoming
+datagrams without telling the application. On Linux, the number of
+datagrams dropped so far and the current queue sizes of every UDP
+socket are listed in /proc/net/udp (and /proc/net/udp6).
+SocketDropSampler reads them periodically for one listening port.
+
+"""
+import os
+import socket
+
+from twisted.python import log
+from twisted.internet import reactor, task
+
+from mdht import constants
+
+_PROC_FILES = ["/proc/net/udp", "/proc/net/udp6"]
+
+def set_buffer_sizes(sock, receive_buffer=None, send_buffer=None):
+    """
+    Request SO_RCVBUF/SO_SNDBUF sizes (in bytes) for sock
+
+    A size of None leaves that buffer alone. The kernel may grant
+    other sizes than requested (Linux doubles the request, and caps
+    it at net.core.rmem_max / wmem_max)
+
+    @returns the resulting (receive buffer, send buffer) sizes
+
+    """
+    if receive_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    if send_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    return (sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+def parse_proc_net_udp(text, inode):
+    """
+    Find the socket with the given inode in /proc/net/udp formatted text
+
+    @returns a dictionary with the socket's "drops", "rx_queue" and
+        "tx_queue" (bytes), or None if the socket is not listed
+
+    """
+    for line in text.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 13 or fields[9] != str(inode):
+            continue
+        tx_queue, _, rx_queue = fields[4].partition(":")
+        return {"drops": int(fields[12]),
+                "rx_queue": int(rx_queue, 16),
+                "tx_queue": int(tx_queue, 16)}
+    return None
+
+class SocketDropSampler(object):
+    """
+    Sample the kernel counters of a socket every `interval' seconds
+
+    Besides the latest sample, the number of drops over the last
+    interval and the largest receive queue seen are kept
+
+    """
+    def __init__(self, sock, interval=constants.socket_sample_interval,
+            _reactor=None):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self.sock = sock
+        self.interval = interval
+        self.inode = os.fstat(sock.fileno()).st_ino
+        self.sample = None
+        self.recent_drops = 0
+        self.max_rx_queue = 0
+        self._loop = task.LoopingCall(self.take_sample)
+        self._loop.clock = _reactor
+
+    def start(self):
+        self._loop.start(self.interval)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def take_sample(self):
+        """Read the socket's counters (they stay unset if not available)"""
+        sample = self._read_sample()
+        if sample is None:
+            return
+        if self.sample is not None:
+            self.recent_drops = sample["drops"] - self.sample["drops"]
+        self.max_rx_queue = max(self.max_rx_queue, sample["rx_queue"])
+        self.sample = sample
+
+    def get_stats(self):
+        receive_buffer, send_buffer = set_buffer_sizes(self.sock)
+        stats = {"receive_buffer": receive_buffer,
+                 "send_buffer": send_buffer,
+                 "recent_drops": self.recent_drops,
+                 "max_rx_queue": self.max_rx_queue}
+        if self.sample is not None:
+            stats.update(self.sample)
+        return stats
+
+    def _read_sample(self):
+        for path in _PROC_FILES:
+            try:
+                with open(path) as proc_file:
+                    text = proc_file.read()
+            except IOError:
+                continue
+            sample = parse_proc_net_udp(text, self.inode)
+            if sample is not None:
+                return sample
+        log.msg("socket %d not found in %s, not sampling its drops" %
+                (self.inode, " or ".join(_PROC_FILES)))
+        self.stop()
+        return None
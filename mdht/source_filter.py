@@ -0,0 +1,163 @@
+"""
+@author Greg Skoczek
+
+Inbound traffic filtering, applied to datagrams before they are decoded
+
+Datagrams from blocked addresses or networks are dropped, and so are
+datagrams exceeding the packet rate allowed for their source address
+or for the /24 subnet it is in. Only the source address of a datagram
+is looked at, so dropping excess traffic costs little more than a
+dict lookup.
+
+The rate limits do not apply to addresses we have queries outstanding
+to, so that the replies to our own queries (say, of a lookup querying
+several nodes of one subnet) are not dropped.
+
+@see mdht.constants.source_packet_rate
+@see mdht.constants.subnet_packet_rate
+@see mdht.constants.source_blocklist
+
+"""
+import socket
+import struct
+from collections import defaultdict, OrderedDict
+
+from twisted.internet import reactor
+
+from mdht import constants
+from mdht.token_bucket import TokenBucket
+
+class SourceFilter(object):
+    """
+    Decide whether datagrams from an address should be processed
+
+    Token buckets are kept for at most `max_sources' addresses and
+    subnets each (the least recently seen are forgotten first). A rate
+    of None disables the corresponding limit
+
+    """
+    def __init__(self, _reactor=None,
+            source_rate=constants.source_packet_rate,
+            subnet_rate=constants.subnet_packet_rate,
+            blocklist=constants.source_blocklist,
+            max_sources=constants._source_filter_max_sources):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self.source_rate = source_rate
+        self.subnet_rate = subnet_rate
+        self.max_sources = max_sources
+        # ip => TokenBucket and subnet => TokenBucket,
+        # least recently used first
+        self._sources = OrderedDict()
+        self._subnets = OrderedDict()
+        self._blocked_ips = set()
+        # prefix length => set of blocked networks (as integers)
+        self._blocked_networks = dict()
+        self.counters = defaultdict(int)
+        for network in blocklist:
+            self.block(network)
+
+    def block(self, network):
+        """
+        Drop all datagrams coming from `network'
+
+        @param network: an IPv4 address ("1.2.3.4") or network
+            in CIDR notation ("1.2.3.0/24")
+        @raises ValueError if the network can not be parsed
+
+        """
+        ip, prefix_length = _parse_network(network)
+        if prefix_length == 32:
+            self._blocked_ips.add(ip)
+        else:
+            networks = self._blocked_networks.setdefault(prefix_length, set())
+            networks.add(_ip_to_long(ip) >> (32 - prefix_length))
+
+    def unblock(self, network):
+        """Stop dropping datagrams from a previously blocked network"""
+        ip, prefix_length = _parse_network(network)
+        if prefix_length == 32:
+            self._blocked_ips.discard(ip)
+        else:
+            networks = self._blocked_networks.get(prefix_length, set())
+            networks.discard(_ip_to_long(ip) >> (32 - prefix_length))
+            if not networks:
+                self._blocked_networks.pop(prefix_length, None)
+
+    def accept(self, address, expected=False):
+        """
+        Tell whether a datagram from address should be processed
+
+        Every datagram that is not accepted is counted under
+        the reason for which it was dropped
+
+        @param expected: whether we are waiting for replies from
+            address, which exempts it from the rate limits (but
+            not from the blocklist)
+
+        """
+        ip = address[0]
+        if ip in self._blocked_ips or (self._blocked_networks and
+                                       self._in_blocked_network(ip)):
+            self.counters["blocked"] += 1
+            return False
+        if expected:
+            return True
+        now = self._reactor.seconds()
+        if self.source_rate is not None and not _take_token(
+                self._sources, ip, self.source_rate, self.max_sources, now):
+            self.counters["source_rate"] += 1
+            return False
+        if self.subnet_rate is not None and not _take_token(
+                self._subnets, ip.rpartition(".")[0], self.subnet_rate,
+                self.max_sources, now):
+            self.counters["subnet_rate"] += 1
+            return False
+        return True
+
+    def get_stats(self):
+        stats = dict(self.counters)
+        stats["tracked_sources"] = len(self._sources)
+        stats["tracked_subnets"] = len(self._subnets)
+        return stats
+
+    def _in_blocked_network(self, ip):
+        try:
+            ip_long = _ip_to_long(ip)
+        except socket.error:
+            return False
+        for prefix_length, networks in self._blocked_networks.iteritems():
+            if (ip_long >> (32 - prefix_length)) in networks:
+                return True
+        return False
+
+def _take_token(buckets, key, rate, max_buckets, now):
+    bucket = buckets.pop(key, None)
+    if bucket is None:
+        bucket = TokenBucket(rate, rate * constants._source_burst_seconds, now)
+        if len(buckets) >= max_buckets:
+            buckets.popitem(last=False)
+    buckets[key] = bucket
+    return bucket.consume(1, now)
+
+def _ip_to_long(ip):
+    return struct.unpack("!L", socket.inet_aton(ip))[0]
+
+def _parse_network(network):
+    ip, _, prefix_length = network.partition("/")
+    try:
+        socket.inet_aton(ip)
+    except socket.error:
+        raise ValueError("invalid IPv4 address: %s" % network)
+    if not prefix_length:
+        return ip, 32
+    try:
+        prefix_length = int(prefix_length)
+    except ValueError:
+        raise ValueError("invalid prefix length: %s" % network)
+    if not 0 < prefix_length <= 32:
+        raise ValueError("invalid prefix length: %s" % network)
+    return ip, prefix_length
@@ -2,7 +2,7 @@ from twisted.trial import unittest
 
 from mdht.coding.krpc_coder import (
         encode, decode, _chunkify, _decode_addresses,
-        InvalidKRPCError)
+        encode_nodes_prefix, InvalidKRPCError)
 from mdht.coding import basic_coder
 from mdht.krpc_types import Query, Response, Error
 from mdht.contact import Node
@@ -157,6 +157,25 @@ class ResponseCodingTestCase(unittest.TestCase):
         encoding = encode(r)
         self.assertEquals(expected_encoding, encoding)
 
+    def test_encode_withPacketPrefixMatchesFullEncoding(self):
+        r = Response()
+        r._transaction_id = 1903890316316
+        r._from = 169031860931900138093217073128059
+        r.nodes = [Node(2**158, ("127.0.0.1", 890)),
+                   Node(2**15, ("127.0.0.1", 8890))]
+        full_encoding = encode(r)
+        r._packet_prefix = encode_nodes_prefix(r._from, r.nodes)
+        self.assertEquals(full_encoding, encode(r))
+        # With a token as well (as in get_peers responses)
+        r.token = 90831
+        r._packet_prefix = None
+        full_encoding = encode(r)
+        r._packet_prefix = encode_nodes_prefix(r._from, r.nodes)
+        self.assertEquals(full_encoding, encode(r))
+
+    def test_encode_nodes_prefix_invalidNodeID(self):
+        self.assertRaises(InvalidKRPCError, encode_nodes_prefix, -1, [])
+
     def test_encode_and_decode_validPingResponse(self):
         r = Response()
         r._transaction_id = 2095
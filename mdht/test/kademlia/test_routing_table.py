@@ -1,4 +1,5 @@
 from twisted.trial import unittest
+from twisted.python.monkey import MonkeyPatcher
 
 from mdht import constants
 from mdht.contact import Node
@@ -7,6 +8,9 @@ from mdht.kademlia.kbucket import KBucket
 from mdht.kademlia.routing_table import _TreeNode, TreeRoutingTable, \
                                          SubsecondRoutingTable
 from mdht.test import testing_data
+from mdht.test.utils import Clock
+
+monkey_patcher = MonkeyPatcher()
 
 # As long the id is unique per test case, this
 # function generates non-conflicting nodes
@@ -220,6 +224,136 @@ class SubsecondRoutingTableTestCase(unittest.TestCase):
         self.assertEquals(64, rl_child.kbucket.maxsize)
         self.assertEquals(8, rr_child.kbucket.maxsize)
 
+class _RecordingObserver(object):
+    """Records every change a routing table reports"""
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.splits = []
+
+    def node_added(self, node):
+        self.added.append(node)
+
+    def node_removed(self, node):
+        self.removed.append(node)
+
+    def bucket_split(self, kbucket, lbucket, rbucket):
+        self.splits.append((kbucket, lbucket, rbucket))
+
+class RoutingTableObserverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orig_k = constants.k
+        constants.k = 8
+        self.rt = TreeRoutingTable(node_id=1)
+        self.observer = _RecordingObserver()
+        self.rt.register_observer(self.observer)
+
+    def tearDown(self):
+        constants.k = self.orig_k
+
+    def test_offer_node_notifiesAndIncreasesVersion(self):
+        node = generate_node(2**159)
+        self.rt.offer_node(node)
+        self.assertEquals([node], self.observer.added)
+        self.assertEquals(1, self.rt.version)
+        # Offering a node we already have changes nothing
+        self.rt.offer_node(node)
+        self.assertEquals([node], self.observer.added)
+        self.assertEquals(1, self.rt.version)
+
+    def test_remove_node_notifiesAndIncreasesVersion(self):
+        node = generate_node(2**159)
+        self.rt.offer_node(node)
+        self.rt.remove_node(node)
+        self.assertEquals([node], self.observer.removed)
+        self.assertEquals(2, self.rt.version)
+        # Removing an unknown node changes nothing
+        self.rt.remove_node(node)
+        self.assertEquals(2, self.rt.version)
+
+    def test_offer_node_notifiesSplit(self):
+        # The ninth node forces the root kbucket to split
+        for num in range(9):
+            self.rt.offer_node(generate_node(2**159 + num))
+        self.assertEquals(1, len(self.observer.splits))
+        kbucket, lbucket, rbucket = self.observer.splits[0]
+        self.assertEquals(self.rt.root.kbucket, kbucket)
+        self.assertEquals(self.rt.root.lchild.kbucket, lbucket)
+        self.assertEquals(self.rt.root.rchild.kbucket, rbucket)
+
+    def test_offer_node_evictionRemovesStaleNode(self):
+        stale_nodes = [generate_node(2**159 + i) for i in range(8)]
+        for node in stale_nodes:
+            self.rt.offer_node(node)
+            node.last_updated = 0
+        fresh_node = generate_node(2**159 + 100)
+        self.assertTrue(self.rt.offer_node(fresh_node))
+        self.assertEquals(1, len(self.observer.removed))
+        evicted_node = self.observer.removed[0]
+        self.assertTrue(evicted_node in stale_nodes)
+        self.assertEquals(None, self.rt.get_node(evicted_node.node_id))
+        self.assertEquals(8, len(self.rt.nodes_dict))
+
+    def test_unregister_observer_stopsNotifications(self):
+        self.rt.unregister_observer(self.observer)
+        self.rt.offer_node(generate_node(2**159))
+        self.assertEquals([], self.observer.added)
+        self.assertEquals(1, self.rt.version)
+
+class RoutingTableStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orig_k = constants.k
+        constants.k = 8
+        self.clock = Clock()
+        monkey_patcher.addPatch(routing_table, "time", self.clock)
+        monkey_patcher.patch()
+        self.rt = TreeRoutingTable(node_id=1)
+
+    def tearDown(self):
+        constants.k = self.orig_k
+        monkey_patcher.restore()
+
+    def test_get_stats_counters(self):
+        nodes = [generate_node(2**159 + i) for i in range(9)]
+        for node in nodes:
+            self.rt.offer_node(node)
+        # The ninth node above was rejected (its kbucket is full
+        # of fresh nodes). Once they are stale, a new node evicts one
+        for node in nodes:
+            node.last_updated = -constants.node_timeout
+        self.rt.offer_node(generate_node(2**159 + 100))
+        self.rt.remove_node(generate_node(2**159 + 100))
+        counters = self.rt.get_stats()["counters"]
+        self.assertEquals(9, counters["accepted"])
+        self.assertEquals(1, counters["rejected"])
+        self.assertEquals(1, counters["evicted"])
+        self.assertEquals(1, counters["removed"])
+        self.assertEquals(1, counters["splits"])
+
+    def test_get_stats_kbuckets(self):
+        for num in range(9):
+            self.rt.offer_node(generate_node(2**159 + num))
+        kbuckets = self.rt.get_stats()["kbuckets"]
+        self.assertEquals([1, 1], [b["depth"] for b in kbuckets])
+        self.assertEquals([0, 8], sorted(b["nodes"] for b in kbuckets))
+        self.assertEquals([8, 8], [b["maxsize"] for b in kbuckets])
+
+    def test_get_stats_agesAndRTTs(self):
+        nodes = [generate_node(2**159 + i) for i in range(3)]
+        for node in nodes:
+            self.rt.offer_node(node)
+        nodes[0].last_updated = 0
+        nodes[1].last_updated = -100
+        nodes[2].last_updated = -constants.node_timeout
+        nodes[0].successcount = 1
+        nodes[0].totalrtt = 0.07
+        stats = self.rt.get_stats()
+        self.assertEquals([1, 1, 0, 1, 0], stats["ages"])
+        self.assertEquals(1, stats["stale"])
+        self.assertEquals(2, stats["unknown_rtt"])
+        self.assertEquals(1, stats["rtts"][1])
+        self.assertEquals(1, sum(stats["rtts"]))
+
 class TreeNodeTestCase(unittest.TestCase):
     def test_is_leaf(self):
         k = KBucket(range_min=0, range_max=32, maxsize=20)
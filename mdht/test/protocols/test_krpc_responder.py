@@ -1,12 +1,15 @@
 from twisted.trial import unittest
 from twisted.python.monkey import MonkeyPatcher
+from twisted.internet.task import Clock as ReactorClock
 
 from mdht import constants, contact
 from mdht.coding import krpc_coder
 from mdht.krpc_types import Query, Response
 from mdht.protocols import krpc_responder
-from mdht.protocols.krpc_responder import _TokenGenerator, KRPC_Responder
-from mdht.test.utils import HollowReactor, HollowTransport, Clock
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.protocols.krpc_responder import _TokenGenerator, KRPC_Responder, \
+                                          _ClosestNodesCache, _ReplyCache
+from mdht.test.utils import HollowReactor, HollowTransport, Clock, Counter
 
 monkey_patcher = MonkeyPatcher()
 
@@ -342,6 +345,147 @@ class KRPC_ResponderTestCase(unittest.TestCase):
         # Make sure no peers were returned
         self.assertEquals(None, response.peers)
 
+    def test_get_peers_Received_usesIssuedToken(self):
+        kresponder = Patched_KRPC_Responder()
+        kresponder._token_generator.generate = Counter()
+        query = Query(rpctype="get_peers", _from=123, _transaction_id=150,
+                      target_id=800)
+        # As computed while decoding (@see mdht.offload)
+        query._issued_token = 4242
+        kresponder.krpcReceived(query, test_address)
+        self.assertEquals(4242, kresponder.sendResponse.response.token)
+        self.assertEquals(0, kresponder._token_generator.generate.count)
+
+    def test_announce_peer_Received_usesTokenValidity(self):
+        kresponder = Patched_KRPC_Responder()
+        query = Query(rpctype="announce_peer", _from=123,
+                      _transaction_id=150, target_id=800, token=5858,
+                      port=55)
+        query._token_valid = True
+        kresponder.krpcReceived(query, test_address)
+        self.assertEquals(set([(test_address[0], 55)]),
+                          kresponder._datastore[800])
+
+class KRPC_Responder_ReplyCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kresponder = Patched_KRPC_Responder()
+        self.kresponder._closest_nodes_cache.get = Counter(
+            self.kresponder._closest_nodes_cache.get)
+        self.packets = []
+        self.kresponder.sendPacket = lambda packet, address: \
+                                        self.packets.append(packet)
+
+    def _find_node(self, transaction_id, address=test_address,
+                   target_id=2**100):
+        query = Query(_transaction_id=transaction_id, _from=123,
+                      rpctype="find_node", target_id=target_id)
+        self.kresponder.datagramReceived(krpc_coder.encode(query), address)
+        return self.packets[-1]
+
+    def test_queryReceived_retransmissionAnsweredFromCache(self):
+        first_packet = self._find_node(15)
+        second_packet = self._find_node(15)
+        self.assertEquals(first_packet, second_packet)
+        self.assertEquals(15, krpc_coder.decode(second_packet)._transaction_id)
+        self.assertEquals(1, self.kresponder._closest_nodes_cache.get.count)
+        stats = self.kresponder.get_stats()["reply_cache"]
+        self.assertEquals(1, stats["hits"])
+
+    def test_queryReceived_differentQueriesNotCached(self):
+        self._find_node(15)
+        self._find_node(16)
+        self._find_node(15, ("127.0.0.2", 8888))
+        self.assertEquals(3, self.kresponder._closest_nodes_cache.get.count)
+
+    def test_queryReceived_reusedTransactionIdNotCached(self):
+        self._find_node(15)
+        # Same transaction id, another target
+        self._find_node(15, target_id=2**120)
+        self.assertEquals(2, self.kresponder._closest_nodes_cache.get.count)
+        self.assertEquals(0,
+                          self.kresponder.get_stats()["reply_cache"]["hits"])
+
+class _ReplyCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = ReactorClock()
+        self.cache = _ReplyCache(10, 3, self.clock)
+
+    def test_get_missing(self):
+        self.assertEquals(None, self.cache.get("a"))
+        self.assertEquals(1, self.cache.misses)
+
+    def test_get_expires(self):
+        self.cache.put("a", "packet")
+        self.clock.advance(9)
+        self.assertEquals("packet", self.cache.get("a"))
+        self.clock.advance(1)
+        self.assertEquals(None, self.cache.get("a"))
+        self.assertEquals(0, len(self.cache))
+
+    def test_put_dropsLeastRecentlyUsed(self):
+        for key in "abc":
+            self.cache.put(key, key)
+        self.cache.get("a")
+        self.cache.put("d", "d")
+        self.assertEquals(3, len(self.cache))
+        self.assertEquals(None, self.cache.get("b"))
+        self.assertEquals("a", self.cache.get("a"))
+
+    def test_put_dropsExpired(self):
+        self.cache.put("a", "a")
+        self.clock.advance(10)
+        self.cache.put("b", "b")
+        self.assertEquals(1, len(self.cache))
+
+class _ClosestNodesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orig_k = constants.k
+        constants.k = 8
+        self.rt = TreeRoutingTable(node_id=1)
+        # Fill the far half of the id space with one full kbucket
+        for num in range(9):
+            self.rt.offer_node(
+                contact.Node(2**159 + num, ("127.0.0.1", 1000 + num)))
+        self.cache = _ClosestNodesCache(self.rt)
+
+    def tearDown(self):
+        constants.k = self.orig_k
+
+    def test_get_matchesRoutingTable(self):
+        nodes, prefix = self.cache.get(2**159 + 5)
+        self.assertEquals(self.rt.get_closest_nodes(2**159 + 5), nodes)
+        self.assertEquals(
+            krpc_coder.encode_nodes_prefix(self.rt.node_id, nodes), prefix)
+
+    def test_get_sameKBucketIsCached(self):
+        first_entry = self.cache.get(2**159 + 5)
+        second_entry = self.cache.get(2**160 - 1)
+        self.assertTrue(first_entry is second_entry)
+        # A target in the other kbucket gets its own answer
+        third_entry = self.cache.get(2**10)
+        self.assertFalse(first_entry is third_entry)
+
+    def test_get_routingTableChangeInvalidates(self):
+        first_entry = self.cache.get(2**159 + 5)
+        [removed_node] = first_entry[0][:1]
+        self.rt.remove_node(removed_node)
+        second_entry = self.cache.get(2**159 + 5)
+        self.assertFalse(first_entry is second_entry)
+        self.assertFalse(removed_node in second_entry[0])
+        self.assertEquals(self.rt.get_closest_nodes(2**159 + 5),
+                          second_entry[0])
+
+    def test_get_changeElsewhereKeepsEntry(self):
+        far_entry = self.cache.get(2**159 + 5)
+        near_entry = self.cache.get(2**10)
+        new_node = contact.Node(2**11, ("127.0.0.1", 999))
+        self.rt.offer_node(new_node)
+        # The far kbucket holds closer nodes than the new one
+        self.assertTrue(far_entry is self.cache.get(2**159 + 5))
+        # The near entry had to be filled with farther nodes
+        self.assertFalse(near_entry is self.cache.get(2**10))
+        self.assertTrue(new_node in self.cache.get(2**10)[0])
+
 class _TokenGeneratorTestCase(unittest.TestCase):
     def setUp(self):
         self.clock = Clock()
@@ -392,3 +536,15 @@ class _TokenGeneratorTestCase(unittest.TestCase):
         self.assertTrue(self.tgen.verify(self.query, self.address, token))
         self.clock.set(constants.token_timeout)
         self.assertFalse(self.tgen.verify(self.query, self.address, token))
+
+    def test_current_secrets_matchGenerateAndVerify(self):
+        token = self.tgen.generate(self.query, self.address)
+        self.clock.set(constants._secret_timeout)
+        secrets = self.tgen.current_secrets()
+        self.assertEquals(2, len(secrets))
+        self.assertEquals(token, krpc_responder.token_hash(
+            self.query, self.address, secrets[1]))
+        new_token = krpc_responder.token_hash(self.query, self.address,
+                                              secrets[0])
+        self.assertEquals(new_token,
+                          self.tgen.generate(self.query, self.address))
@@ -1,13 +1,20 @@
+import gc
+
 from twisted.trial import unittest
 from twisted.python.monkey import MonkeyPatcher
+from twisted.internet.task import Clock as ReactorClock
 
+from mdht import constants
 from mdht.krpc_types import Query, Response, Error
 from mdht.kademlia.routing_table import TreeRoutingTable
 from mdht.protocols import krpc_sender
 from mdht.protocols.krpc_sender import KRPC_Sender
-from mdht.protocols.errors import TimeoutError
-from mdht.coding import krpc_coder
-from mdht.test.utils import Clock, HollowReactor, HollowTransport, Counter
+from mdht.protocols.errors import TimeoutError, QueryLimitError, \
+                                  SendDroppedError
+from mdht.coding import krpc_coder, basic_coder
+from mdht.send_queue import SendQueue
+from mdht.test.utils import Clock, HollowReactor, HollowTransport, Counter, \
+                            HollowDelayedCall
 
 # Write two functions that simply remove / restore
 # the reactor for krpc_sender
@@ -82,6 +89,29 @@ class KRPC_Sender_ReceivedCallChainTestCase(unittest.TestCase):
         self._patch_counter_and_input_krpc(
                 self.query, self.query.rpctype + "_Received")
 
+    def test_datagramReceived_blockedSourceDropped(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        k_messenger.source_filter.block("127.0.0.0/8")
+        counter = Counter()
+        k_messenger.krpcReceived = counter
+        k_messenger.datagramReceived(krpc_coder.encode(self.query),
+                                     ("127.0.0.1", 8888))
+        self.assertEquals(0, counter.count)
+        self.assertEquals(1,
+            k_messenger.get_stats()["source_filter"]["blocked"])
+
+    def test_datagramsReceived(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        counter = Counter()
+        k_messenger.krpcReceived = counter
+        encoded = krpc_coder.encode(self.query)
+        k_messenger.datagramsReceived([(encoded, ("127.0.0.1", 8888)),
+                                       ("malformed", ("127.0.0.1", 8888)),
+                                       (encoded, ("127.0.0.2", 8888))])
+        # The malformed datagram does not stop the rest of the batch
+        self.assertEquals(2, counter.count)
+        self.flushLoggedErrors()
+
     def test_responseReceived(self):
         # Make a query that we will "send"
         query = Query()
@@ -101,6 +131,86 @@ class KRPC_Sender_ReceivedCallChainTestCase(unittest.TestCase):
         _restore_reactor()
         self.assertEquals(1, counter.count)
 
+class KRPC_Sender_LatencyTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _ping(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQuery(query, address).addErrback(
+            lambda failure: None)
+        return query
+
+    def test_get_latency_snapshot_byRpctypeAndOutcome(self):
+        response = self._ping().build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        query = self._ping()
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[query._transaction_id])
+        query = self._ping()
+        self.k_messenger.errorReceived(Error(code=201),
+            self.k_messenger._transactions[query._transaction_id], address)
+        snapshot = self.k_messenger.get_latency_snapshot()
+        self.assertEquals(["ping"], snapshot.keys())
+        self.assertEquals(set(["success", "timeout", "error"]),
+                          set(snapshot["ping"].keys()))
+        self.assertEquals(1, snapshot["ping"]["success"]["count"])
+
+    def test_get_latency_snapshot_reset(self):
+        query = self._ping()
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[query._transaction_id])
+        snapshot = self.k_messenger.get_latency_snapshot(reset=True)
+        self.assertEquals(1, snapshot["ping"]["timeout"]["count"])
+        snapshot = self.k_messenger.get_latency_snapshot()
+        self.assertEquals(0, snapshot["ping"]["timeout"]["count"])
+
+class KRPC_Sender_OverloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = ReactorClock()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50,
+                                       _reactor=self.clock)
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.startProtocol()
+        self.addCleanup(self.k_messenger.stopProtocol)
+        self.k_messenger.ping_Received = Counter()
+        self.k_messenger.announce_peer_Received = Counter()
+        # Run the lag measurement one second late
+        self.clock.advance(constants._overload_sample_interval + 1)
+
+    def test_queryReceived_shedsByRpctype(self):
+        self.patch(self.k_messenger.overload, "shed_order",
+                   ["announce_peer", "ping"])
+        self.patch(self.k_messenger.overload, "lag_threshold", 0.6)
+        self.clock.advance(constants._overload_sample_interval + 1)
+        query = Query(_transaction_id=5, _from=9, rpctype="announce_peer")
+        self.k_messenger.queryReceived(query, address)
+        self.k_messenger.queryReceived(Query(_transaction_id=6, _from=9,
+                                             rpctype="ping"), address)
+        self.assertEquals(0, self.k_messenger.announce_peer_Received.count)
+        self.assertEquals(1, self.k_messenger.ping_Received.count)
+        stats = self.k_messenger.get_stats()["overload"]
+        self.assertEquals({"announce_peer": 1}, stats["shed_queries"])
+
+    def test_responseReceived_neverShed(self):
+        self.assertTrue(self.k_messenger.overload.shedding)
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 30)
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        result = []
+        d.addCallback(result.append)
+        self.assertEquals(query._transaction_id, result[0]._transaction_id)
+
 class KRPC_Sender_DeferredTestCase(unittest.TestCase):
     def setUp(self):
         _swap_out_reactor()
@@ -171,9 +281,475 @@ class KRPC_Sender_DeferredTestCase(unittest.TestCase):
         d = self.k_messenger.sendQuery(self.query, address, timeout)
         self.assertTrue(self.query._transaction_id in
                         self.k_messenger._transactions)
-        d.errback(TimeoutError())
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[self.query._transaction_id])
         self.assertFalse(self.query._transaction_id in
                          self.k_messenger._transactions)
 
         # Cleanup the error
         d.addErrback(lambda failure: failure.trap(TimeoutError))
+
+class KRPC_Sender_CallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.results = []
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _callback(self, response, error):
+        self.results.append((response, error))
+
+    def test_sendQueryCallback_response(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQueryCallback(query, address, self._callback)
+        self.assertEquals([], self.results)
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        [(actual_response, error)] = self.results
+        self.assertEquals(None, error)
+        self.assertEquals(response._transaction_id,
+                          actual_response._transaction_id)
+        self.assertEquals({}, self.k_messenger._transactions)
+
+    def test_sendQueryCallback_timeout(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQueryCallback(query, address, self._callback)
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[query._transaction_id])
+        [(response, error)] = self.results
+        self.assertEquals(None, response)
+        self.assertTrue(isinstance(error, TimeoutError))
+
+    def test_sendQueryCallback_encodingError(self):
+        query = Query(rpctype="pingpong")
+        self.k_messenger.sendQueryCallback(query, address, self._callback)
+        [(response, error)] = self.results
+        self.assertTrue(isinstance(error, krpc_coder.InvalidKRPCError))
+
+    def test_sendQueryCallback_exceptionInCallbackIsContained(self):
+        def failing_callback(response, error):
+            raise RuntimeError()
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQueryCallback(query, address, failing_callback)
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[query._transaction_id])
+        self.assertEquals({}, dict(self.k_messenger._queries_by_address))
+        self.assertEquals(1, len(self.flushLoggedErrors(RuntimeError)))
+
+    def test_sendQueryCallback_failingStatisticsStillComplete(self):
+        def failing_query_failure(error, address, transaction):
+            raise RuntimeError()
+        self.k_messenger._query_failure = failing_query_failure
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQueryCallback(query, address, self._callback)
+        self.assertRaises(RuntimeError, self.k_messenger._timed_out,
+            self.k_messenger._transactions[query._transaction_id])
+        [(response, error)] = self.results
+        self.assertTrue(isinstance(error, TimeoutError))
+        self.assertEquals({}, dict(self.k_messenger._queries_by_address))
+        self.assertEquals({}, dict(self.k_messenger._queries_by_subnet))
+
+    def test_repliesAreNotRateLimited(self):
+        # Too low a rate for a single datagram from a stranger
+        self.k_messenger.source_filter.source_rate = 0.1
+        queries = [Query(rpctype="find_node", target_id=target_id)
+                   for target_id in range(3)]
+        for query in queries:
+            self.k_messenger.sendQueryCallback(query, address, self._callback)
+        for query in queries:
+            response = query.build_response()
+            response._from = 9
+            self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                              address)
+        self.assertEquals(3, len(self.results))
+        self.assertEquals({}, self.k_messenger._transactions)
+
+    def test_sendQueryCallback_droppedBySendQueue(self):
+        self.k_messenger._send_queue.send = lambda *args: False
+        self.k_messenger._query_failure = Counter()
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQueryCallback(query, address, self._callback)
+        [(response, error)] = self.results
+        self.assertEquals(None, response)
+        self.assertTrue(isinstance(error, SendDroppedError))
+        self.assertEquals({}, self.k_messenger._transactions)
+        self.assertEquals({}, dict(self.k_messenger._queries_by_address))
+        self.assertEquals(0, self.k_messenger._query_failure.count)
+        self.assertEquals(1,
+                          self.k_messenger.get_stats()["dropped_queries"])
+
+class KRPC_Sender_CoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.sendPacket = Counter(self.k_messenger.sendPacket)
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _find_node(self, target_id=1500, address=address):
+        query = Query(rpctype="find_node", target_id=target_id)
+        return query, self.k_messenger.sendQuery(query, address, timeout)
+
+    def test_sendQuery_identicalQueriesShareResponse(self):
+        query, d1 = self._find_node()
+        _, d2 = self._find_node()
+        self.assertEquals(1, self.k_messenger.sendPacket.count)
+        self.assertEquals(1, len(self.k_messenger._transactions))
+        results1, results2 = [], []
+        # The first caller changing its result does not affect the second
+        d1.addCallback(lambda response: None)
+        d1.addCallback(results1.append)
+        d2.addCallback(results2.append)
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        self.assertEquals([None], results1)
+        self.assertEquals(response._transaction_id,
+                          results2[0]._transaction_id)
+        self.assertEquals(1, self.k_messenger.get_stats()["coalesced_queries"])
+        # Once answered, the same query is sent again
+        self._find_node()
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+
+    def test_sendQuery_identicalQueriesShareFailure(self):
+        query, d1 = self._find_node()
+        _, d2 = self._find_node()
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[query._transaction_id])
+        self.assertFailure(d1, TimeoutError)
+        return self.assertFailure(d2, TimeoutError)
+
+    def test_sendQuery_differentQueriesNotCoalesced(self):
+        self._find_node()
+        self._find_node(target_id=1501)
+        self._find_node(address=("127.0.0.2", 2828))
+        query = Query(rpctype="get_peers", target_id=1500)
+        self.k_messenger.sendQuery(query, address, timeout)
+        self.assertEquals(4, self.k_messenger.sendPacket.count)
+
+    def test_sendQuery_announcePeerNotCoalesced(self):
+        for _ in range(2):
+            query = Query(rpctype="announce_peer", target_id=1500,
+                          token=15, port=5125)
+            self.k_messenger.sendQuery(query, address, timeout)
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+
+class KRPC_Sender_TimeoutTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.timeouts = []
+        self.k_messenger._schedule_timeout = self._record_timeout
+        self.query = Query()
+        self.query.rpctype = "ping"
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _record_timeout(self, transaction, timeout):
+        self.timeouts.append(timeout)
+        return HollowDelayedCall()
+
+    def test_sendQuery_explicitTimeoutIsHonored(self):
+        self.k_messenger.sendQuery(self.query, address, timeout)
+        self.assertEquals([timeout], self.timeouts)
+
+    def test_sendQuery_noHistoryUsesInitialTimeout(self):
+        self.k_messenger.sendQuery(self.query, address)
+        self.assertEquals([constants.rpctimeout_initial], self.timeouts)
+
+    def test_sendQuery_timeoutFollowsObservedRTT(self):
+        self.k_messenger._rtt_estimator.add_sample(address, 0.5)
+        self.k_messenger.sendQuery(self.query, address)
+        self.assertEquals([1.5], self.timeouts)
+
+class KRPC_Sender_TransactionIdTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def test_generate_transaction_id_compactAndUnique(self):
+        ids = set()
+        for _ in xrange(2**constants.transaction_id_size):
+            transaction_id = self.k_messenger._generate_transaction_id()
+            self.assertTrue(transaction_id < 2**constants.transaction_id_size)
+            ids.add(transaction_id)
+        self.assertEquals(2**constants.transaction_id_size, len(ids))
+
+    def test_generate_transaction_id_outstandingIdNotReused(self):
+        k_messenger = self.k_messenger
+        first_id = k_messenger._generate_transaction_id()
+        k_messenger._transactions[first_id] = None
+        for _ in xrange(2**constants.transaction_id_size - 1):
+            k_messenger._generate_transaction_id()
+        # The counter wrapped, but first_id is still outstanding
+        wide_id = k_messenger._generate_transaction_id()
+        self.assertNotEquals(first_id, wide_id)
+        self.assertTrue(wide_id >= 2**constants.transaction_id_size)
+        # Ids that are free again are short
+        self.assertTrue(k_messenger._generate_transaction_id() <
+                        2**constants.transaction_id_size)
+
+    def test_sendQuery_transactionIdOnTheWire(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQuery(query, address, timeout)
+        self.assertTrue(len(basic_coder.ltob(query._transaction_id)) <= 2)
+
+class KRPC_Sender_RetransmitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = ReactorClock()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50,
+                                       _reactor=self.clock)
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.sendPacket = Counter(self.k_messenger.sendPacket)
+
+    def _reply(self, query):
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+
+    def test_sendQuery_retransmitsWithBackoff(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7, retransmits=2)
+        transaction_id = query._transaction_id
+        self.assertEquals(1, self.k_messenger.sendPacket.count)
+        self.clock.advance(1)
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+        self.clock.advance(1)
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+        self.clock.advance(1)
+        self.assertEquals(3, self.k_messenger.sendPacket.count)
+        # The same transaction id is used for every copy
+        self.assertEquals(transaction_id, query._transaction_id)
+        self.clock.advance(3.5)
+        self.assertEquals(3, self.k_messenger.sendPacket.count)
+        self.clock.advance(0.5)
+        self.assertEquals(2,
+            self.k_messenger.get_stats()["retransmitted_queries"])
+        return self.assertFailure(d, TimeoutError)
+
+    def test_sendQuery_replyStopsRetransmission(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQuery(query, address, 7, retransmits=2)
+        self.clock.advance(1)
+        self._reply(query)
+        self.clock.advance(10)
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+        # A reply to a retransmitted query gives no RTT sample
+        self.assertEquals(0, len(self.k_messenger._rtt_estimator))
+
+    def test_sendQuery_noRetransmits(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7, retransmits=0)
+        self.clock.advance(7)
+        self.assertEquals(1, self.k_messenger.sendPacket.count)
+        return self.assertFailure(d, TimeoutError)
+
+    def test_sendQuery_noRetransmitsByDefault(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7)
+        self.clock.advance(7)
+        self.assertEquals(1, self.k_messenger.sendPacket.count)
+        return self.assertFailure(d, TimeoutError)
+
+    def test_sendQuery_answeredFirstTimeGivesRTTSample(self):
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQuery(query, address, 7, retransmits=2)
+        self._reply(query)
+        self.assertEquals(1, len(self.k_messenger._rtt_estimator))
+
+    def test_retransmit_resendsSamePacket(self):
+        packets = []
+        send_packet = self.k_messenger.sendPacket
+        def record(packet, address, priority):
+            packets.append(packet)
+            return send_packet(packet, address, priority)
+        self.k_messenger.sendPacket = record
+        query = Query(rpctype="ping")
+        self.k_messenger.sendQuery(query, address, 7, retransmits=1)
+        for _ in range(3):
+            self.clock.advance(1)
+        self.assertEquals(2, len(packets))
+        self.assertTrue(packets[0] is packets[1])
+
+    def test_retransmit_skippedWhileQueued(self):
+        # The query waits in the send queue for about two seconds
+        self.k_messenger._send_queue = SendQueue(
+            self.k_messenger._write_packet, self.clock,
+            global_rate=1500, host_rate=None)
+        for _ in range(3):
+            self.k_messenger.sendPacket("x" * 1500, ("127.0.0.2", 1000))
+        query = Query(rpctype="ping")
+        # Attempts after 1, 3 and 7 seconds
+        self.k_messenger.sendQuery(query, address, 15, retransmits=3)
+        self.clock.advance(1)
+        self.assertEquals(0,
+            self.k_messenger.get_stats()["retransmitted_queries"])
+        for _ in range(6):
+            self.clock.advance(1)
+        self.assertEquals(1,
+            self.k_messenger.get_stats()["retransmitted_queries"])
+
+    def test_retransmit_stopsWhenRefused(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7, retransmits=2)
+        self.k_messenger._send_queue.send = lambda *args: False
+        self.clock.advance(7)
+        # One refused attempt, and no further one
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+        self.assertEquals(0,
+            self.k_messenger.get_stats()["retransmitted_queries"])
+        return self.assertFailure(d, TimeoutError)
+
+class KRPC_Sender_QueryLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.patch(constants, "max_queries_per_address", 2)
+        self.patch(constants, "max_queries_per_subnet", 3)
+        self.patch(constants, "max_waiting_queries_per_subnet", 2)
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.sendPacket = Counter(self.k_messenger.sendPacket)
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _find_node(self, target_id, address=address):
+        query = Query(rpctype="find_node", target_id=target_id)
+        return query, self.k_messenger.sendQuery(query, address, timeout)
+
+    def _reply(self, query, address=address):
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+
+    def test_sendQuery_addressLimitHoldsBackQueries(self):
+        q1, _ = self._find_node(1)
+        self._find_node(2)
+        q3, d3 = self._find_node(3)
+        self.assertEquals(2, self.k_messenger.sendPacket.count)
+        self.assertEquals(1, self.k_messenger.get_stats()["waiting_queries"])
+        # The held back query is sent once another one completes
+        self._reply(q1)
+        self.assertEquals(3, self.k_messenger.sendPacket.count)
+        results = []
+        d3.addCallback(results.append)
+        self._reply(q3)
+        self.assertEquals(1, len(results))
+
+    def test_sendQuery_subnetLimitHoldsBackQueries(self):
+        q1, _ = self._find_node(1)
+        self._find_node(2)
+        self._find_node(3, ("127.0.0.2", 2828))
+        self._find_node(4, ("127.0.0.3", 2828))
+        self._find_node(5, ("127.0.1.1", 2828))
+        self.assertEquals(4, self.k_messenger.sendPacket.count)
+        self._reply(q1)
+        self.assertEquals(5, self.k_messenger.sendPacket.count)
+        stats = self.k_messenger.get_stats()
+        self.assertEquals(1, stats["delayed_queries"])
+        self.assertEquals(0, stats["waiting_queries"])
+
+    def test_sendQuery_rejectedWhenTooManyWaiting(self):
+        for target_id in range(4):
+            self._find_node(target_id)
+        _, d = self._find_node(5)
+        self.assertEquals(1, self.k_messenger.get_stats()["rejected_queries"])
+        return self.assertFailure(d, QueryLimitError)
+
+    def test_sendQuery_timeoutMakesRoomForHeldBackQuery(self):
+        q1, d1 = self._find_node(1)
+        self._find_node(2)
+        _, d3 = self._find_node(3)
+        self.k_messenger._timed_out(
+            self.k_messenger._transactions[q1._transaction_id])
+        self.assertFailure(d1, TimeoutError)
+        self.assertEquals(3, self.k_messenger.sendPacket.count)
+        self.assertEquals({address: 2},
+                          dict(self.k_messenger._queries_by_address))
+
+class KRPC_Sender_ReferenceCycleTestCase(unittest.TestCase):
+    """Completed queries must be freed by reference counting alone"""
+    def setUp(self):
+        self.clock = ReactorClock()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50,
+                                       _reactor=self.clock)
+        self.k_messenger.transport = HollowTransport()
+        gc.collect()
+        self.addCleanup(gc.enable)
+        self.addCleanup(gc.set_debug, gc.get_debug())
+        gc.disable()
+        # Keep what the collector finds, so that it can be inspected
+        gc.set_debug(gc.DEBUG_SAVEALL)
+        del gc.garbage[:]
+
+    def _assertNoGarbage(self):
+        gc.collect()
+        garbage = [type(obj).__name__ for obj in gc.garbage]
+        del gc.garbage[:]
+        self.assertEquals([], garbage)
+
+    def _reply(self, query):
+        response = query.build_response()
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+
+    def test_sendQuery_response(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7)
+        self._reply(query)
+        del d
+        self._assertNoGarbage()
+
+    def test_sendQuery_errorResponse(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7)
+        d.addErrback(lambda failure: None)
+        error = Error(_transaction_id=query._transaction_id,
+                      code=201, message="Generic Error")
+        self.k_messenger.datagramReceived(krpc_coder.encode(error), address)
+        del d
+        self._assertNoGarbage()
+
+    def test_sendQuery_retransmittedTimeout(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 7, retransmits=2)
+        d.addErrback(lambda failure: None)
+        self.clock.advance(7)
+        self.clock.advance(1)
+        self.assertEquals({}, self.k_messenger._transactions)
+        del d
+        self._assertNoGarbage()
+
+    def test_sendQueryCallback_coalescedAndHeldBack(self):
+        self.patch(constants, "max_queries_per_address", 1)
+        results = []
+        def callback(response, error):
+            results.append(error)
+        q1 = Query(rpctype="find_node", target_id=1)
+        self.k_messenger.sendQueryCallback(q1, address, callback, 7)
+        self.k_messenger.sendQueryCallback(
+            Query(rpctype="find_node", target_id=1), address, callback, 7)
+        q3 = Query(rpctype="find_node", target_id=3)
+        self.k_messenger.sendQueryCallback(q3, address, callback, 7)
+        self._reply(q1)
+        self.clock.advance(8)
+        self.assertEquals(3, len(results))
+        del results[:]
+        self._assertNoGarbage()
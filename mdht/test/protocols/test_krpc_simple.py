@@ -1,8 +1,10 @@
 from twisted.trial import unittest
 from twisted.internet import defer
 
+from mdht import constants
 from mdht.coding import krpc_coder
 from mdht.contact import Node
+from mdht.krpc_types import Query
 from mdht.protocols.krpc_simple import LiveSearch, LiveSearchError, KRPC_Simple
 from mdht.test.utils import test_nodes, HollowTransport, HollowReactor
 
@@ -105,6 +107,30 @@ class KRPC_Simple_TestCase(unittest.TestCase):
         self.assertEquals(0, len(live_search.get_results()))
         self.assertTrue(live_search.is_complete)
 
+    def test_get_queryLimitDoesNotCompleteEarly(self):
+        self.patch(constants, "max_queries_per_subnet", 1)
+        self.patch(constants, "max_waiting_queries_per_subnet", 1)
+        # Fill up the query limits of 127.0.0.0/24
+        for port in (998, 999):
+            self.ksimple.sendQueryCallback(Query(rpctype="ping"),
+                    ("127.0.0.1", port), lambda response, error: None)
+        rejected_node = test_nodes[0]
+        other_node = Node(77, ("10.0.0.1", 77))
+        live_search = LiveSearch(TEST_TARGET_ID)
+        self.ksimple._get_iterate([rejected_node, other_node], live_search)
+        self.assertFalse(live_search.is_complete)
+        self.assertEquals(1, live_search.outstanding_queries)
+        [transaction] = [t for t in self.ksimple._transactions.itervalues()
+                         if t.address == other_node.address]
+        response = transaction.query.build_response(
+                        peers=[test_nodes[33].address])
+        response._from = other_node.node_id
+        self.ksimple.datagramReceived(krpc_coder.encode(response),
+                                      other_node.address)
+        self.assertEquals([test_nodes[33].address],
+                          live_search.get_results())
+        self.assertTrue(live_search.is_complete)
+
     def test_put(self):
         self.assertTrue(False)
 
@@ -0,0 +1,134 @@
+from twisted.trial import unittest
+
+from mdht import asyncio_adapter
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query
+from mdht.protocols.krpc_responder import KRPC_Responder
+from mdht.asyncio_adapter import LoopClock, KRPCDatagramProtocol
+
+class _FakeHandle(object):
+    def __init__(self, loop, when, callback, args):
+        self.loop = loop
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class _FakeLoop(object):
+    """The part of an asyncio loop used by LoopClock"""
+    def __init__(self):
+        self.now = 100.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = _FakeHandle(self, self.now + delay, callback, args)
+        self.handles.append(handle)
+        return handle
+
+    def advance(self, seconds):
+        self.now += seconds
+        due = [handle for handle in self.handles if handle.when <= self.now]
+        self.handles = [handle for handle in self.handles
+                        if handle.when > self.now]
+        for handle in sorted(due, key=lambda handle: handle.when):
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+class _FakeTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+class LoopClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = _FakeLoop()
+        self.clock = LoopClock(self.loop)
+
+    def test_seconds(self):
+        self.assertEquals(100.0, self.clock.seconds())
+
+    def test_callLater_runs(self):
+        calls = []
+        call = self.clock.callLater(2, calls.append, "x")
+        self.assertTrue(call.active())
+        self.assertEquals(102.0, call.getTime())
+        self.assertEquals([call], self.clock.getDelayedCalls())
+        self.loop.advance(2)
+        self.assertEquals(["x"], calls)
+        self.assertFalse(call.active())
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+    def test_cancel(self):
+        calls = []
+        call = self.clock.callLater(2, calls.append, "x")
+        call.cancel()
+        self.loop.advance(2)
+        self.assertEquals([], calls)
+        self.assertFalse(call.active())
+        self.assertRaises(Exception, call.cancel)
+
+    def test_callLater_errorIsLogged(self):
+        self.clock.callLater(1, lambda: 1 / 0)
+        self.loop.advance(1)
+        self.assertEquals(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+class KRPCDatagramProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = _FakeLoop()
+        self.responder = KRPC_Responder(node_id=2**50,
+                                        _reactor=LoopClock(self.loop))
+        self.transport = _FakeTransport()
+        self.proto = KRPCDatagramProtocol(self.responder)
+        self.proto.connection_made(self.transport)
+        self.addCleanup(self.proto.connection_lost, None)
+
+    def test_datagram_received_answersQuery(self):
+        query = Query(_transaction_id=15, _from=9, rpctype="ping")
+        self.proto.datagram_received(krpc_coder.encode(query),
+                                     ("127.0.0.1", 6881))
+        # Responses are written with the next batch
+        self.loop.advance(0)
+        [(data, address)] = self.transport.sent
+        self.assertEquals(("127.0.0.1", 6881), address)
+        response = krpc_coder.decode(data)
+        self.assertEquals(15, response._transaction_id)
+        self.assertEquals(2**50, response._from)
+
+    def test_pause_writingHoldsPacketsBack(self):
+        query = Query(_transaction_id=15, _from=9, rpctype="ping")
+        self.proto.pause_writing()
+        self.proto.datagram_received(krpc_coder.encode(query),
+                                     ("127.0.0.1", 6881))
+        self.loop.advance(0)
+        self.assertEquals([], self.transport.sent)
+        # The send queue keeps the response and backs off
+        self.loop.advance(1)
+        self.assertEquals([], self.transport.sent)
+        self.proto.resume_writing()
+        self.loop.advance(1)
+        [(data, address)] = self.transport.sent
+        self.assertEquals(15, krpc_coder.decode(data)._transaction_id)
+
+    def test_sendQuery_timesOutOnLoop(self):
+        d = self.responder.ping(("127.0.0.1", 6881), timeout=5)
+        results = []
+        d.addErrback(results.append)
+        self.loop.advance(0)
+        self.assertEquals(1, len(self.transport.sent))
+        for _ in range(20):
+            self.loop.advance(0.5)
+        self.assertEquals(1, len(results))
+
+    def test_listen_udp_unavailable(self):
+        if asyncio_adapter.available():
+            raise unittest.SkipTest("asyncio is available")
+        self.assertRaises(NotImplementedError, asyncio_adapter.listen_udp,
+                          0, self.responder)
@@ -0,0 +1,73 @@
+from twisted.trial import unittest
+
+from mdht.latency_histogram import LatencyHistogram
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.histogram = LatencyHistogram(30)
+
+    def test_snapshot_empty(self):
+        snapshot = self.histogram.snapshot()
+        self.assertEquals(0, snapshot["count"])
+        self.assertEquals(None, snapshot["p99"])
+        self.assertEquals(None, self.histogram.percentile(50))
+
+    def test_percentile_withinPrecision(self):
+        for millis in range(1, 1001):
+            self.histogram.record(millis / 1000.0)
+        for percent, expected in [(50, 0.5), (90, 0.9), (99, 0.99)]:
+            actual = self.histogram.percentile(percent)
+            self.assertTrue(expected <= actual <= expected * 1.04,
+                            (percent, actual))
+        self.assertEquals(1.0, self.histogram.percentile(100))
+
+    def test_snapshot_smallValuesAreExact(self):
+        self.histogram.record(0.000005)
+        self.histogram.record(0.000010)
+        snapshot = self.histogram.snapshot()
+        self.assertEquals(2, snapshot["count"])
+        self.assertEquals(0.000005, snapshot["min"])
+        self.assertEquals(0.000005, snapshot["p50"])
+        self.assertEquals(0.000010, snapshot["max"])
+        self.assertAlmostEquals(0.0000075, snapshot["mean"])
+
+    def test_record_beyondMaximum(self):
+        self.histogram.record(100)
+        self.histogram.record(-1)
+        snapshot = self.histogram.snapshot()
+        self.assertEquals(100, snapshot["max"])
+        self.assertEquals(0, snapshot["min"])
+        self.assertEquals(100, snapshot["p999"])
+
+    def test_bucketsAreContiguous(self):
+        histogram = LatencyHistogram(0.01, sub_bucket_bits=3)
+        previous_index = 0
+        for value in range(1, 10000):
+            index = histogram._index(value)
+            self.assertTrue(index in (previous_index, previous_index + 1))
+            self.assertTrue(value <= histogram._highest_value(index))
+            previous_index = index
+
+    def test_merge(self):
+        other = LatencyHistogram(30)
+        for millis in range(1, 501):
+            self.histogram.record(millis / 1000.0)
+        for millis in range(501, 1001):
+            other.record(millis / 1000.0)
+        self.histogram.merge(other)
+        snapshot = self.histogram.snapshot()
+        self.assertEquals(1000, snapshot["count"])
+        self.assertEquals(0.001, snapshot["min"])
+        self.assertEquals(1.0, snapshot["max"])
+        self.assertTrue(0.5 <= snapshot["p50"] <= 0.52)
+
+    def test_merge_differentBuckets(self):
+        self.assertRaises(ValueError, self.histogram.merge,
+                          LatencyHistogram(30, sub_bucket_bits=4))
+
+    def test_reset(self):
+        self.histogram.record(1)
+        self.histogram.reset()
+        self.assertEquals(0, self.histogram.snapshot()["count"])
+        self.histogram.record(2)
+        self.assertEquals(2, self.histogram.percentile(50))
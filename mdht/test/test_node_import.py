@@ -0,0 +1,124 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mdht import node_import
+from mdht.coding import basic_coder
+from mdht.coding.bencode import bencode
+from mdht.node_import import NodeImporter, NodeImportError
+from mdht.protocols.errors import TimeoutError
+
+addresses = [("127.0.0.%d" % num, 1000 + num) for num in range(1, 11)]
+
+class ParseTestCase(unittest.TestCase):
+    def test_parse_dht_state_concatenatedNodes(self):
+        nodes = "".join(map(basic_coder.encode_address, addresses))
+        state = bencode({"node-id": "a" * 20, "nodes": nodes})
+        self.assertEquals(addresses, node_import.parse_dht_state(state))
+
+    def test_parse_dht_state_nodeList(self):
+        nodes = map(basic_coder.encode_address, addresses)
+        # Compact node strings (with a node id) are accepted as well
+        nodes[0] = basic_coder.encode_network_id(15) + nodes[0]
+        state = bencode({"nodes": nodes})
+        self.assertEquals(addresses, node_import.parse_dht_state(state))
+
+    def test_parse_dht_state_invalid(self):
+        self.assertRaises(NodeImportError,
+                node_import.parse_dht_state, "not bencoded")
+        self.assertRaises(NodeImportError,
+                node_import.parse_dht_state, bencode({"id": "a"}))
+        self.assertRaises(NodeImportError,
+                node_import.parse_dht_state, bencode({"nodes": "a" * 7}))
+
+    def test_parse_address_list(self):
+        text = ("# bootstrap routers\n"
+                "router.utorrent.com:6881\n"
+                "\n"
+                "  127.0.0.1:2323  \n"
+                "no_port_here\n"
+                "127.0.0.1:99999\n")
+        expected = [("router.utorrent.com", 6881), ("127.0.0.1", 2323)]
+        self.assertEquals(expected, node_import.parse_address_list(text))
+
+class LoadAddressesTestCase(unittest.TestCase):
+    def _write(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_load_addresses_dhtState(self):
+        nodes = "".join(map(basic_coder.encode_address, addresses))
+        path = self._write(bencode({"nodes": nodes}))
+        self.assertEquals(addresses, node_import.load_addresses(path))
+
+    def test_load_addresses_listStartingWithD(self):
+        path = self._write("dht.transmissionbt.com:6881\n127.0.0.1:2323\n")
+        self.assertEquals([("dht.transmissionbt.com", 6881),
+                           ("127.0.0.1", 2323)],
+                          node_import.load_addresses(path))
+
+class FakeProtocol(object):
+    """Hands out a controllable Deferred for every ping"""
+    def __init__(self):
+        self.pings = {}
+
+    def sendQueryCallback(self, query, address, callback, timeout=None,
+            retransmits=None):
+        assert query.rpctype == "ping"
+        d = defer.Deferred()
+        d.addCallbacks(lambda response: callback(response, None),
+                       lambda failure: callback(None, failure.value))
+        self.pings[address] = d
+
+class FakeResolver(object):
+    def resolve(self, hostname):
+        if hostname == "unresolvable":
+            return defer.fail(Exception())
+        return defer.succeed("127.0.0.99")
+
+class NodeImporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.proto = FakeProtocol()
+        self.importer = NodeImporter(self.proto, concurrency=3,
+                _reactor=FakeResolver())
+
+    def test_import_addresses_concurrencyIsBounded(self):
+        d = self.importer.import_addresses(addresses)
+        self.assertEquals(3, len(self.proto.pings))
+        # Finishing one ping lets another one start
+        self.proto.pings[addresses[0]].callback(None)
+        self.assertEquals(4, len(self.proto.pings))
+        self.assertEquals(4, self.importer.offered)
+        d.addErrback(lambda failure: None)
+
+    def test_import_addresses_countsAndCompletes(self):
+        results = []
+        d = self.importer.import_addresses(addresses)
+        d.addCallback(results.append)
+        for num, address in enumerate(addresses):
+            ping_d = self.proto.pings[address]
+            if num % 2 == 0:
+                ping_d.callback(None)
+            else:
+                ping_d.errback(TimeoutError())
+        self.assertEquals([self.importer], results)
+        self.assertEquals(10, self.importer.offered)
+        self.assertEquals(5, self.importer.verified)
+        self.assertEquals(5, self.importer.failed)
+
+    def test_import_addresses_resolvesHostnames(self):
+        results = []
+        d = self.importer.import_addresses(
+                [("example.com", 5), ("unresolvable", 6)])
+        d.addCallback(results.append)
+        self.assertEquals([("127.0.0.99", 5)], self.proto.pings.keys())
+        self.proto.pings[("127.0.0.99", 5)].callback(None)
+        self.assertEquals([self.importer], results)
+        self.assertEquals(1, self.importer.verified)
+        self.assertEquals(1, self.importer.failed)
+
+    def test_import_addresses_emptyList(self):
+        results = []
+        self.importer.import_addresses([]).addCallback(results.append)
+        self.assertEquals([self.importer], results)
@@ -0,0 +1,174 @@
+import os
+import signal
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mdht.coding import krpc_coder
+from mdht.krpc_types import Query, Response
+from mdht.offload import DecodePool, _decode
+from mdht.protocols.krpc_responder import _TokenGenerator
+from mdht.protocols.krpc_sender import KRPC_Sender
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.test.utils import Counter, HollowReactor, HollowTransport
+
+address = ("127.0.0.1", 5555)
+
+def _get_peers():
+    return Query(_transaction_id=15, rpctype="get_peers", _from=15125,
+                 target_id=90809)
+
+class _DecodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tgen = _TokenGenerator()
+        self.secrets = self.tgen.current_secrets()
+
+    def test_decode_malformed(self):
+        self.assertEquals(None, _decode("garbage", address, None, "sha512"))
+
+    def test_decode_noSecrets(self):
+        krpc = _decode(krpc_coder.encode(_get_peers()), address, None,
+                       "sha512")
+        self.assertEquals(15125, krpc._from)
+        self.assertEquals(None, krpc._issued_token)
+
+    def test_decode_get_peersIssuesToken(self):
+        query = _get_peers()
+        krpc = _decode(krpc_coder.encode(query), address, self.secrets,
+                       "sha512")
+        self.assertEquals(self.tgen.generate(query, address),
+                          krpc._issued_token)
+
+    def test_decode_announce_peerChecksToken(self):
+        query = Query(_transaction_id=15, rpctype="announce_peer",
+                      _from=15125, target_id=90809, port=55)
+        query.token = self.tgen.generate(_get_peers(), address)
+        krpc = _decode(krpc_coder.encode(query), address, self.secrets,
+                       "sha512")
+        self.assertTrue(krpc._token_valid)
+        query.token += 1
+        krpc = _decode(krpc_coder.encode(query), address, self.secrets,
+                       "sha512")
+        self.assertFalse(krpc._token_valid)
+
+    def test_decode_responseUntouched(self):
+        response = Response(_transaction_id=15, _from=9)
+        krpc = _decode(krpc_coder.encode(response), address, self.secrets,
+                       "sha512")
+        self.assertEquals(response._transaction_id, krpc._transaction_id)
+
+class _RecordingPool(object):
+    def __init__(self):
+        self.batches = []
+
+    def submit(self, datagrams, callback, secrets=None):
+        self.batches.append((datagrams, callback, secrets))
+
+class KRPC_Sender_DecodePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50,
+                                       _reactor=HollowReactor())
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.decode_pool = _RecordingPool()
+        self.k_messenger.krpcReceived = Counter()
+
+    def test_datagramsReceived_submitsBatch(self):
+        data = krpc_coder.encode(_get_peers())
+        self.k_messenger.datagramsReceived([(data, address)] * 3)
+        self.assertEquals(0, self.k_messenger.krpcReceived.count)
+        [(datagrams, callback, secrets)] = \
+            self.k_messenger.decode_pool.batches
+        self.assertEquals(3, len(datagrams))
+        krpcs = [_decode(data, address, secrets, "sha512")] * 2 + [None]
+        callback(datagrams, krpcs)
+        self.assertEquals(2, self.k_messenger.krpcReceived.count)
+
+    def test_datagramsReceived_sourceFilter(self):
+        self.k_messenger.source_filter.accept = \
+            lambda address, expected=False: False
+        data = krpc_coder.encode(_get_peers())
+        self.k_messenger.datagramsReceived([(data, address)])
+        self.assertEquals([], self.k_messenger.decode_pool.batches)
+
+class DecodePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = DecodePool(workers=1, buffer_size=1024, max_pending=1)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def _submit(self, datagrams, secrets=None):
+        d = defer.Deferred()
+        self.pool.submit(datagrams,
+                         lambda datagrams, krpcs: d.callback(krpcs), secrets)
+        return d
+
+    def test_submit_decodesInWorker(self):
+        query = _get_peers()
+        tgen = _TokenGenerator()
+        datagrams = [(krpc_coder.encode(query), address),
+                     ("garbage", address)]
+        d = self._submit(datagrams, tgen.current_secrets())
+        def check(krpcs):
+            self.assertEquals(2, len(krpcs))
+            self.assertEquals(query.target_id, krpcs[0].target_id)
+            self.assertEquals(tgen.generate(query, address),
+                              krpcs[0]._issued_token)
+            self.assertEquals(None, krpcs[1])
+        return d.addCallback(check)
+
+    def test_submit_splitsToBufferSize(self):
+        data = krpc_coder.encode(_get_peers())
+        count = 1024 / len(data) + 1
+        results = []
+        for _ in xrange(2):
+            d = defer.Deferred()
+            results.append(d)
+        callbacks = iter(results)
+        self.pool.submit([(data, address)] * count,
+                         lambda datagrams, krpcs:
+                             callbacks.next().callback(krpcs))
+        d = defer.gatherResults(results)
+        def check(batches):
+            self.assertEquals(count, sum(len(krpcs) for krpcs in batches))
+            self.assertEquals(2, self.pool.submitted)
+        return d.addCallback(check)
+
+    def test_submit_dropsBeyondMaxPending(self):
+        data = krpc_coder.encode(_get_peers())
+        # One batch in the worker, one pending, one dropped
+        ds = [self._submit([(data, address)]) for _ in xrange(3)]
+        self.assertEquals(1, self.pool.dropped)
+        self.assertEquals(1, self.pool.get_stats()["pending_batches"])
+        return defer.gatherResults(ds[:2])
+
+    def test_workerDeathIsRecovered(self):
+        [worker] = self.pool._workers
+        os.kill(worker._process.pid, signal.SIGKILL)
+        worker._process.join()
+        data = krpc_coder.encode(_get_peers())
+        # The batch handed to the dead worker is decoded all the same
+        d = self._submit([(data, address)])
+        def check_replaced(krpcs):
+            self.assertEquals(1, len(krpcs))
+            stats = self.pool.get_stats()
+            self.assertEquals(1, stats["restarted_workers"])
+            self.assertEquals(1, stats["workers"])
+            self.assertFalse(worker in self.pool._workers)
+            # The replacement decodes the next batches
+            inline = stats["inline_batches"]
+            d = self._submit([(data, address)])
+            d.addCallback(lambda krpcs: self.assertEquals(
+                inline, self.pool.get_stats()["inline_batches"]))
+            return d
+        return d.addCallback(check_replaced)
+
+class DecodePoolInlineTestCase(unittest.TestCase):
+    def test_submit_withoutWorkersDecodesInline(self):
+        pool = DecodePool(workers=1)
+        results = []
+        data = krpc_coder.encode(_get_peers())
+        pool.submit([(data, address)],
+                    lambda datagrams, krpcs: results.append(krpcs))
+        [[krpc]] = results
+        self.assertEquals(15125, krpc._from)
+        self.assertEquals(1, pool.get_stats()["inline_batches"])
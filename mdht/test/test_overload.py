@@ -0,0 +1,69 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from mdht.overload import OverloadController
+
+order = ["announce_peer", "get_peers", "find_node", "ping"]
+
+class OverloadControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.controller = OverloadController(self.clock, 0.1, order, 1)
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.stop()
+
+    def _lag(self, lag):
+        """Let the next measurement run `lag' seconds late"""
+        self.clock.advance(1 + lag)
+
+    def _admitted(self):
+        return [rpctype for rpctype in order
+                if self.controller.admit(rpctype)]
+
+    def test_admit_noLag(self):
+        self._lag(0)
+        self._lag(0)
+        self.assertEquals(0, self.controller.lag)
+        self.assertEquals(order, self._admitted())
+        self.assertEquals({}, self.controller.counters)
+
+    def test_admit_shedsInOrder(self):
+        self._lag(0.15)
+        self.assertEquals(order[1:], self._admitted())
+        self._lag(0.25)
+        self.assertEquals(order[2:], self._admitted())
+        self._lag(1)
+        self.assertEquals([], self._admitted())
+        self.assertEquals({"announce_peer": 3, "get_peers": 2,
+                           "find_node": 1, "ping": 1},
+                          self.controller.counters)
+
+    def test_admit_recoversGradually(self):
+        self._lag(0.3)
+        self.assertEquals(order[3:], self._admitted())
+        self._lag(0)
+        self.assertAlmostEquals(0.225, self.controller.lag)
+        self.assertEquals(order[2:], self._admitted())
+        for _ in range(20):
+            self._lag(0)
+        self.assertEquals(order, self._admitted())
+        self.assertAlmostEquals(0.3, self.controller.get_stats()["max_lag"])
+
+    def test_admit_disabled(self):
+        controller = OverloadController(self.clock, None, order, 1)
+        controller.start()
+        self.clock.advance(10)
+        self.assertTrue(controller.admit("announce_peer"))
+        controller.stop()
+
+    def test_stop(self):
+        self.controller.stop()
+        self.assertEquals([], self.clock.getDelayedCalls())
+        self.controller.start()
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+
+    def test_unknownRpctypeIsAdmitted(self):
+        self._lag(1)
+        self.assertTrue(self.controller.admit("vote"))
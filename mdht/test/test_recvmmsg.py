@@ -0,0 +1,69 @@
+import socket
+
+from twisted.trial import unittest
+from twisted.internet import protocol
+
+from mdht import recvmmsg
+
+class _BatchProtocol(protocol.DatagramProtocol):
+    def __init__(self):
+        self.batches = []
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+
+class _SingleProtocol(protocol.DatagramProtocol):
+    def __init__(self):
+        self.datagrams = []
+
+    def datagramReceived(self, data, address):
+        self.datagrams.append((data, address))
+
+class RecvmmsgPortTestCase(unittest.TestCase):
+    if not recvmmsg.available():
+        skip = "recvmmsg is not available on this system"
+
+    def setUp(self):
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.bind(("127.0.0.1", 0))
+        self.addCleanup(self.sender.close)
+
+    def _listen(self, proto, batch_size=4):
+        port = recvmmsg.RecvmmsgPort(0, proto, "127.0.0.1",
+                                     batch_size=batch_size)
+        port.startListening()
+        self.addCleanup(port.stopListening)
+        return port
+
+    def _send(self, port, payloads):
+        destination = ("127.0.0.1", port.getHost().port)
+        for payload in payloads:
+            self.sender.sendto(payload, destination)
+
+    def test_doRead_deliversBatches(self):
+        proto = _BatchProtocol()
+        port = self._listen(proto)
+        payloads = ["datagram %d" % i for i in range(6)]
+        self._send(port, payloads)
+        port.doRead()
+        self.assertEquals([4, 2], [len(batch) for batch in proto.batches])
+        received = [datagram for batch in proto.batches
+                             for datagram in batch]
+        self.assertEquals(payloads, [data for data, _ in received])
+        sender_address = self.sender.getsockname()
+        for _, address in received:
+            self.assertEquals(sender_address, address)
+
+    def test_doRead_fallsBackToDatagramReceived(self):
+        proto = _SingleProtocol()
+        port = self._listen(proto)
+        self._send(port, ["a", "bb", "ccc"])
+        port.doRead()
+        self.assertEquals(["a", "bb", "ccc"],
+                          [data for data, _ in proto.datagrams])
+
+    def test_doRead_nothingToRead(self):
+        proto = _BatchProtocol()
+        port = self._listen(proto)
+        port.doRead()
+        self.assertEquals([], proto.batches)
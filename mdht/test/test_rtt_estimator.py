@@ -0,0 +1,48 @@
+from twisted.trial import unittest
+
+from mdht import constants
+from mdht.rtt_estimator import RTTEstimator
+
+address = ("127.0.0.1", 5555)
+
+class RTTEstimatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.estimator = RTTEstimator(max_addresses=2)
+
+    def test_timeout_noHistory(self):
+        self.assertEquals(constants.rpctimeout_initial,
+                          self.estimator.timeout(address))
+
+    def test_timeout_firstSample(self):
+        # srtt + 4 * (rtt / 2) == 3 * rtt
+        self.estimator.add_sample(address, 2)
+        self.assertEquals(6, self.estimator.timeout(address))
+
+    def test_timeout_converges(self):
+        for _ in range(100):
+            self.estimator.add_sample(address, 1.5)
+        self.assertAlmostEqual(1.5, self.estimator.timeout(address), 3)
+
+    def test_timeout_floorAndCeiling(self):
+        self.estimator.add_sample(address, 0.001)
+        self.assertEquals(constants.rpctimeout_min,
+                          self.estimator.timeout(address))
+        self.estimator.add_sample(("127.0.0.1", 1), 100)
+        self.assertEquals(constants.rpctimeout,
+                          self.estimator.timeout(("127.0.0.1", 1)))
+
+    def test_timed_out_backsOffUntilNextSample(self):
+        self.estimator.add_sample(address, 1)
+        self.estimator.timed_out(address)
+        self.assertEquals(6, self.estimator.timeout(address))
+        self.estimator.add_sample(address, 1)
+        self.assertTrue(self.estimator.timeout(address) < 6)
+
+    def test_add_sample_forgetsLeastRecentlyUpdated(self):
+        self.estimator.add_sample(("127.0.0.1", 1), 1)
+        self.estimator.add_sample(("127.0.0.1", 2), 1)
+        self.estimator.add_sample(("127.0.0.1", 1), 1)
+        self.estimator.add_sample(("127.0.0.1", 3), 1)
+        self.assertEquals(2, len(self.estimator))
+        self.assertEquals(constants.rpctimeout_initial,
+                          self.estimator.timeout(("127.0.0.1", 2)))
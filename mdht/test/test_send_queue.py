@@ -0,0 +1,168 @@
+import errno
+import socket
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from mdht import constants
+from mdht.send_queue import SendQueue, RESPONSE, QUERY
+from mdht.test.utils import Counter
+
+class _Writer(object):
+    """Records packets, failing with the given errnos first (if any)"""
+    def __init__(self, errors=()):
+        self.sent = []
+        self.errors = list(errors)
+
+    def __call__(self, packet, address):
+        if self.errors:
+            raise socket.error(self.errors.pop(0), "error")
+        self.sent.append((packet, address))
+
+host_a = ("127.0.0.1", 1000)
+host_b = ("127.0.0.2", 1000)
+
+class SendQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.writer = _Writer()
+
+    def _queue(self, global_rate=None, host_rate=None, max_queued=10,
+               batch_size=256):
+        return SendQueue(self.writer, self.clock, global_rate, host_rate,
+                         max_queued, batch_size=batch_size)
+
+    def test_send_unlimited(self):
+        queue = self._queue()
+        for _ in range(100):
+            self.assertTrue(queue.send("x" * 1000, host_a))
+        # Packets are written together on the next reactor iteration
+        self.assertEquals(0, len(self.writer.sent))
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(0)
+        self.assertEquals(100, len(self.writer.sent))
+        self.assertEquals(0, queue.queue_depth())
+
+    def test_drain_yieldsAfterBatch(self):
+        queue = self._queue(batch_size=3)
+        queue._drain = Counter(queue._drain)
+        for _ in range(5):
+            queue.send("x", host_a)
+        self.clock.advance(0)
+        self.assertEquals(5, len(self.writer.sent))
+        self.assertEquals(2, queue._drain.count)
+
+    def test_drain_backsOffWhenSocketFull(self):
+        self.writer.errors = [errno.EAGAIN, errno.ENOBUFS]
+        queue = self._queue()
+        queue.send("a", host_a)
+        queue.send("b", host_a)
+        self.clock.advance(0)
+        self.assertEquals([], self.writer.sent)
+        self.clock.advance(constants._send_backoff_min)
+        self.assertEquals([], self.writer.sent)
+        # Packets sent while backing off wait behind the others
+        queue.send("c", host_a)
+        self.assertEquals(1, queue.get_stats()["queued_queries"])
+        self.clock.advance(2 * constants._send_backoff_min)
+        self.assertEquals(["a", "b", "c"],
+                          [packet for packet, _ in self.writer.sent])
+        stats = queue.get_stats()
+        self.assertEquals(2, stats["backoffs"])
+        self.assertEquals(4, stats["deferred"])
+        self.assertEquals(3, stats["sent"])
+        self.assertEquals(0, queue.queue_depth())
+
+    def test_drain_dropsUnsendablePackets(self):
+        self.writer.errors = [errno.EMSGSIZE]
+        queue = self._queue()
+        queue.send("a", host_a)
+        queue.send("b", host_a)
+        self.clock.advance(0)
+        self.assertEquals(["b"], [packet for packet, _ in self.writer.sent])
+        self.assertEquals(1, queue.get_stats()["write_errors"])
+        self.flushLoggedErrors(socket.error)
+
+    def test_send_globalLimitQueuesAndFlushes(self):
+        # Burst (and rate) of 1500 bytes per second
+        queue = self._queue(global_rate=1500)
+        queue.send("x" * 1000, host_a)
+        queue.send("x" * 1000, host_b)
+        self.clock.advance(0)
+        self.assertEquals(1, len(self.writer.sent))
+        self.assertEquals(1, queue.queue_depth())
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.writer.sent))
+        self.assertEquals(0, queue.queue_depth())
+        self.assertEquals(0, len(self.clock.getDelayedCalls()))
+
+    def test_send_hostLimitDoesNotBlockOtherHosts(self):
+        queue = self._queue(host_rate=1500)
+        queue.send("a" * 1000, host_a)
+        queue.send("a" * 1000, host_a)
+        queue.send("b" * 1000, host_b)
+        self.clock.advance(0)
+        self.assertEquals([host_a, host_b],
+                          [address for _, address in self.writer.sent])
+        self.clock.advance(1)
+        self.assertEquals([host_a, host_b, host_a],
+                          [address for _, address in self.writer.sent])
+
+    def test_send_oversizedPacketDoesNotBlockQueue(self):
+        queue = self._queue(global_rate=1500)
+        queue.send("x" * 1000, host_a)
+        # Larger than the burst of the global bucket
+        queue.send("y" * 25000, host_b, RESPONSE)
+        queue.send("response", host_b, RESPONSE)
+        queue.send("query", host_a, QUERY)
+        self.clock.advance(0)
+        self.assertEquals(["x" * 1000],
+                          [packet for packet, _ in self.writer.sent])
+        for _ in range(3):
+            self.clock.advance(1)
+        self.assertEquals(["x" * 1000, "y" * 25000, "response", "query"],
+                          [packet for packet, _ in self.writer.sent])
+        self.assertEquals(0, queue.queue_depth())
+
+    def test_send_oversizedPacketToHost(self):
+        queue = self._queue(host_rate=1500)
+        queue.send("x" * 6000, host_a)
+        queue.send("a", host_a)
+        self.clock.advance(0)
+        self.assertEquals(["x" * 6000],
+                          [packet for packet, _ in self.writer.sent])
+        self.clock.advance(1)
+        self.assertEquals(["x" * 6000, "a"],
+                          [packet for packet, _ in self.writer.sent])
+        self.assertEquals(0, queue.queue_depth())
+
+    def test_is_queued(self):
+        queue = self._queue(global_rate=1500)
+        queue.send("x" * 1500, host_a)
+        queue.send("query", host_a, QUERY)
+        self.assertTrue(queue.is_queued("query", host_a))
+        self.assertFalse(queue.is_queued("query", host_b))
+        self.clock.advance(1)
+        self.assertFalse(queue.is_queued("query", host_a))
+
+    def test_flush_responsesBeforeQueries(self):
+        queue = self._queue(global_rate=1500)
+        queue.send("x" * 1500, host_a)
+        queue.send("query", host_a, QUERY)
+        queue.send("response", host_b, RESPONSE)
+        self.clock.advance(1)
+        self.assertEquals(["x" * 1500, "response", "query"],
+                          [packet for packet, _ in self.writer.sent])
+
+    def test_send_dropsWhenQueueFull(self):
+        queue = self._queue(global_rate=1500, max_queued=2)
+        queue.send("x" * 1500, host_a)
+        self.assertTrue(queue.send("q", host_a, QUERY))
+        self.assertTrue(queue.send("q", host_a, QUERY))
+        self.assertFalse(queue.send("q", host_a, QUERY))
+        self.assertTrue(queue.send("r", host_a, RESPONSE))
+        stats = queue.get_stats()
+        self.assertEquals(1, stats["dropped_queries"])
+        self.assertEquals(2, stats["queued_queries"])
+        self.assertEquals(1, stats["queued_responses"])
+        self.assertEquals(1, stats["queued_ready"])
@@ -0,0 +1,55 @@
+import os
+import socket
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from mdht.socket_monitor import set_buffer_sizes, parse_proc_net_udp, \
+                                SocketDropSampler
+
+proc_net_udp = (
+"   sl  local_address rem_address   st tx_queue rx_queue tr tm->when "
+"retrnsmt   uid  timeout inode ref pointer drops\n"
+"  123: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 "
+"00000000     0        0 1111 2 0000000000000000 0\n"
+"  456: 0100007F:1B59 00000000:0000 07 00000010:00000A00 00:00000000 "
+"00000000  1000        0 2222 2 0000000000000000 42\n")
+
+class ParseProcNetUDPTestCase(unittest.TestCase):
+    def test_parse_proc_net_udp(self):
+        self.assertEquals({"drops": 42, "rx_queue": 0xA00, "tx_queue": 0x10},
+                          parse_proc_net_udp(proc_net_udp, 2222))
+
+    def test_parse_proc_net_udp_unknownInode(self):
+        self.assertEquals(None, parse_proc_net_udp(proc_net_udp, 3333))
+
+class SocketMonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.addCleanup(self.sock.close)
+
+    def test_set_buffer_sizes(self):
+        receive_buffer, send_buffer = set_buffer_sizes(self.sock, 8192, 8192)
+        # The kernel may adjust the sizes (Linux doubles them)
+        self.assertTrue(receive_buffer >= 8192)
+        self.assertTrue(send_buffer >= 8192)
+        self.assertEquals((receive_buffer, send_buffer),
+                          set_buffer_sizes(self.sock))
+
+    def test_sampler(self):
+        if not os.path.exists("/proc/net/udp"):
+            raise unittest.SkipTest("/proc/net/udp is not available")
+        clock = Clock()
+        sampler = SocketDropSampler(self.sock, interval=5, _reactor=clock)
+        sampler.start()
+        self.addCleanup(sampler.stop)
+        receiver = ("127.0.0.1", self.sock.getsockname()[1])
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.sendto("x" * 100, receiver)
+        clock.advance(5)
+        stats = sampler.get_stats()
+        self.assertEquals(0, stats["drops"])
+        self.assertTrue(stats["rx_queue"] > 0)
+        self.assertEquals(stats["rx_queue"], stats["max_rx_queue"])
@@ -0,0 +1,79 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from mdht.source_filter import SourceFilter
+
+class SourceFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def _filter(self, source_rate=None, subnet_rate=None, blocklist=(),
+                max_sources=100):
+        return SourceFilter(self.clock, source_rate, subnet_rate,
+                            blocklist, max_sources)
+
+    def _accepted(self, source_filter, ip, count):
+        return sum(source_filter.accept((ip, 6881)) for _ in range(count))
+
+    def test_accept_unlimited(self):
+        source_filter = self._filter()
+        self.assertEquals(1000, self._accepted(source_filter, "1.2.3.4", 1000))
+        self.assertEquals({}, source_filter.counters)
+
+    def test_accept_blockedAddress(self):
+        source_filter = self._filter(blocklist=["1.2.3.4"])
+        self.assertFalse(source_filter.accept(("1.2.3.4", 6881)))
+        self.assertTrue(source_filter.accept(("1.2.3.5", 6881)))
+        source_filter.unblock("1.2.3.4")
+        self.assertTrue(source_filter.accept(("1.2.3.4", 6881)))
+        self.assertEquals(1, source_filter.counters["blocked"])
+
+    def test_accept_blockedNetwork(self):
+        source_filter = self._filter(blocklist=["10.0.0.0/8", "1.2.3.0/24"])
+        self.assertFalse(source_filter.accept(("10.200.1.1", 6881)))
+        self.assertFalse(source_filter.accept(("1.2.3.200", 6881)))
+        self.assertTrue(source_filter.accept(("1.2.4.1", 6881)))
+        self.assertTrue(source_filter.accept(("11.0.0.1", 6881)))
+        source_filter.unblock("10.0.0.0/8")
+        self.assertTrue(source_filter.accept(("10.200.1.1", 6881)))
+
+    def test_block_invalidNetwork(self):
+        source_filter = self._filter()
+        self.assertRaises(ValueError, source_filter.block, "not an ip")
+        self.assertRaises(ValueError, source_filter.block, "1.2.3.0/33")
+        self.assertRaises(ValueError, source_filter.block, "1.2.3.0/x")
+
+    def test_accept_sourceRateLimited(self):
+        # Burst of two seconds worth of packets
+        source_filter = self._filter(source_rate=10)
+        self.assertEquals(20, self._accepted(source_filter, "1.2.3.4", 30))
+        self.assertEquals(20, self._accepted(source_filter, "1.2.3.5", 30))
+        self.assertEquals(20, source_filter.counters["source_rate"])
+        self.clock.advance(1)
+        self.assertEquals(10, self._accepted(source_filter, "1.2.3.4", 30))
+
+    def test_accept_expectedSourcesNotRateLimited(self):
+        source_filter = self._filter(source_rate=10, subnet_rate=10,
+                                     blocklist=["1.2.4.0/24"])
+        self.assertEquals(20, self._accepted(source_filter, "1.2.3.4", 30))
+        self.assertEquals(30, sum(source_filter.accept(("1.2.3.4", 6881),
+                                                       expected=True)
+                                  for _ in range(30)))
+        self.assertFalse(source_filter.accept(("1.2.4.1", 6881),
+                                              expected=True))
+
+    def test_accept_subnetRateLimited(self):
+        source_filter = self._filter(subnet_rate=10)
+        self.assertEquals(10, self._accepted(source_filter, "1.2.3.4", 10))
+        self.assertEquals(10, self._accepted(source_filter, "1.2.3.5", 20))
+        self.assertEquals(20, self._accepted(source_filter, "1.2.4.5", 20))
+        self.assertEquals(10, source_filter.counters["subnet_rate"])
+
+    def test_accept_boundedMemory(self):
+        source_filter = self._filter(source_rate=10, subnet_rate=10,
+                                     max_sources=5)
+        for i in range(20):
+            source_filter.accept(("1.2.%d.4" % i, 6881))
+        stats = source_filter.get_stats()
+        self.assertEquals(5, stats["tracked_sources"])
+        self.assertEquals(5, stats["tracked_subnets"])
@@ -0,0 +1,82 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from mdht.timer_wheel import TimerWheel
+from mdht.test.utils import Counter
+
+class TimerWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(granularity=1, num_slots=8,
+                                _reactor=self.clock)
+        self.counter = Counter()
+
+    def test_callLater_firesAfterDelay(self):
+        self.wheel.callLater(3, self.counter)
+        self.clock.advance(2)
+        self.assertEquals(0, self.counter.count)
+        self.clock.advance(1)
+        self.assertEquals(1, self.counter.count)
+        self.assertEquals(0, len(self.wheel))
+
+    def test_callLater_passesArguments(self):
+        results = []
+        self.wheel.callLater(1, results.append, 5)
+        self.clock.advance(1)
+        self.assertEquals([5], results)
+
+    def test_callLater_delayLongerThanWheel(self):
+        timer = self.wheel.callLater(20, self.counter)
+        self.clock.pump([1] * 19)
+        self.assertEquals(0, self.counter.count)
+        self.assertTrue(timer.active())
+        self.clock.advance(1)
+        self.assertEquals(1, self.counter.count)
+        self.assertFalse(timer.active())
+
+    def test_cancel_preventsFiring(self):
+        timer = self.wheel.callLater(2, self.counter)
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertEquals(0, len(self.wheel))
+        self.clock.advance(5)
+        self.assertEquals(0, self.counter.count)
+        # Cancelling twice does nothing
+        timer.cancel()
+
+    def test_cancel_byEarlierTimerInSameSlot(self):
+        timers = []
+        timers.append(self.wheel.callLater(1, lambda: timers[1].cancel()))
+        timers.append(self.wheel.callLater(1, self.counter))
+        self.clock.advance(1)
+        # Whichever timer fired first, the wheel stays consistent
+        self.assertEquals(0, len(self.wheel))
+        self.assertTrue(self.counter.count <= 1)
+
+    def test_tick_onlyScheduledWhileTimersPending(self):
+        self.wheel.callLater(1, self.counter)
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(1)
+        self.assertEquals(0, len(self.clock.getDelayedCalls()))
+
+    def test_tick_catchesUpAfterLateTick(self):
+        self.wheel.callLater(1, self.counter)
+        self.wheel.callLater(3, self.counter)
+        # The reactor was busy and the tick is late
+        self.clock.advance(5)
+        self.assertEquals(2, self.counter.count)
+
+    def test_callLater_neverFiresEarlyWhileTicking(self):
+        fired = []
+        # Keep the wheel ticking
+        self.wheel.callLater(100, self.counter)
+        for start in [0.25, 0.5, 0.75, 1.0, 1.3]:
+            self.clock.advance(start - self.clock.seconds())
+            scheduled = self.clock.seconds()
+            self.wheel.callLater(1.0, lambda scheduled=scheduled:
+                fired.append((scheduled, self.clock.seconds())))
+        self.clock.pump([0.05] * 100)
+        self.assertEquals(5, len(fired))
+        for scheduled, at in fired:
+            self.assertTrue(scheduled + 1.0 <= at + 1e-6, (scheduled, at))
+            self.assertTrue(at <= scheduled + 2.0 + 1e-6, (scheduled, at))
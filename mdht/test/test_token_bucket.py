@@ -0,0 +1,27 @@
+from twisted.trial import unittest
+
+from mdht.token_bucket import TokenBucket
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bucket = TokenBucket(rate=10, burst=20, now=0)
+
+    def test_consume_startsFull(self):
+        self.assertTrue(self.bucket.consume(20, 0))
+        self.assertFalse(self.bucket.consume(1, 0))
+
+    def test_consume_refillsOverTime(self):
+        self.bucket.consume(20, 0)
+        self.assertFalse(self.bucket.consume(10, 0.5))
+        self.assertTrue(self.bucket.consume(10, 1))
+
+    def test_consume_refillCappedAtBurst(self):
+        self.assertTrue(self.bucket.full(100))
+        self.assertFalse(self.bucket.consume(21, 100))
+
+    def test_time_until(self):
+        self.assertEquals(0, self.bucket.time_until(20, 0))
+        self.bucket.consume(20, 0)
+        self.assertEquals(0.5, self.bucket.time_until(5, 0))
+        self.assertFalse(self.bucket.full(1))
+        self.assertTrue(self.bucket.full(2))
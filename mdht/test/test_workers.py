@@ -0,0 +1,180 @@
+from twisted.trial import unittest
+from twisted.internet import protocol
+from twisted.internet.task import Clock as ReactorClock
+
+from mdht import contact, workers
+from mdht.coding import basic_coder, krpc_coder
+from mdht.krpc_types import Query, Response
+from mdht.kademlia.routing_table import TreeRoutingTable
+from mdht.protocols.krpc_sender import KRPC_Sender
+from mdht.protocols.krpc_responder import KRPC_Responder
+from mdht.workers import WorkerChannel, aggregate_stats
+from mdht.test.utils import Counter, HollowTransport
+
+address = ("1.2.3.4", 6881)
+
+class _RecordingTransport(object):
+    def __init__(self):
+        self.packets = []
+
+    def write(self, packet, address):
+        self.packets.append((packet, address))
+
+class WorkerChannelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = ReactorClock()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50,
+                                       _reactor=self.clock)
+        self.k_messenger.transport = HollowTransport()
+        self.channel = self._channel(self.k_messenger, 1)
+
+    def _channel(self, k_messenger, index):
+        channel = WorkerChannel(k_messenger, index, 3, 7100, "127.0.0.1",
+                                10, self.clock)
+        channel.transport = _RecordingTransport()
+        return channel
+
+    def test_init_invalidIndex(self):
+        self.assertRaises(ValueError, WorkerChannel, self.k_messenger, 3, 3)
+
+    def test_generate_transaction_id_partitioned(self):
+        transaction_ids = [self.k_messenger._generate_transaction_id()
+                           for _ in range(100)]
+        for transaction_id in transaction_ids:
+            self.assertEquals(1, self.channel.owner(transaction_id))
+
+    def test_generate_transaction_id_partitionedCompact(self):
+        for _ in range(2**16):
+            transaction_id = self.k_messenger._generate_transaction_id()
+            self.assertTrue(transaction_id < 2**16, transaction_id)
+
+    def test_datagramReceived_keepsRepliesOfNoWorker(self):
+        self.k_messenger.krpcReceived = Counter()
+        response = Response(_transaction_id=4 * 17 + 3, _from=9)
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        self.assertEquals(1, self.k_messenger.krpcReceived.count)
+        self.assertEquals([], self.channel.transport.packets)
+
+    def test_generate_transaction_id_partitionedCollision(self):
+        transaction_id = self.k_messenger._generate_transaction_id()
+        self.k_messenger._transactions[transaction_id] = None
+        self.k_messenger._transaction_counter += 2**16 - 1
+        other_id = self.k_messenger._generate_transaction_id()
+        self.assertNotEquals(transaction_id, other_id)
+        self.assertEquals(1, self.channel.owner(other_id))
+
+    def test_datagramReceived_forwardsRepliesOfOtherWorkers(self):
+        self.k_messenger.krpcReceived = Counter()
+        response = Response(_transaction_id=4 * 17 + 2, _from=9)
+        data = krpc_coder.encode(response)
+        self.k_messenger.datagramReceived(data, address)
+        self.assertEquals(0, self.k_messenger.krpcReceived.count)
+        [(packet, destination)] = self.channel.transport.packets
+        self.assertEquals(("127.0.0.1", 7102), destination)
+        self.assertEquals("f" + basic_coder.encode_address(address) + data,
+                          packet)
+
+    def test_datagramReceived_keepsOwnRepliesAndQueries(self):
+        self.k_messenger.krpcReceived = Counter()
+        response = Response(_transaction_id=4 * 17 + 1, _from=9)
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        query = Query(_transaction_id=4 * 17 + 2, _from=9, rpctype="ping")
+        self.k_messenger.datagramReceived(krpc_coder.encode(query), address)
+        self.assertEquals(2, self.k_messenger.krpcReceived.count)
+        self.assertEquals([], self.channel.transport.packets)
+
+    def test_forwardedReplyCompletesQuery(self):
+        query = Query(rpctype="ping")
+        d = self.k_messenger.sendQuery(query, address, 10)
+        response = query.build_response()
+        response._from = 9
+        # As received (and forwarded) by another worker
+        other = self._channel(KRPC_Sender(TreeRoutingTable, 2**50,
+                                          _reactor=self.clock), 0)
+        other.forward(krpc_coder.encode(response),
+                      response._transaction_id, address)
+        [(packet, _)] = other.transport.packets
+        self.channel.datagramReceived(packet, ("127.0.0.1", 7100))
+        results = []
+        d.addCallback(results.append)
+        self.assertEquals(query._transaction_id, results[0]._transaction_id)
+        self.assertEquals(1, self.channel.counters["forwarded_received"])
+
+    def test_datagramReceived_ignoresForeignSources(self):
+        self.k_messenger.krpcReceived = Counter()
+        self.channel.datagramReceived("f" + "x" * 20, address)
+        self.assertEquals(0, self.k_messenger.krpcReceived.count)
+        self.assertEquals(1, self.channel.counters["foreign"])
+
+    def test_share_nodes(self):
+        self.channel.startProtocol()
+        self.addCleanup(self.channel.stopProtocol)
+        node = contact.Node(2**10, ("1.1.1.1", 1111))
+        self.k_messenger.routing_table.offer_node(node)
+        self.clock.advance(10)
+        packets = self.channel.transport.packets
+        self.assertEquals([("127.0.0.1", 7100), ("127.0.0.1", 7102)],
+                          [destination for _, destination in packets])
+        self.assertEquals("n" + contact.encode_node(node), packets[0][0])
+        # Nothing new to share
+        self.clock.advance(10)
+        self.assertEquals(2, len(packets))
+
+    def test_datagramReceived_sharedNodesAreNotSharedBack(self):
+        self.channel.startProtocol()
+        self.addCleanup(self.channel.stopProtocol)
+        node = contact.Node(2**10, ("1.1.1.1", 1111))
+        self.channel.datagramReceived("n" + contact.encode_node(node),
+                                      ("127.0.0.1", 7100))
+        self.assertEquals(node.address, self.k_messenger.routing_table
+                                            .get_node(2**10).address)
+        self.clock.advance(10)
+        self.assertEquals([], self.channel.transport.packets)
+
+    def test_announcedPeerIsSharedWithOtherWorkers(self):
+        responders = [KRPC_Responder(node_id=2**50, _reactor=self.clock)
+                      for _ in range(2)]
+        channels = []
+        for index, responder in enumerate(responders):
+            responder.transport = HollowTransport()
+            channels.append(self._channel(responder, index))
+        get_peers = Query(_transaction_id=1, rpctype="get_peers",
+                          _from=9, target_id=800)
+        responders[0].krpcReceived(get_peers, address)
+        token = responders[0]._token_generator.generate(get_peers, address)
+        announce = Query(_transaction_id=2, rpctype="announce_peer",
+                         _from=9, target_id=800, token=token, port=55)
+        responders[0].krpcReceived(announce, address)
+        packets = channels[0].transport.packets
+        self.assertEquals([("127.0.0.1", 7101), ("127.0.0.1", 7102)],
+                          [destination for _, destination in packets])
+        channels[1].datagramReceived(packets[0][0], ("127.0.0.1", 7100))
+        self.assertEquals(set([(address[0], 55)]),
+                          responders[1]._datastore[800])
+        self.assertEquals(1, channels[1].counters["received_peers"])
+
+class AggregateStatsTestCase(unittest.TestCase):
+    def test_aggregate_stats(self):
+        stats = aggregate_stats([
+            {"sent": 1, "lag": 0.5, "nested": {"count": 2, "shed": ["ping"]},
+             "flag": True},
+            {"sent": 2, "lag": 0.1, "nested": {"count": 3}, "other": None}])
+        self.assertEquals({"sent": 3, "nested": {"count": 5}}, stats)
+
+class _NullProtocol(protocol.DatagramProtocol):
+    pass
+
+class ReusePortTestCase(unittest.TestCase):
+    if not workers.reuseport_available():
+        skip = "SO_REUSEPORT is not available on this system"
+
+    def test_listen_reuseport_sharesPort(self):
+        first = workers.listen_reuseport(0, _NullProtocol(), "127.0.0.1")
+        self.addCleanup(first.stopListening)
+        port_number = first.getHost().port
+        second = workers.listen_reuseport(port_number, _NullProtocol(),
+                                          "127.0.0.1")
+        self.addCleanup(second.stopListening)
+        self.assertEquals(port_number, second.getHost().port)
@@ -82,6 +82,9 @@ class HollowDelayedCall(object):
         self._active = False
 
 class HollowReactor(object):
+    def seconds(self):
+        return 0
+
     def callLater(self, timeout, function, *args, **kwargs):
         return HollowDelayedCall()
 
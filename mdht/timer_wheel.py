@@ -0,0 +1,154 @@
+"""
+@author Greg Skoczek
+
+A coarse grained timer for large numbers of short lived timeouts
+
+Scheduling a reactor DelayedCall for every outstanding query means
+that the reactor's heap of timed calls grows and shrinks on every
+send and every reply. A TimerWheel instead keeps its timers in a
+ring of slots (one slot per `granularity' seconds) and asks the
+reactor for a single periodic tick that expires whole slots at once.
+Adding and cancelling a timer only touches a python set.
+
+Timers never fire early, and up to one granularity later than
+requested, which is fine for timeouts
+
+"""
+import math
+
+from twisted.python import log
+from twisted.internet import reactor
+
+class TimerWheel(object):
+    """
+    A ring of `num_slots' slots, each covering `granularity' seconds
+
+    Delays longer than the ring are supported; such timers stay in
+    their slot while the wheel makes more than one revolution
+
+    """
+    def __init__(self, granularity, num_slots, _reactor=None):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        self._reactor = _reactor
+        self.granularity = float(granularity)
+        self._slots = [set() for _ in xrange(num_slots)]
+        self._epoch = self._reactor.seconds()
+        # The last tick whose slot has been expired
+        self._processed_tick = 0
+        self._tick_call = None
+        self._count = 0
+
+    def callLater(self, delay, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) after (about) `delay' seconds
+
+        @returns a timer object providing active() and cancel(), as
+            a twisted DelayedCall would
+
+        """
+        elapsed = self._reactor.seconds() - self._epoch
+        current_tick = self._current_tick()
+        if self._count == 0:
+            # Nothing is pending, so there are no slots to catch up on
+            self._processed_tick = current_tick
+        # The deadline is the first tick at or after the absolute
+        # time the timer is due (the current tick is rounded down,
+        # so counting from it would fire up to a granularity early)
+        deadline = max(current_tick + 1,
+                int(math.ceil((elapsed + delay) / self.granularity)))
+        timer = _WheelTimer(self, deadline, function, args, kwargs)
+        self._slots[timer.deadline % len(self._slots)].add(timer)
+        self._count += 1
+        if self._tick_call is None:
+            self._schedule_tick(current_tick)
+        return timer
+
+    def __len__(self):
+        """The number of pending timers"""
+        return self._count
+
+    def _cancel(self, timer):
+        slot = self._slots[timer.deadline % len(self._slots)]
+        slot.discard(timer)
+        self._count -= 1
+
+    def _current_tick(self):
+        elapsed = self._reactor.seconds() - self._epoch
+        # Tolerate the rounding of a tick scheduled for a tick boundary
+        return int(elapsed / self.granularity + 1e-9)
+
+    def _schedule_tick(self, current_tick):
+        """Tick at the boundary of the tick after current_tick"""
+        next_boundary = self._epoch + (current_tick + 1) * self.granularity
+        delay = max(0, next_boundary - self._reactor.seconds())
+        self._tick_call = self._reactor.callLater(delay, self._tick)
+
+    def _tick(self):
+        """Expire every slot that has come due since the last tick"""
+        self._tick_call = None
+        current_tick = self._current_tick()
+        # One revolution is enough to visit every slot
+        first_tick = max(self._processed_tick + 1,
+                         current_tick - len(self._slots) + 1)
+        expired = []
+        for tick in xrange(first_tick, current_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                due = [timer for timer in slot
+                       if timer.deadline <= current_tick]
+                slot.difference_update(due)
+                expired.extend(due)
+        self._processed_tick = current_tick
+
+        for timer in expired:
+            # An earlier timer may have cancelled this one
+            if timer.active():
+                self._count -= 1
+                timer._fire()
+
+        if self._count > 0 and self._tick_call is None:
+            self._schedule_tick(current_tick)
+
+class _WheelTimer(object):
+    """A timer pending in a TimerWheel"""
+
+    __slots__ = ("wheel", "deadline", "function", "args", "kwargs")
+
+    def __init__(self, wheel, deadline, function, args, kwargs):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def active(self):
+        """Tells whether this timer has neither fired nor been cancelled"""
+        return self.wheel is not None
+
+    def cancel(self):
+        """
+        Prevent this timer from firing
+
+        Nothing happens if the timer has already fired or been cancelled
+
+        """
+        if self.wheel is not None:
+            self.wheel._cancel(self)
+            self._clear()
+
+    def _fire(self):
+        function, args, kwargs = self.function, self.args, self.kwargs
+        self._clear()
+        try:
+            function(*args, **kwargs)
+        except:
+            log.err(None, "Error while firing a TimerWheel timer")
+
+    def _clear(self):
+        self.wheel = None
+        self.function = None
+        self.args = None
+        self.kwargs = None
@@ -0,0 +1,52 @@
+"""
+@author Greg Skoczek
+
+A token bucket, used to limit the rate of traffic
+
+"""
+class TokenBucket(object):
+    """
+    Allow `rate' tokens per second, in bursts of up to `burst' tokens
+
+    The bucket starts out full. The current time is always supplied
+    by the caller (so that a single clock reading can be shared by
+    many buckets)
+
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_update = now
+
+    def consume(self, amount, now):
+        """
+        Take `amount' tokens out of the bucket if there are enough
+
+        @returns boolean indicating whether the tokens were taken
+
+        """
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def time_until(self, amount, now):
+        """Return the number of seconds until `amount' tokens are available"""
+        self._refill(now)
+        missing = amount - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def full(self, now):
+        """Tells whether the bucket has refilled completely"""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def _refill(self, now):
+        elapsed = now - self.last_update
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_update = now
@@ -12,32 +12,37 @@ class Transaction(object):
     A class wrapping essential attributes of a transaction in the DHT network
 
     query: the query this transaction refers to
-    deferred: the deferred that will be fired once a response/error is
+    callback: called with (response, error) once a response/error is
               received corresponding to the query (or the query times out)
     timeout_call: the delayed call that is used to time this query out
                  (and remove this transaction from the transaction table)
     address: the address of the target node of this transaction
+    packet: the encoded query, as sent (and sent again) to address
     time: the time that this transaction originated
+    waiters: callbacks of identical queries waiting
+             on the result of this one (or None)
+    attempts: the number of times the query has been sent
+    retransmit_call: the timer used to send the query again (or None)
+
+    Transactions compare (and hash) by identity. One is kept for
+    every outstanding query, so the attributes are slotted. Once
+    the transaction completes, its callbacks and timers are dropped
 
     """
+    __slots__ = ("query", "callback", "timeout_call", "address", "packet",
+                 "time", "waiters", "attempts", "retransmit_call")
+
     def __init__(self):
         self.query = None
-        self.deferred = None
+        self.callback = None
         self.timeout_call = None
         self.address = None
+        self.packet = None
         self.time = time.time()
-
-    def __eq__(self, other):
-        return not self.__ne__(other)
-
-    def __ne__(self, other):
-        return self.__hash__() ^ other.__hash__()
-
-    def __hash__(self):
-        return long(
-                round(
-                    float("%d%f" % (self.query.transaction_id, self.time))))
+        self.waiters = None
+        self.attempts = 1
+        self.retransmit_call = None
 
     def __str__(self):
         return "transaction: id=%d, time=%d" % (
-                self.query.transaction_id, self.time)
+                self.query._transaction_id, self.time)
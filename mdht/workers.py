@@ -0,0 +1,270 @@
+"""
+@author Greg Skoczek
+
+Serving one DHT node from several worker processes
+
+Every worker binds the DHT port with SO_REUSEPORT, so that the kernel
+spreads incoming datagrams over the workers (by source address). All
+workers share one node id. The lowest bits of the transaction ids of
+a worker's queries hold the worker's index (@see
+KRPC_Sender._generate_transaction_id), so a reply that reaches the
+wrong worker can be forwarded to the one that sent the query.
+
+Workers talk to each other through a WorkerChannel: a UDP port on the
+loopback interface per worker (base_port + index). Besides forwarded
+replies, workers tell each other about the nodes they have added to
+their routing tables, in batches every `share_interval' seconds, and
+about every peer announced to them (as soon as it is announced), so
+that a get_peers query finds the peers announced to any worker.
+
+Token secrets are not shared: a token is only valid at the worker
+that handed it out. The kernel picks the worker by source address
+and port, so a client that announces from the port it sent its
+get_peers query from reaches the same worker.
+
+The channel trusts every datagram from its loopback interface: any
+local process can send it replies (with whatever source address it
+likes) and nodes for the routing table. Do not run workers on hosts
+whose local users are not trusted.
+
+"""
+import socket
+from collections import defaultdict
+
+from zope.interface import implements
+from twisted.python import log
+from twisted.internet import reactor, protocol, task, udp
+
+from mdht import constants, contact, recvmmsg
+from mdht.coding import basic_coder, krpc_coder
+from mdht.coding.krpc_coder import InvalidKRPCError
+from mdht.kademlia.routing_table import IRoutingTableObserver
+
+# The first byte of every message between workers
+_FORWARD = "f"
+_NODES = "n"
+_PEER = "a"
+
+# Size of an encoded address and of an encoded node
+_ADDRESS_SIZE = 6
+_NODE_SIZE = 26
+_ID_SIZE = 20
+
+def reuseport_available():
+    """Tells whether SO_REUSEPORT is supported on this system"""
+    return hasattr(socket, "SO_REUSEPORT")
+
+class _ReusePortMixin(object):
+    def createInternetSocket(self):
+        sock = super(_ReusePortMixin, self).createInternetSocket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
+
+class ReusePort(_ReusePortMixin, udp.Port):
+    """A udp.Port that other processes can bind as well"""
+
+class RecvmmsgReusePort(_ReusePortMixin, recvmmsg.RecvmmsgPort):
+    """A RecvmmsgPort that other processes can bind as well"""
+
+def listen_reuseport(port, protocol, interface='', maxPacketSize=8192,
+        _reactor=None):
+    """
+    Listen for datagrams on a port shared with other processes
+
+    A RecvmmsgPort is used where recvmmsg is available
+
+    @raises NotImplementedError if SO_REUSEPORT is not available
+    @returns the listening port
+
+    """
+    if _reactor is None:
+        _reactor = reactor
+    if not reuseport_available():
+        raise NotImplementedError("SO_REUSEPORT is not available")
+    if recvmmsg.available():
+        port_class = RecvmmsgReusePort
+    else:
+        port_class = ReusePort
+    p = port_class(port, protocol, interface, maxPacketSize, _reactor)
+    p.startListening()
+    return p
+
+class WorkerChannel(protocol.DatagramProtocol):
+    """
+    Connect a worker's KRPC protocol to the other workers of its node
+
+    The channel has to listen on (interface, base_port + index)
+
+    """
+    implements(IRoutingTableObserver)
+
+    def __init__(self, krpc_protocol, index, count,
+            base_port=constants.worker_base_port, interface="127.0.0.1",
+            share_interval=constants._worker_share_interval,
+            _reactor=None):
+        # If the user doesn't specify a reactor, we will use
+        # one from twisted.internet
+        if _reactor is None:
+            _reactor = reactor
+        if not 0 <= index < count:
+            raise ValueError("invalid worker index: %d of %d" %
+                             (index, count))
+        self.krpc_protocol = krpc_protocol
+        self.index = index
+        self.count = count
+        # The bits of a transaction id holding the index of its owner
+        self.index_bits = (count - 1).bit_length()
+        self.base_port = base_port
+        self.interface = interface
+        # Nodes added to our routing table since they were last shared
+        self._new_nodes = []
+        self._receiving_nodes = False
+        self.counters = defaultdict(int)
+        self._share_loop = task.LoopingCall(self.share_nodes)
+        self._share_loop.clock = _reactor
+        self.share_interval = share_interval
+        krpc_protocol.worker_channel = self
+        krpc_protocol.routing_table.register_observer(self)
+
+    def startProtocol(self):
+        self._share_loop.start(self.share_interval, now=False)
+
+    def stopProtocol(self):
+        if self._share_loop.running:
+            self._share_loop.stop()
+
+    def owner(self, transaction_id):
+        """
+        @returns the index of the worker that generated transaction_id
+            (or of no worker, if the id was not generated by a worker)
+
+        """
+        return transaction_id & ((1 << self.index_bits) - 1)
+
+    def forward(self, data, transaction_id, address):
+        """
+        Hand a reply datagram to the worker owning its transaction
+
+        @returns boolean indicating whether the datagram was forwarded
+            (it was not if it belongs to this worker)
+
+        """
+        owner = self.owner(transaction_id)
+        if owner == self.index or owner >= self.count:
+            return False
+        self.transport.write(
+            _FORWARD + basic_coder.encode_address(address) + data,
+            self._worker_address(owner))
+        self.counters["forwarded"] += 1
+        return True
+
+    def share_nodes(self):
+        """Tell the other workers about the nodes added since last time"""
+        nodes, self._new_nodes = self._new_nodes, []
+        per_datagram = constants._worker_nodes_per_datagram
+        for start in xrange(0, len(nodes), per_datagram):
+            message = _NODES + "".join(contact.encode_node(node) for node
+                                       in nodes[start:start + per_datagram])
+            for index in xrange(self.count):
+                if index != self.index:
+                    self.transport.write(message, self._worker_address(index))
+        self.counters["shared_nodes"] += len(nodes)
+
+    def share_peer(self, infohash, peer_address):
+        """Tell the other workers about a peer announced to this one"""
+        message = (_PEER + basic_coder.encode_network_id(infohash) +
+                   basic_coder.encode_address(peer_address))
+        for index in xrange(self.count):
+            if index != self.index:
+                self.transport.write(message, self._worker_address(index))
+        self.counters["shared_peers"] += 1
+
+    def datagramReceived(self, data, address):
+        if address[0] != self.interface:
+            self.counters["foreign"] += 1
+            return
+        kind = data[:1]
+        if kind == _FORWARD:
+            self._forwarded_received(data[1:])
+        elif kind == _NODES:
+            self._nodes_received(data[1:])
+        elif kind == _PEER:
+            self._peer_received(data[1:])
+
+    def get_stats(self):
+        stats = dict(self.counters)
+        stats["index"] = self.index
+        stats["count"] = self.count
+        return stats
+
+    def node_added(self, node):
+        # Nodes learned from other workers are not shared back
+        if self._share_loop.running and not self._receiving_nodes:
+            self._new_nodes.append(node)
+
+    def node_removed(self, node):
+        pass
+
+    def bucket_split(self, kbucket, lbucket, rbucket):
+        pass
+
+    def _forwarded_received(self, data):
+        try:
+            address = basic_coder.decode_address(data[:_ADDRESS_SIZE])
+            krpc = krpc_coder.decode(data[_ADDRESS_SIZE:])
+        except (basic_coder.InvalidDataError, InvalidKRPCError):
+            log.msg("dropping a malformed datagram from another worker")
+            return
+        self.counters["forwarded_received"] += 1
+        self.krpc_protocol.krpcReceived(krpc, address)
+
+    def _nodes_received(self, data):
+        routing_table = self.krpc_protocol.routing_table
+        self._receiving_nodes = True
+        try:
+            for start in xrange(0, len(data) - _NODE_SIZE + 1, _NODE_SIZE):
+                try:
+                    node = contact.decode_node(
+                                data[start:start + _NODE_SIZE])
+                except basic_coder.InvalidDataError:
+                    continue
+                if node.node_id != self.krpc_protocol.node_id:
+                    routing_table.offer_node(node)
+                self.counters["received_nodes"] += 1
+        finally:
+            self._receiving_nodes = False
+
+    def _peer_received(self, data):
+        try:
+            infohash = basic_coder.decode_network_id(data[:_ID_SIZE])
+            peer_address = basic_coder.decode_address(data[_ID_SIZE:])
+        except basic_coder.InvalidDataError:
+            log.msg("dropping a malformed datagram from another worker")
+            return
+        self.krpc_protocol.store_peer(infohash, peer_address)
+        self.counters["received_peers"] += 1
+
+    def _worker_address(self, index):
+        return (self.interface, self.base_port + index)
+
+def aggregate_stats(worker_stats):
+    """
+    Combine the statistics reported by several workers
+
+    Integer counters are summed, dictionaries are combined key by
+    key; anything else (rates, lags, percentiles) is not additive,
+    and is left out
+
+    @param worker_stats: a list of get_stats() dictionaries
+    @returns the combined dictionary
+
+    """
+    total = dict()
+    for stats in worker_stats:
+        for key, value in stats.iteritems():
+            if isinstance(value, dict):
+                total[key] = aggregate_stats([total.get(key, {}), value])
+            elif (isinstance(value, (int, long)) and
+                    not isinstance(value, bool)):
+                total[key] = total.get(key, 0) + value
+    return total
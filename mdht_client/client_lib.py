@@ -41,6 +41,9 @@ class RPCClient(object):
     def grab_nodes(self):
         return self._call('grab_nodes')
 
+    def stats(self):
+        return self._call('stats')
+
     def _deserialize(self, serial_val):
         return pickle.loads(serial_val)
 
@@ -1 +1,37 @@
 SERVER_PORT = 7001
+
+# Node list files (libtorrent dht_state files or `host:port' lists)
+# that are imported into the routing table on startup
+# @see mdht.node_import
+NODE_LISTS = []
+
+# Addresses ("1.2.3.4") and networks ("1.2.3.0/24") from which
+# incoming datagrams are always dropped
+# @see mdht.source_filter
+BLOCKLIST = []
+
+# Sizes requested for the DHT socket's receive and send buffers (bytes,
+# or None for the system defaults). Linux caps them at
+# net.core.rmem_max / wmem_max
+# @see mdht.socket_monitor
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_BUFFER_SIZE = 1024 * 1024
+
+# Read datagrams in batches with recvmmsg (where available)
+# @see mdht.recvmmsg
+USE_RECVMMSG = True
+
+# The number of processes decoding the batches read with recvmmsg
+# (and computing tokens), or 0 to decode them in the server process
+# @see mdht.offload
+DECODE_WORKERS = 0
+
+# The number of worker processes serving the node when started with
+# ./workers (they share SERVER_PORT through SO_REUSEPORT, and one node
+# id). Worker i talks to the other workers on the loopback port
+# WORKER_BASE_PORT + i, and serves rpc on RPC_PORT + i
+# @see mdht.workers
+WORKERS = 4
+WORKER_BASE_PORT = 7100
+
+RPC_PORT = 5000